@@ -0,0 +1,368 @@
+from collections import OrderedDict, namedtuple
+import io
+import os
+
+from constants import DATABASE_FILENAME
+from index import Index, sort_key
+from inventory import Inventory
+from range_cache import range_key
+from shards import load_manifest, shard_of, sync_indexes
+
+"""
+Reading files from a backup
+---------------------------
+
+`BitumArchive` reads files straight from the `.bitumen`-files of a backup
+without extracting it -- `RemoteArchive` from the bucket and `BitumArchive`
+from `.bitumen`-files on disk:
+
+    with RemoteArchive(s3_client, 'my-bucket', 'backups/') as archive:
+        archive.listdir('/projects')
+        with archive.open('/projects/foo/README.md') as f:
+            f.seek(100)
+            f.read(50)
+
+The index is opened once (a remote index is synced to the cache first, see
+`remote_index.sync_index()`). `open()` returns a seekable, read-only binary
+file.
+
+The `.bitumen`-files are read in blocks of `block_size` bytes, aligned to the
+start of the `.bitumen`-file, that are kept in an LRU-cache shared by all
+open files. Small files are stored back-to-back, so reading the files of a
+directory one after the other mostly hits blocks that are already cached.
+When a file is read sequentially, the blocks after the read are fetched in
+the same request (read-ahead) -- starting at a single block and doubling up
+to `max_readahead` blocks, like the read-ahead of the Linux page cache. A
+request never fetches more than `max_readahead` blocks.
+"""
+
+BLOCK_SIZE = 2**18  # 256 KiB
+CACHE_BLOCKS = 256  # 64 MiB
+MAX_READAHEAD = 16  # 4 MiB
+
+ArchiveStat = namedtuple(
+    'ArchiveStat', ['path', 'is_dir', 'file_size', 'file_hash', 'file_perms']
+)
+
+
+def _normalize(path):
+    # type: (str) -> str
+    "`a/b/` -> `/a/b` and `/` -> `''` like paths in the index"
+    return ''.join(f'/{component}' for component in path.split('/') if component)
+
+
+class BitumArchive:
+    """A backup opened for reading
+
+    `db_filepaths` are the indexes of the backup -- keyed by shard subtree
+    with `shard_depth` for a sharded backup, or `{None: db_filepath}`. The
+    `.bitumen`-files are read from `bucket_dir`.
+    """
+
+    def __init__(
+        self,
+        db_filepaths=None,
+        bucket_dir='.',
+        shard_depth=None,
+        block_size=BLOCK_SIZE,
+        cache_blocks=CACHE_BLOCKS,
+        max_readahead=MAX_READAHEAD,
+    ):
+        if db_filepaths is None:
+            db_filepaths = {None: DATABASE_FILENAME}
+        self.indexes = {
+            key: Index(db_filepath) for key, db_filepath in db_filepaths.items()
+        }
+        self.bucket_dir = bucket_dir
+        self.shard_depth = shard_depth
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.max_readahead = max_readahead
+        self.num_requests = 0
+        self.bytes_read = 0
+        # `(bucket, block_index)` -> block
+        self._blocks = OrderedDict()
+        self._bucket_files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        for index in self.indexes.values():
+            index.close()
+        for f in self._bucket_files.values():
+            f.close()
+
+    def _bucket_size(self, bucket):
+        # type: (str) -> int
+        return os.path.getsize(os.path.join(self.bucket_dir, f'{bucket}.bitumen'))
+
+    def _read_range(self, bucket, offset, size):
+        # type: (str, int, int) -> bytes
+        "Read `size` bytes at `offset` of the `.bitumen`-file of `bucket`"
+        f = self._bucket_files.get(bucket)
+        if f is None:
+            f = open(os.path.join(self.bucket_dir, f'{bucket}.bitumen'), 'rb')
+            self._bucket_files[bucket] = f
+        f.seek(offset)
+        data = f.read(size)
+        self.num_requests += 1
+        self.bytes_read += len(data)
+        return data
+
+    def _index_of(self, path):
+        # type: (str) -> Index | None
+        if self.shard_depth is None:
+            return self.indexes[None]
+        return self.indexes.get(shard_of(path, self.shard_depth))
+
+    def _row(self, path):
+        # type: (str) -> IndexRow | None
+        index = self._index_of(path)
+        return index.lookup(path) if index is not None else None
+
+    def _is_dir(self, path):
+        # type: (str) -> bool
+        # Directories without files are removed from the index, so a
+        # directory exists if it's in any of the indexes (the root always does)
+        return path == '' or any(
+            index.tree_hash(path) is not None for index in self.indexes.values()
+        )
+
+    def listdir(self, path='/'):
+        # type: (str) -> list[str]
+        "Names of the files and directories in the directory `path` (sorted)"
+        path = _normalize(path)
+        if not self._is_dir(path):
+            raise FileNotFoundError(f'No such directory in the backup: "{path}"')
+        names = set()
+        for index in self.indexes.values():
+            names.update(
+                sort_key(row.file_path)[1]
+                for row in index.iter_rows(path, recursive=False)
+            )
+            names.update(sort_key(child)[1] for child in index.child_dirs(path))
+        return sorted(names)
+
+    def stat(self, path):
+        # type: (str) -> ArchiveStat
+        path = _normalize(path)
+        row = self._row(path) if path else None
+        if row is not None:
+            return ArchiveStat(
+                path=path,
+                is_dir=False,
+                file_size=row.file_size,
+                file_hash=row.file_hash,
+                file_perms=row.file_perms,
+            )
+        if self._is_dir(path):
+            return ArchiveStat(
+                path=path, is_dir=True, file_size=None, file_hash=None, file_perms=None
+            )
+        raise FileNotFoundError(f'No such file in the backup: "{path}"')
+
+    def open(self, path):
+        # type: (str) -> io.BufferedReader
+        "Open the file `path` for reading in binary mode"
+        path = _normalize(path)
+        row = self._row(path) if path else None
+        if row is None:
+            if self._is_dir(path):
+                raise IsADirectoryError(f'Is a directory: "{path}"')
+            raise FileNotFoundError(f'No such file in the backup: "{path}"')
+        return io.BufferedReader(ArchiveFile(self, row), buffer_size=self.block_size)
+
+    def _block(self, bucket, block_index, last_block_index):
+        # type: (str, int, int) -> bytes
+        """Block `block_index` of `bucket` from the cache -- or fetched together
+        with the blocks after it up to `last_block_index` in a single request
+        """
+        key = (bucket, block_index)
+        block = self._blocks.get(key)
+        if block is not None:
+            self._blocks.move_to_end(key)
+            return block
+
+        # Stop at the first block that's cached
+        num_blocks = 1
+        while (
+            num_blocks < self.max_readahead
+            and block_index + num_blocks <= last_block_index
+            and (bucket, block_index + num_blocks) not in self._blocks
+        ):
+            num_blocks += 1
+        start = block_index * self.block_size
+        size = min(num_blocks * self.block_size, self._bucket_size(bucket) - start)
+        data = self._read_range(bucket, start, size)
+
+        for i in range(num_blocks):
+            self._blocks[(bucket, block_index + i)] = data[
+                i * self.block_size : (i + 1) * self.block_size
+            ]
+        while len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+        return data[: self.block_size]
+
+    def read(self, bucket, offset, size, readahead=0, readahead_end=None):
+        # type: (str, int, int, int, int | None) -> bytes
+        """Read `size` bytes at `offset` of `bucket` through the block cache
+
+        Up to `readahead` blocks after the ones read are fetched as well, but
+        not past `readahead_end`.
+        """
+        end = offset + size
+        last_block_index = (end - 1) // self.block_size
+        if readahead > 0 and readahead_end is not None and readahead_end > end:
+            last_block_index = min(
+                last_block_index + readahead, (readahead_end - 1) // self.block_size
+            )
+
+        data = bytearray()
+        while offset < end:
+            block_index, block_offset = divmod(offset, self.block_size)
+            block = self._block(bucket, block_index, last_block_index)
+            chunk = block[block_offset : block_offset + end - offset]
+            if not chunk:
+                raise EOFError(f'"{bucket}.bitumen" ends at byte {offset}')
+            data += chunk
+            offset += len(chunk)
+        return bytes(data)
+
+
+class RemoteArchive(BitumArchive):
+    """A backup in the bucket at `prefix` opened for reading
+
+    The `.bitumen`-files are read with HTTP Range requests pinned to the
+    `ETag` they had when the archive was opened, so a concurrent upload
+    that repacks a bucket makes reads fail rather than return the wrong bytes.
+
+    With `range_cache` (a `range_cache.RangeCache`) the blocks are also kept
+    on disk -- keyed by that `ETag` -- so they're only fetched once across
+    runs.
+    """
+
+    def __init__(self, s3_client, bucket, prefix='', range_cache=None, **kwargs):
+        if prefix and not prefix.endswith('/'):
+            prefix = f'{prefix}/'
+        manifest = load_manifest(s3_client, bucket, prefix)
+        db_filepaths = sync_indexes(s3_client, bucket, prefix, manifest)
+        if manifest is None and not db_filepaths:
+            raise ValueError(
+                f'No bitum DB was found at "s3://{bucket}/{prefix}{DATABASE_FILENAME}"'
+            )
+        super().__init__(
+            db_filepaths,
+            shard_depth=manifest['depth'] if manifest is not None else None,
+            **kwargs,
+        )
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.inventory = Inventory(s3_client, bucket, prefix)
+        self.range_cache = range_cache
+
+    def _bucket_size(self, bucket):
+        # type: (str) -> int
+        size = self.inventory.size(bucket)
+        if size is None:
+            raise FileNotFoundError(f'"{self.prefix}{bucket}.bitumen" is missing')
+        return size
+
+    def _read_range(self, bucket, offset, size):
+        # type: (str, int, int) -> bytes
+        etag = self.inventory.objects[bucket].etag
+        end = offset + size
+
+        # Blocks at the start of the range that are in the range cache
+        data = b''
+        if self.range_cache is not None:
+            while offset < end:
+                block_size = min(self.block_size, end - offset)
+                block = self.range_cache.get(range_key(etag, offset, block_size))
+                if block is None:
+                    break
+                data += block
+                offset += block_size
+        if offset == end:
+            return data
+
+        response = self.s3_client.get_object(
+            Bucket=self.bucket,
+            Key=f'{self.prefix}{bucket}.bitumen',
+            Range=f'bytes={offset}-{end - 1}',
+            IfMatch=etag,
+        )
+        fetched = response['Body'].read()
+        self.num_requests += 1
+        self.bytes_read += len(fetched)
+        if self.range_cache is not None:
+            self.range_cache.record_miss(len(fetched))
+            for i in range(0, len(fetched), self.block_size):
+                block = fetched[i : i + self.block_size]
+                self.range_cache.put(range_key(etag, offset + i, len(block)), block)
+        return data + fetched
+
+
+class ArchiveFile(io.RawIOBase):
+    "A file in a `BitumArchive` -- use `BitumArchive.open()`"
+
+    def __init__(self, archive, row):
+        # type: (BitumArchive, IndexRow) -> None
+        self.archive = archive
+        self.row = row
+        self.name = row.file_path
+        self._pos = 0
+        # Where the last read ended -- reads starting there are sequential
+        self._last_end = None
+        self._readahead = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.row.file_size + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+        if pos < 0:
+            raise OSError(f'Negative seek position {pos}')
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        size = min(len(b), self.row.file_size - self._pos)
+        if size <= 0:
+            return 0
+
+        if self._pos == self._last_end:
+            self._readahead = min(
+                max(self._readahead * 2, 1), self.archive.max_readahead
+            )
+        else:
+            self._readahead = 0
+        data = self.archive.read(
+            self.row.bucket,
+            self.row.byte_index + self._pos,
+            size,
+            readahead=self._readahead,
+            # Read ahead to the end of the file at most
+            readahead_end=self.row.byte_index + self.row.file_size,
+        )
+        b[:size] = data
+        self._pos += size
+        self._last_end = self._pos
+        return size
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 import argparse
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import ExitStack
+import json
 import os
 from pathlib import Path
 import re
 import secrets
-import sqlite3
+import shutil
 import string
 import tempfile
+import time
 
 from constants import DATABASE_FILENAME
 from debug_cli import (
@@ -19,16 +22,61 @@ from debug_cli import (
     integrity,
     upload_all,
 )
+from diff import (
+    ADDED,
+    HASH_CHANGED,
+    REMOVED,
+    SIZE_CHANGED,
+    Counted,
+    diff_trees,
+    walk_sorted,
+)
+from index import CHECKSUM_BLOCK_SIZE, Index
+from inventory import Inventory, index_buckets
+from metrics import METRICS, PROFILES, count, profile, span
+from path_filter import PathFilter
+from pipeline import (
+    DEFAULT_BUILD_JOBS,
+    DEFAULT_BUILD_MAX_INFLIGHT,
+    DEFAULT_UPLOAD_JOBS,
+    BucketBuilder,
+    StageStats,
+    Uploader,
+    hash_entries,
+    print_stats,
+)
+from range_cache import DEFAULT_CACHE_SIZE, RangeCache, file_key
+from read_order import DEFAULT_READ_ORDER, READ_ORDERS
+from remote_index import commit_index, index_cache_dir, sync_index
+from shards import (
+    MANIFEST_FILENAME,
+    iter_shard_entries,
+    load_manifest,
+    new_manifest,
+    save_manifest,
+    shard_id,
+    shard_of,
+    shard_prefix,
+    sync_indexes,
+)
+from storage import LocalStorage, copy_to_file
+from transfers import (
+    PART_SIZE,
+    TransferJournal,
+    abort_stale_uploads,
+    bucket_key,
+    journal_path,
+    partial_path,
+)
 from utils import (
     DirEntry,
     TimedMessage,
-    build_bucket,
-    chunks,
-    dirtree_from_db,
-    dirtree_from_disk,
     get_s3_client,
+    parse_size,
     pp_file_size,
 )
+from verify import DEFAULT_JOBS
+from watch import Journal, journal_filter, watch
 
 """
 bitum
@@ -51,81 +99,102 @@ def _bucket_name():
     return ''.join(secrets.choice(alphabet) for i in range(8))
 
 
-def _build_buckets(dir, files):
-    BUCKET_SIZE = 100 * 2**20  # 100 MiB
-
-    buckets = []
-    with TimedMessage('Building buckets...'):
-        # for (file_path, file_type, file_hash, file_size, file_perms) in set_tree1:
-        current_bucket_size = 0
-        current_bucket = []
-        for file_props in files:
-            if file_props.file_size is None:
-                continue
-
-            if current_bucket_size + file_props.file_size > BUCKET_SIZE:
-                current_bucket_size = 0
-                buckets.append((_bucket_name(), current_bucket, current_bucket_size))
-
-            current_bucket.append(file_props)
-            current_bucket_size += file_props.file_size
-
-        buckets.append((_bucket_name(), current_bucket, current_bucket_size))
-
-    num_files = 0
-    total_size = 0
-    for bucket_name, bucket_file_list, bucket_size in buckets:
-        print(
-            f'{bucket_name}: {len(bucket_file_list)} files ({pp_file_size(bucket_size)})'
-        )
-
-        num_files += len(bucket_file_list)
-        total_size += bucket_size
-    print(f'Total: {num_files} files ({pp_file_size(total_size)})')
-
-    #######################
-    # Build bitumen files #
-    #######################
-    db_entries = []
-    with TimedMessage('Building bitumen files...'):
-        print()
-        for bucket_name, bucket_file_list, bucket_size in buckets:
-            db_entries += build_bucket(dir, bucket_name, bucket_file_list)
-        print()
+BUCKET_SIZE = 100 * 2**20  # 100 MiB
+
+
+class _BucketPacker:
+    """Packs new files into buckets of up to `BUCKET_SIZE` as they come in
+
+    Each bucket is handed to `builder` as soon as it's full, and to
+    `uploader` once it's built (see `pipeline.py`). The index entries and
+    checksums of the buckets are kept in `buckets` until the index is updated
+    (`insert_into()`). A bucket gets the name it had in an interrupted run
+    with the same files from `transfers` (see `transfers.py`).
+    """
+
+    def __init__(self, builder, uploader, stats, transfers):
+        # type: (BucketBuilder, Uploader, StageStats, TransferJournal) -> None
+        self.builder = builder
+        self.uploader = uploader
+        self.stats = stats
+        self.transfers = transfers
+        # (bucket_name, db_entries, checksums) of each bucket built
+        self.buckets = []
+        self.num_files = 0
+        self._files = []
+        self._size = 0
+        # (bucket_name, num_files, size, future) of the buckets being built
+        self._pending = deque()
+
+    def add(self, file_props):
+        # type: (DirEntry) -> None
+        if file_props.file_size is None:
+            return
+        if self._files and self._size + file_props.file_size > BUCKET_SIZE:
+            self.flush()
+        self._files.append(file_props)
+        self._size += file_props.file_size
+        self.num_files += 1
+
+    def flush(self):
+        "Start building the bucket of the files added since the last one (if any)"
+        # Without new files no (empty) bucket is made -- it would only be an
+        # orphan in the bucket
+        if self._files:
+            bucket_name = self.transfers.name_bucket(
+                bucket_key(self._files), _bucket_name()
+            )
+            future = self.builder.submit(
+                bucket_name, self._files, self._size, self.stats
+            )
+            self._pending.append((bucket_name, len(self._files), self._size, future))
+            self._files = []
+            self._size = 0
+        self._collect(wait=False)
+
+    def finish(self):
+        "Build the last bucket and wait for all of them to be built"
+        self.flush()
+        self._collect(wait=True)
+
+    def _collect(self, wait):
+        # type: (bool) -> None
+        "Queue the built buckets for upload -- in the order they were added"
+        while self._pending and (wait or self._pending[0][3].done()):
+            bucket_name, num_files, size, future = self._pending.popleft()
+            db_entries, checksums = future.result()
+            print(
+                f'Built "{bucket_name}.bitumen": {num_files} files ({pp_file_size(size)})'
+            )
+            self.buckets.append((bucket_name, db_entries, checksums))
+            self.uploader.submit(bucket_name, self.stats)
 
-    with TimedMessage('Building bitumen database...'):
-        con = sqlite3.connect(DATABASE_FILENAME)
-        cur = con.cursor()
-        cur.execute(
-            'CREATE TABLE IF NOT EXISTS files(bucket, file_path PRIMARY KEY, byte_index, file_size, file_hash, file_perms)'
-        )
-        cur.executemany(
-            'INSERT OR REPLACE INTO files VALUES(?, ?, ?, ?, ?, ?)', db_entries
-        )
-        con.commit()  # Remember to commit the transaction after executing INSERT.
-        con.close()
+    def insert_into(self, index):
+        # type: (Index) -> None
+        for bucket_name, db_entries, checksums in self.buckets:
+            index.insert(db_entries)
+            index.set_checksums(bucket_name, *checksums)
 
-    return buckets
 
+def download_backup_file(
+    args, db_filepath, filepath, range_cache=None, transfers=None, s3_client=None
+):
+    # type: (None, str, str, RangeCache | None, TransferJournal | None, S3Client | None) -> None
+    """Downloads a file from inside a .bitumen-file by doing an HTTP Range request
 
-def download_backup_file(args, db_filepath, filepath):
-    # type: (None, str, str) -> None
-    "Downloads a file from inside a .bitumen-file by doing an HTTP Range request"
-    s3_client = get_s3_client(args.endpoint_url)
+    With `range_cache` the file is copied from the cache if it's there, and
+    added to it otherwise. With `transfers` a large file is downloaded to a
+    partial file first, which a later run continues (see `transfers.py`).
+    """
+    if s3_client is None:
+        s3_client = get_s3_client(args.endpoint_url)
 
     prefix = args.prefix
     if prefix and not prefix.endswith('/'):
         prefix = f'{prefix}/'
 
-    con = sqlite3.connect(db_filepath)
-    con.row_factory = sqlite3.Row  # Allow accessing results by column name
-    cur = con.cursor()
-    cur.execute(
-        'SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms FROM files WHERE file_path = ?',
-        [filepath],
-    )
-    row = cur.fetchone()
-    con.close()
+    with Index(db_filepath) as index:
+        row = index.lookup(filepath)
 
     # All methods below are from: https://stackoverflow.com/questions/30075978/reading-part-of-a-file-in-s3-using-boto
     # Method 1:
@@ -142,117 +211,266 @@ def download_backup_file(args, db_filepath, filepath):
     #     your_bytes = key.get_contents_as_string(headers={'Range': 'bytes=73-1024'})
     #
     # Method 3:
-    byte_start = row['byte_index']
-    byte_end = byte_start + row['file_size'] - 1
+    byte_start = row.byte_index
+    byte_end = byte_start + row.file_size - 1
     bytes_range = f'bytes={byte_start}-{byte_end}'
-    s3_path = f'{prefix}{row["bucket"]}.bitumen'
+    s3_path = f'{prefix}{row.bucket}.bitumen'
 
     # `filepath` can start with a `/`. When `os.path.join()`
     # sees this, it ignores all preceding arguments and just starts the
     # path there, which is not what we want. Therefore the `.lstrip()`.
-    with open(os.path.join(args.dir, filepath.lstrip('/')), 'wb') as f_disk:
-        response = s3_client.get_object(
-            Bucket=args.bucket, Key=s3_path, Range=bytes_range
+    disk_filepath = os.path.join(args.dir, filepath.lstrip('/'))
+    os.makedirs(os.path.dirname(disk_filepath), exist_ok=True)
+    use_cache = range_cache is not None and row.file_size and row.file_hash
+    if use_cache and range_cache.get_file(file_key(row.file_hash), disk_filepath):
+        return
+    write_filepath = disk_filepath
+    offset = 0
+    if transfers is not None and row.file_size > PART_SIZE and row.file_hash:
+        write_filepath = partial_path(disk_filepath)
+        offset = transfers.partial_offset(filepath, row.file_hash, write_filepath)
+        bytes_range = f'bytes={byte_start + offset}-{byte_end}'
+    with open(write_filepath, 'ab' if offset else 'wb') as f_disk:
+        if offset < row.file_size:
+            response = s3_client.get_object(
+                Bucket=args.bucket, Key=s3_path, Range=bytes_range
+            )
+            body = response['Body']
+            # The simplest solution can incur large memory usage for multi GiB-files:
+            #
+            #     f_disk.write(body.read())
+            #
+            # Instead we do a chunked read and write -- or, from a local
+            # directory, a `copy_file_range()` (see `storage.py`):
+            copy_to_file(body, f_disk)
+    if write_filepath != disk_filepath:
+        os.replace(write_filepath, disk_filepath)
+        transfers.remove_partial(filepath)
+    if use_cache:
+        range_cache.record_miss(row.file_size)
+        range_cache.put_file(
+            file_key(row.file_hash), disk_filepath, expected_hash=row.file_hash
         )
-        body = response['Body']
-        # The simplest solution can incur large memory usage for multi GiB-files:
-        #
-        #     f_disk.write(body.read())
-        #
-        # Instead we do a chunked read and write:
-        while True:
-            data = body.read(2**14)  # Read 16 KiB
-            if not data:
-                break
-            f_disk.write(data)
-
-
-def set_disk_file_perms(args, db_filepath, filepath):
-    # type: (None, str, str) -> None
-
-    con = sqlite3.connect(db_filepath)
-    con.row_factory = sqlite3.Row  # Allow accessing results by column name
-    cur = con.cursor()
-    cur.execute(
-        'SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms FROM files WHERE file_path = ?',
-        [filepath],
-    )
-    row = cur.fetchone()
-    con.close()
 
+
+def set_disk_file_perms(args, filepath, file_perms):
+    # type: (None, str, int) -> None
     disk_filepath = os.path.join(args.dir, filepath.lstrip('/'))
-    os.chmod(disk_filepath, row['file_perms'])
+    os.chmod(disk_filepath, file_perms)
+
+
+def _print_transfer_stats(scheduler):
+    # type: (Scheduler) -> None
+    "Print the rate achieved against the limit, and the retries if there were any"
+    for verb, limiter in [('Sent', scheduler.upload), ('Received', scheduler.download)]:
+        if not limiter.bytes:
+            continue
+        limit = f'limit {pp_file_size(limiter.rate)}/s' if limiter.rate else 'no limit'
+        rate = limiter.achieved_rate()
+        at_rate = f' at {pp_file_size(int(rate))}/s' if rate is not None else ''
+        print(f'{verb} {pp_file_size(limiter.bytes)}{at_rate} ({limit})')
+    if scheduler.retries:
+        print(scheduler.summary())
 
 
 def download(args, tempdir_path):
     "Diffs the remote and local tree and downloads files that have changed in remote"
-    s3_client = get_s3_client(args.endpoint_url)
+    s3_client = get_s3_client(args.endpoint_url, download_limit=args.download_limit)
 
     prefix = args.prefix
     if prefix and not prefix.endswith('/'):
         prefix = f'{prefix}/'
 
-    s3_db_filepath = f'{prefix}{DATABASE_FILENAME}'
-    db_filepath = os.path.join(tempdir_path, DATABASE_FILENAME)
-    with open(db_filepath, 'wb') as f_db:
-        s3_client.download_fileobj(args.bucket, s3_db_filepath, f_db)
+    # Only the shards and directories needed for `--include` are read
+    path_filter = PathFilter(args.include) if args.include else None
+    manifest = load_manifest(s3_client, args.bucket, prefix)
+    db_filepaths = sync_indexes(s3_client, args.bucket, prefix, manifest, path_filter)
+    if manifest is None and not db_filepaths:
+        print(
+            f'No bitum DB was found at "s3://{args.bucket}/{prefix}{DATABASE_FILENAME}"'
+        )
+        return
 
-    set_tree_disk, tree_disk = dirtree_from_disk(
-        args.dir,
-        return_sizes=True,  # not args.skip_sizes,
-        return_perms=True,  # not args.skip_perms,
-        return_hashes=True,  # not args.skip_hashes,
-        # exclude_pattern=args.re_exclude,
+    # An interrupted download is resumed -- the files it already wrote aren't
+    # hashed again (see `transfers.py`)
+    transfers = TransferJournal(
+        journal_path('download', args.endpoint_url, args.bucket, prefix, args.dir)
     )
-    set_tree_backup, tree_backup = dirtree_from_db(
-        db_filepath,
-        return_sizes=True,  # not args.skip_sizes,
-        return_perms=True,  # not args.skip_perms,
-        return_hashes=True,  # not args.skip_hashes,
+    tree_disk = Counted(
+        walk_sorted(
+            args.dir,
+            return_sizes=True,  # not args.skip_sizes,
+            return_perms=True,  # not args.skip_perms,
+            return_hashes=True,  # not args.skip_hashes,
+            # exclude_pattern=args.re_exclude,
+            path_filter=path_filter,
+            known_hashes=transfers.known_hashes(),
+        )
+    )
+    tree_backup = Counted(
+        iter_shard_entries(
+            db_filepaths.values(),
+            return_sizes=True,  # not args.skip_sizes,
+            return_perms=True,  # not args.skip_perms,
+            return_hashes=True,  # not args.skip_hashes,
+            path_filter=path_filter,
+        )
     )
 
-    diff = set_tree_disk.symmetric_difference(set_tree_backup)
+    # Files are downloaded while the disk is being walked. This is safe since
+    # `diff_trees()` only yields a change for a path once the walk has moved
+    # past it.
+    # A cache of a local directory would only be a second copy of it
+    use_cache = args.cache_size and not isinstance(s3_client, LocalStorage)
+    range_cache = RangeCache(args.cache_size * 2**20) if use_cache else None
+    num_changes = 0
+    with span('download files'):
+        for change in diff_trees(tree_disk, tree_backup):
+            num_changes += 1
+            path = change.file_path
+            if change.kind == REMOVED:
+                # Only on disk -- remove_disk_file()
+                continue
+            elif change.kind in (ADDED, SIZE_CHANGED, HASH_CHANGED):
+                if manifest is None:
+                    db_filepath = db_filepaths[None]
+                else:
+                    db_filepath = db_filepaths[shard_of(path, manifest['depth'])]
+                download_backup_file(
+                    args, db_filepath, path, range_cache, transfers, s3_client
+                )
+                count('files_restored')
+                count('bytes_restored', change.new.file_size or 0)
+
+            # Always change file perms
+            if change.new.file_perms is not None:
+                set_disk_file_perms(args, path, change.new.file_perms)
+            if change.new.file_hash is not None:
+                transfers.add_file(
+                    path, change.new.file_hash, os.path.join(args.dir, path.lstrip('/'))
+                )
 
-    if len(set_tree_disk) == 0 and len(set_tree_backup) == 0:
+    if tree_disk.count == 0 and tree_backup.count == 0:
         print('Both DISK and BACKUP are empty')
-        return
-    elif len(diff) == 0:
+    elif num_changes == 0:
         print('No changes! Backup is up-to-date')
-        return
     else:
-        print(f'{len(diff)} files changed.')
-
-    visited = set()
-    for dir_entry in sorted(
-        diff,
-        key=lambda e: e.file_path + '/' if e.file_type == 'D' else e.file_path,
-    ):
-        path = dir_entry.file_path
-        if path in visited:
-            continue
-        else:
-            visited.add(path)
+        print(f'{num_changes} files changed.')
+    if range_cache is not None:
+        print(range_cache.summary())
+        range_cache.close()
+    _print_transfer_stats(s3_client.scheduler)
+    transfers.clear()
+    transfers.close()
+
+
+def _confirm_create(args, s3_path):
+    # type: (argparse.Namespace, str) -> bool
+    if args.create:
+        return True
+    print(
+        f'No bitum DB was found at "s3://{args.bucket}/{s3_path}" -- do you want to continue? (Y/n) ',
+        end='',
+        flush=True,
+    )
+    return input().lower()[0] == 'y'
+
+
+def _update_index(
+    db_filepath,
+    packer,
+    changed_files,
+    removed_files,
+    builder,
+    uploader,
+    stats,
+    transfers,
+):
+    # type: (str, _BucketPacker, dict[str, DirEntry], set[str], BucketBuilder, Uploader, StageStats, TransferJournal) -> tuple[list, set[str]]
+    """Repack the buckets of changed files and add the new buckets of `packer`
+
+    The buckets are repacked in parallel with `builder` and queued for upload
+    with `uploader`. Returns the
+    changes made to the index at `db_filepath` (see `Index.changes`) and the
+    names of the buckets to upload.
+    """
+    index = Index(db_filepath, build=True, track_changes=True)
+    affected_buckets = index.buckets_of(changed_files)
+
+    repacks = []
+    for bucket in affected_buckets:
+        # Get all files in bucket
+        bucket_file_list = []
+        for row in index.bucket_rows(bucket):
+            if row.file_path in removed_files:
+                # Can't be repacked as it's no longer on disk
+                index.delete([row.file_path])
+            elif row.file_path in changed_files:
+                bucket_file_list.append(changed_files[row.file_path])
+            else:
+                bucket_file_list.append(
+                    DirEntry(
+                        file_path=row.file_path,
+                        file_type='F',
+                        file_hash=row.file_hash,
+                        file_size=row.file_size,
+                        file_perms=row.file_perms,
+                    )
+                )
 
-        if path in tree_disk and path not in tree_backup:
-            # remove_disk_file()
-            continue
-        elif path not in tree_disk and path in tree_backup:
-            download_backup_file(args, db_filepath, path)
-        elif tree_disk[path].file_size != tree_backup[path].file_size:
-            download_backup_file(args, db_filepath, path)
-        elif tree_disk[path].file_hash != tree_backup[path].file_hash:
-            download_backup_file(args, db_filepath, path)
-        elif tree_disk[path].file_perms != tree_backup[path].file_perms:
-            # Always change file perms (see below)
-            pass
+        size = sum(entry.file_size for entry in bucket_file_list)
+        transfers.name_bucket(bucket_key(bucket_file_list, bucket), bucket)
+        repacks.append(
+            (
+                bucket,
+                len(bucket_file_list),
+                builder.submit(bucket, bucket_file_list, size, stats),
+            )
+        )
 
-        # Always change file perms
-        if tree_backup[path].file_perms is not None:
-            set_disk_file_perms(args, db_filepath, path)
+    # In the order they were submitted, so the index is the same however long
+    # each bucket takes to build
+    for bucket, num_files, future in repacks:
+        db_entries, checksums = future.result()
+        index.insert(db_entries)
+        index.set_checksums(bucket, *checksums)
+        print(f'Repacked "{bucket}.bitumen": {num_files} files')
+        uploader.submit(bucket, stats)
+
+    # The new files were packed during the diff
+    packer.insert_into(index)
+    index.close()
+
+    return index.changes, affected_buckets | {b[0] for b in packer.buckets}
+
+
+def _index_state(db_filepaths):
+    # type: (dict[str | None, str]) -> str
+    "The `index_id` and `delta_seq` of each index -- changes with every commit to any of them"
+    state = {}
+    for key, db_filepath in db_filepaths.items():
+        with Index(db_filepath) as index:
+            state[key or ''] = [
+                index.get_meta('index_id'),
+                index.get_meta('delta_seq', 0),
+            ]
+    return json.dumps(state, sort_keys=True)
+
+
+def _finish_transfers(s3_client, bucket, transfers):
+    # type: (S3Client, str, TransferJournal) -> None
+    "Clear the journal of a finished upload -- aborting the multipart uploads left in it"
+    num_aborted = transfers.abort_uploads(s3_client, bucket)
+    if num_aborted:
+        print(
+            f'Aborted {num_aborted} multipart uploads of buckets that are no longer needed'
+        )
+    transfers.clear()
+    transfers.close()
 
 
 def upload(args):
-    s3_client = get_s3_client(args.endpoint_url)
+    s3_client = get_s3_client(args.endpoint_url, upload_limit=args.upload_limit)
 
     prefix = args.prefix
     if prefix and not prefix.endswith('/'):
@@ -260,140 +478,243 @@ def upload(args):
 
     s3_db_filepath = f'{prefix}{DATABASE_FILENAME}'
 
-    local_db_filepath = DATABASE_FILENAME
-    try:
-        s3_client.head_object(Bucket=args.bucket, Key=s3_db_filepath)
-    except s3_client.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            # No DB in S3 -- create an empty DB
-            if not args.create:
-                print(
-                    f'No bitum DB was found at "s3://{args.bucket}/{s3_db_filepath}" -- do you want to continue? (Y/n) ',
-                    end='',
-                    flush=True,
-                )
-                if input().lower()[0] != 'y':
-                    return
-            set_tree_backup, tree_backup = (set(), {})
-            con = sqlite3.connect(local_db_filepath)
-            con.row_factory = sqlite3.Row  # Allow accessing results by column name
-            cur = con.cursor()
-            cur.execute(
-                'CREATE TABLE IF NOT EXISTS files(bucket, file_path PRIMARY KEY, byte_index, file_size, file_hash, file_perms)'
+    # Sharded backups have a manifest (see `shards.py`)
+    manifest = load_manifest(s3_client, args.bucket, prefix)
+    is_manifest_changed = False
+    if manifest is None and args.shard_depth is not None:
+        if sync_index(s3_client, args.bucket, prefix) is not None:
+            print(
+                f'The backup at "s3://{args.bucket}/{prefix}" isn\'t sharded -- `--shard-depth` can only be given for new backups'
             )
-            con.commit()
-            con.close()
-        else:
-            raise
-    else:
-        # Use DB in S3
-        with open(local_db_filepath, 'wb') as f_db:
-            s3_client.download_fileobj(args.bucket, s3_db_filepath, f_db)
-        set_tree_backup, tree_backup = dirtree_from_db(
-            local_db_filepath,
-            return_sizes=True,  # not args.skip_sizes,
-            # Ignore changes in permissions for now
-            return_perms=False,  # not args.skip_perms,
-            return_hashes=True,  # not args.skip_hashes,
-        )
+            return
+        if not _confirm_create(args, f'{prefix}{MANIFEST_FILENAME}'):
+            return
+        manifest = new_manifest(args.shard_depth)
+        is_manifest_changed = True
+
+    cache_db_filepaths = sync_indexes(s3_client, args.bucket, prefix, manifest)
+    if manifest is None and not cache_db_filepaths:
+        # No DB in S3 -- an empty DB is created below
+        if not _confirm_create(args, s3_db_filepath):
+            return
+
+    # An interrupted upload is resumed (see `transfers.py`)
+    transfers = TransferJournal(
+        journal_path('upload', args.endpoint_url, args.bucket, prefix, args.dir)
+    )
+    num_aborted = abort_stale_uploads(s3_client, args.bucket, prefix, transfers)
+    if num_aborted:
+        print(f'Aborted {num_aborted} stale multipart uploads')
+
+    # With `bitum watch` running, only the paths that changed since the last
+    # upload are read (see `watch.py`)
+    journal = Journal.open_existing(args.dir)
+    fence = journal.fence() if journal is not None else None
+    index_state = _index_state(cache_db_filepaths)
+    path_filter = None
+    if fence is not None and journal.is_baseline(fence[0], index_state):
+        changed_paths = journal.paths(fence[1])
+        path_filter = journal_filter(changed_paths)
+        if path_filter is not None:
+            print(f'{len(changed_paths)} paths changed since the last upload')
+
+    # The cached DBs are only read -- they're replaced once the upload has
+    # gone through
+    tree_backup = iter_shard_entries(
+        cache_db_filepaths.values(),
+        return_sizes=True,  # not args.skip_sizes,
+        # Ignore changes in permissions for now
+        return_perms=False,  # not args.skip_perms,
+        return_hashes=True,  # not args.skip_hashes,
+        path_filter=path_filter,
+    )
+
+    # Walk, hash, diff, pack and upload run concurrently (see `pipeline.py`)
+    walk_stats = StageStats('walk', 'files')
+    hash_stats = StageStats('hash', 'files', workers=args.jobs)
+    pack_stats = StageStats('pack', 'buckets', workers=args.build_jobs)
+    upload_stats = StageStats('upload', 'buckets', workers=args.jobs)
+    t_begin = time.perf_counter()
 
     re_exclude = re.compile(args.exclude) if args.exclude else None
-    set_tree_disk, tree_disk = dirtree_from_disk(
+    tree_disk = walk_sorted(
         args.dir,
         return_sizes=True,  # not args.skip_sizes,
         # Ignore changes in permissions for now
         return_perms=False,  # not args.skip_perms,
-        return_hashes=True,  # not args.skip_hashes,
+        # Hashed by `hash_entries()`
+        return_hashes=False,  # not args.skip_hashes,
         exclude_pattern=re_exclude,
+        path_filter=path_filter,
+    )
+    tree_disk = hash_entries(
+        tree_disk,
+        args.dir,
+        args.jobs,
+        walk_stats,
+        hash_stats,
+        read_order=args.read_order,
+        drop_cache=args.drop_cache,
     )
 
-    diff = set_tree_disk - set_tree_backup
-
-    if len(set_tree_disk) == 0 and len(set_tree_backup) == 0:
-        print('Both DISK and BACKUP are empty')
-        return
-    elif len(diff) == 0:
-        print('No changes! Backup is up-to-date')
-        return
-
-    dir_disk = 'DISK'
-    dir_backup = 'BACKUP'
-
-    files_to_upload = set_tree_disk - set_tree_backup
-
-    prefix = args.prefix
-    if prefix and not prefix.endswith('/'):
-        prefix = f'{prefix}/'
-
-    con = sqlite3.connect(local_db_filepath)
-    con.row_factory = sqlite3.Row  # Allow accessing results by column name
-    cur = con.cursor()
-    # SQLite IN query parameters: https://stackoverflow.com/questions/1309989/parameter-substitution-for-a-sqlite-in-clause
-    # - Limit of 999 "?"
-    # - You have to make the string of "?, ?, ?, ?, ?" yourself
-    affected_buckets = set()
-    existing_files = set()
-    for files_to_upload_part in chunks(list(files_to_upload), 999):
-        questionmarks = '?,' * (len(files_to_upload_part) - 1) + '?'
-        cur.execute(
-            f'SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms FROM files WHERE file_path IN ({questionmarks})',
-            [e.file_path for e in files_to_upload_part],
+    tree_disk = Counted(tree_disk)
+    tree_backup = Counted(tree_backup)
+    buckets_to_upload = set()
+    indexes_to_commit = []
+    with ExitStack() as stack:
+        stack.enter_context(span('pipeline'))
+        uploader = stack.enter_context(
+            Uploader(
+                s3_client,
+                args.bucket,
+                prefix,
+                args.jobs,
+                upload_stats,
+                journal=transfers,
+            )
         )
-        rows_buckets = cur.fetchall()
-
-        affected_buckets |= set(row['bucket'] for row in rows_buckets)
-        existing_files |= set(row['bucket'] for row in rows_buckets)
-
-    new_files = [e for e in files_to_upload if e.file_path not in existing_files]
-
-    db_entries = []
-    for bucket in affected_buckets:
-        # Get all files in bucket
-        cur.execute(
-            'SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms FROM files WHERE bucket = ?',
-            [bucket],
+        builder = stack.enter_context(
+            BucketBuilder(
+                args.dir,
+                args.build_jobs,
+                args.build_max_inflight * 2**20,
+                CHECKSUM_BLOCK_SIZE,
+                pack_stats,
+                read_order=args.read_order,
+                drop_cache=args.drop_cache,
+                journal=transfers,
+            )
         )
-        rows = cur.fetchall()
-
-        bucket_file_list = [
-            DirEntry(
-                file_path=row['file_path'],
-                file_type='F',
-                file_hash=row['file_hash'],
-                file_size=row['file_size'],
-                file_perms=row['file_perms'],
+        # (packer, changed_files, removed_files) of each shard
+        shard_changes = defaultdict(
+            lambda: (
+                _BucketPacker(builder, uploader, pack_stats, transfers),
+                {},
+                set(),
             )
-            for row in rows
-        ]
-
-        db_entries += build_bucket(args.dir, bucket, bucket_file_list)
-
-    cur.executemany('INSERT OR REPLACE INTO files VALUES(?, ?, ?, ?, ?, ?)', db_entries)
-    con.commit()  # Remember to commit the transaction after executing INSERT.
-    con.close()
-
-    # Handle new files and insert them into the DB
-    new_buckets = _build_buckets(args.dir, new_files)
+        )
+        print('Comparing DISK against BACKUP...')
+        for change in diff_trees(tree_backup, tree_disk):
+            if manifest is None:
+                shard = None
+            else:
+                shard = shard_of(change.file_path, manifest['depth'])
+            packer, changed_files, removed_files = shard_changes[shard]
+            if change.kind == ADDED:
+                packer.add(change.new)
+            elif change.kind in (SIZE_CHANGED, HASH_CHANGED):
+                changed_files[change.file_path] = change.new
+            elif change.kind == REMOVED:
+                removed_files.add(change.file_path)
+        for packer, _, _ in shard_changes.values():
+            packer.finish()
+
+        if tree_disk.count == 0 and tree_backup.count == 0 and path_filter is None:
+            print('Both DISK and BACKUP are empty')
+            return
+        elif all(
+            packer.num_files == 0 and len(changed_files) == 0
+            for packer, changed_files, _ in shard_changes.values()
+        ):
+            print('No changes! Backup is up-to-date')
+            if fence is not None:
+                journal.consume(*fence, index_state)
+            _finish_transfers(s3_client, args.bucket, transfers)
+            return
+
+        # Only the indexes of shards with changes are updated
+        for shard, (packer, changed_files, removed_files) in sorted(
+            shard_changes.items(), key=lambda item: item[0] or ''
+        ):
+            if packer.num_files == 0 and len(changed_files) == 0:
+                continue
 
-    ################
-    # UPLOAD FILES #
-    ################
-    bucket_files_to_upload = []
-    for bucket_name in affected_buckets | set(b[0] for b in new_buckets):
-        filename = f'{bucket_name}.bitumen'
-        bucket_files_to_upload.append(filename)
+            if manifest is None:
+                index_prefix = prefix
+                local_db_filepath = DATABASE_FILENAME
+            else:
+                if shard not in manifest['shards']:
+                    manifest['shards'][shard] = shard_id(shard)
+                    is_manifest_changed = True
+                index_prefix = shard_prefix(prefix, manifest['shards'][shard])
+                local_db_filepath = f'bitumen.{manifest["shards"][shard]}.sqlite3'
+
+            if os.path.exists(local_db_filepath):
+                os.remove(local_db_filepath)
+            cache_db_filepath = cache_db_filepaths.get(shard)
+            if cache_db_filepath is None:
+                Index(local_db_filepath, build=True).close()
+            else:
+                # Work on a copy of the cached DB
+                shutil.copyfile(cache_db_filepath, local_db_filepath)
+
+            index_changes, bucket_names = _update_index(
+                local_db_filepath,
+                packer,
+                changed_files,
+                removed_files,
+                builder,
+                uploader,
+                pack_stats,
+                transfers,
+            )
+            buckets_to_upload |= bucket_names
+            indexes_to_commit.append(
+                (
+                    shard,
+                    index_prefix,
+                    local_db_filepath,
+                    # A new index is uploaded as a whole
+                    None if cache_db_filepath is None else index_changes,
+                )
+            )
+        # Leaving the `with`-block waits for the uploads to finish (the
+        # builder is done by now)
+    print_stats(
+        [walk_stats, hash_stats, pack_stats, upload_stats],
+        time.perf_counter() - t_begin,
+    )
+    _print_transfer_stats(s3_client.scheduler)
+
+    # One listing of the `.bitumen`-files in the bucket (see `inventory.py`)
+    with span('inventory'):
+        inventory = Inventory(s3_client, args.bucket, prefix)
+    indexed_buckets = index_buckets(cache_db_filepaths.values())
+    missing_buckets = indexed_buckets - buckets_to_upload - set(inventory.objects)
+    if missing_buckets:
+        print(
+            f'Warning: {len(missing_buckets)} .bitumen-files in the index are missing from the bucket: {", ".join(sorted(missing_buckets))}'
+        )
+    orphans = inventory.orphans(indexed_buckets | buckets_to_upload)
+    if orphans:
+        print(
+            f'{len(orphans)} .bitumen-files in the bucket are not in the index ({pp_file_size(sum(obj.size for obj in orphans))})'
+        )
 
-    # Always upload DB
-    bucket_files_to_upload.append(local_db_filepath)
+    # Upload the changes to the DBs (see `remote_index.py`)
+    with span('commit indexes'):
+        for shard, index_prefix, local_db_filepath, index_changes in indexes_to_commit:
+            commit_index(
+                s3_client,
+                args.bucket,
+                index_prefix,
+                local_db_filepath,
+                index_changes,
+                checkpoint=args.checkpoint,
+            )
+            # Committing replaces the cached copy
+            cache_db_filepaths[shard] = os.path.join(
+                index_cache_dir(s3_client, args.bucket, index_prefix),
+                DATABASE_FILENAME,
+            )
 
-    for filename in bucket_files_to_upload:
-        total_bytes = os.stat(filename).st_size
-        s3_path = f'{prefix}{filename}'
+    # Last, so that the manifest never lists shards that don't exist
+    if is_manifest_changed:
+        save_manifest(s3_client, args.bucket, prefix, manifest)
+    _finish_transfers(s3_client, args.bucket, transfers)
 
-        # FROM: https://stackoverflow.com/a/70263266
-        with open(filename, 'rb') as f_bitumen:
-            with TimedMessage(f'Uploading "{filename}"...'):
-                s3_client.upload_fileobj(f_bitumen, args.bucket, s3_path)
+    if fence is not None:
+        journal.consume(*fence, _index_state(cache_db_filepaths))
 
 
 def extract(args):
@@ -404,22 +725,26 @@ def extract(args):
     with TimedMessage('Building file list from backup...'):
         # set_tree_backup = set()
         # tree_backup = {}
-        con = sqlite3.connect(DATABASE_FILENAME)
-        cur = con.cursor()
-        cur.execute(
-            'SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms FROM files ORDER BY bucket ASC, byte_index ASC'
-        )
-        rows = cur.fetchall()
-        con.close()
-        for (
-            bucket_name,
-            file_path,
-            byte_index,
-            file_size,
-            file_hash,
-            file_perms,
-        ) in rows:
-            buckets[bucket_name].append((byte_index, file_path, file_size, file_perms))
+        with Index(DATABASE_FILENAME) as index:
+            if args.include:
+                # Only the buckets with matching files are read
+                for row in PathFilter(args.include).merge(index.iter_rows):
+                    buckets[row.bucket].append(
+                        (row.byte_index, row.file_path, row.file_size, row.file_perms)
+                    )
+                for files in buckets.values():
+                    files.sort()
+            else:
+                for bucket_name, _ in index.buckets():
+                    for row in index.bucket_rows(bucket_name):
+                        buckets[bucket_name].append(
+                            (
+                                row.byte_index,
+                                row.file_path,
+                                row.file_size,
+                                row.file_perms,
+                            )
+                        )
 
     with TimedMessage('Extracting buckets...'):
         print()
@@ -433,7 +758,9 @@ def extract(args):
                     files
                 ):
                     if current_seek != byte_index:
-                        breakpoint()
+                        # Skip files that aren't extracted
+                        f_bitumen.seek(byte_index)
+                        current_seek = byte_index
 
                     if i % 1000 == 0:
                         progress_str = f'{i}/{len(files)}\r'
@@ -450,9 +777,12 @@ def extract(args):
                     with open(full_path, 'wb') as f_output:
                         current_seek += file_size
                         bytes_written += f_output.write(f_bitumen.read(file_size))
+                    count('files_restored')
+                    count('bytes_restored', file_size)
 
-                    # Set file permissions
-                    os.chmod(full_path, file_perms)
+                    # Set file permissions (`upload` doesn't store them yet)
+                    if file_perms is not None:
+                        os.chmod(full_path, file_perms)
 
             print(' ' * len(progress_str) + '\r', end='', flush=True)
         print()
@@ -462,6 +792,21 @@ def entry():
     argparser = argparse.ArgumentParser(
         description='Quickly send your files to cloud storage'
     )
+    argparser.add_argument(
+        '--metrics-json',
+        help='Write the timings and counters of the command to this file (see `metrics.py`)',
+        metavar='path',
+    )
+    argparser.add_argument(
+        '--profile',
+        choices=PROFILES,
+        help='Profile the command with cProfile (cpu) or tracemalloc (memory)',
+    )
+    argparser.add_argument(
+        '--profile-output',
+        help='File to write the profile to (default "bitum.pstats" or "bitum.tracemalloc")',
+        metavar='path',
+    )
     subparsers = argparser.add_subparsers(
         title='command', dest='command', required=True
     )
@@ -481,10 +826,44 @@ def entry():
         action='store_true',
         help="Create `bitumen.sqlite3` if it doesn't exist (bypasses question)",
     )
+    upload_cmd.add_argument(
+        '--checkpoint',
+        action='store_true',
+        help='Upload the whole database instead of only the changes to it',
+    )
+    upload_cmd.add_argument(
+        '--jobs',
+        type=int,
+        default=DEFAULT_UPLOAD_JOBS,
+        help=f'Number of files to hash and buckets to upload in parallel (default {DEFAULT_UPLOAD_JOBS})',
+    )
+    upload_cmd.add_argument(
+        '--shard-depth',
+        type=int,
+        help='Split the database of a new backup into one shard per subtree this many directories deep',
+        metavar='depth',
+    )
+    upload_cmd.add_argument(
+        '--upload-limit',
+        type=parse_size,
+        help='Limit the upload to this many bytes per second, e.g. "10M" (default `upload_limit` of config.ini, or no limit)',
+        metavar='bytes',
+    )
     download_cmd = subparsers.add_parser(
         'download',
         description='Download changed files from the bucket (overwrite local files)',
     )
+    download_cmd.add_argument(
+        '--download-limit',
+        type=parse_size,
+        help='Limit the download to this many bytes per second, e.g. "10M" (default `download_limit` of config.ini, or no limit)',
+        metavar='bytes',
+    )
+    watch_cmd = subparsers.add_parser(
+        'watch',
+        description='Record changed files so that `upload` only has to read those (Linux only)',
+    )
+    watch_cmd.add_argument('dir', type=str, help='Which local directory to watch')
     for cmd in [download_cmd, upload_cmd]:
         cmd.add_argument(
             'dir',
@@ -505,6 +884,31 @@ def entry():
         action='store_true',
         help='Only list number of files in buckets. Do not build .bitumen-files.',
     )
+    for cmd in [upload_cmd, build_cmd]:
+        cmd.add_argument(
+            '--build-jobs',
+            type=int,
+            default=DEFAULT_BUILD_JOBS,
+            help=f'Number of .bitumen-files to build in parallel (default {DEFAULT_BUILD_JOBS})',
+        )
+        cmd.add_argument(
+            '--build-max-inflight',
+            type=int,
+            default=DEFAULT_BUILD_MAX_INFLIGHT // 2**20,
+            help=f'Size in MiB of the .bitumen-files being built at a time (default {DEFAULT_BUILD_MAX_INFLIGHT // 2**20})',
+            metavar='MiB',
+        )
+        cmd.add_argument(
+            '--read-order',
+            choices=READ_ORDERS,
+            default=DEFAULT_READ_ORDER,
+            help=f'Order to read files in: as walked, by inode or by physical offset on disk (default {DEFAULT_READ_ORDER})',
+        )
+        cmd.add_argument(
+            '--drop-cache',
+            action='store_true',
+            help="Drop files from the page cache once they've been read, to leave the cache of other processes alone",
+        )
     diff_local_cmd = debug_subcommands.add_parser(
         'diff-local', help=f'Diff tree in local {DATABASE_FILENAME} against local files'
     )
@@ -522,11 +926,51 @@ def entry():
     integrity_cmd.add_argument(
         'arg2', choices=['local-files', 'local-db', 'remote-db', 'remote-files']
     )
+    integrity_cmd.add_argument(
+        '--sample',
+        type=float,
+        default=100,
+        help='For "remote-files": only verify this percentage of blocks and files, picked at random',
+        metavar='percent',
+    )
+    integrity_cmd.add_argument(
+        '--jobs',
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f'For "remote-files": number of blocks and files to read in parallel (default {DEFAULT_JOBS})',
+    )
+    integrity_cmd.add_argument(
+        '--seed',
+        type=int,
+        help='For "remote-files": seed for picking the sample',
+    )
+    integrity_cmd.add_argument(
+        '--download-limit',
+        type=parse_size,
+        help='For "remote-files": limit the reads to this many bytes per second, e.g. "10M" (default `download_limit` of config.ini, or no limit)',
+        metavar='bytes',
+    )
     extract_single_file_cmd = debug_subcommands.add_parser(
         'extract-single-file',
         help='Extracts a single file from .bitumen-files in the current folder',
     )
     extract_single_file_cmd.add_argument('filepath', help='Path of the file to extract')
+    extract_single_file_cmd.add_argument(
+        '--bucket',
+        type=str,
+        help='Extract the file from the bucket instead, reading only the needed parts of the remote database',
+    )
+    extract_single_file_cmd.add_argument(
+        '--prefix',
+        type=str,
+        help='Prefix inside the bucket to extract the file from',
+        default='',
+    )
+    extract_single_file_cmd.add_argument(
+        '--endpoint-url',
+        type=str,
+        help='S3-compatible endpoint URL (e.g. Backblaze "s3.eu-central-003.backblazeb2.com"), or a local directory (e.g. "file:///mnt/nas")',
+    )
     upload_all_cmd = debug_subcommands.add_parser(
         'upload-all',
         description=f'Uploads all .bitumen-files in the current folder to the given prefix in the bucket as well as the database file ({DATABASE_FILENAME})',
@@ -538,6 +982,15 @@ def entry():
     for cmd in [upload_all_cmd, download_all_cmd]:
         pass
 
+    for cmd in [download_cmd, extract_single_file_cmd]:
+        cmd.add_argument(
+            '--cache-size',
+            type=int,
+            default=0,
+            help=f'Keep up to this many MiB of downloaded files in a cache, so restoring them again needs no download, e.g. {DEFAULT_CACHE_SIZE // 2**20} (default 0: no cache, never used for local directories)',
+            metavar='MiB',
+        )
+
     for cmd in [
         download_cmd,
         upload_cmd,
@@ -561,12 +1014,29 @@ def entry():
         cmd.add_argument(
             '--endpoint-url',
             type=str,
-            help='S3-compatible endpoint URL (e.g. Backblaze "s3.eu-central-003.backblazeb2.com")',
+            help='S3-compatible endpoint URL (e.g. Backblaze "s3.eu-central-003.backblazeb2.com"), or a local directory (e.g. "file:///mnt/nas")',
         )
 
     extract_cmd = subparsers.add_parser('extract')
     extract_cmd.add_argument('dir')
 
+    for cmd in [download_cmd, extract_cmd, download_all_cmd]:
+        cmd.add_argument(
+            '-i',
+            '--include',
+            action='append',
+            help='Only restore files matching this glob (e.g. "projects/foo/**" or "*.py") -- can be given multiple times',
+            metavar='glob',
+        )
+
+    for cmd in [diff_local_cmd, integrity_cmd]:
+        cmd.add_argument(
+            '--format',
+            choices=['text', 'ndjson', 'tsv'],
+            default='text',
+            help='Print the changes as aligned text (default), or stream them as JSON lines or tab-separated values with a summary at the end',
+        )
+
     for cmd in [build_cmd, diff_local_cmd, integrity_cmd]:
         # fmt: off
         cmd.add_argument('dir')
@@ -583,6 +1053,22 @@ def entry():
         print(f'"{args.dir}" does not exist')
         return
 
+    command = args.command
+    if command == 'debug':
+        command = f'debug {args.debug_command}'
+    try:
+        with ExitStack() as stack:
+            if args.profile:
+                stack.enter_context(profile(args.profile, args.profile_output))
+            stack.enter_context(span(command))
+            _run_command(args)
+    finally:
+        # Also when the command failed or exited
+        if args.metrics_json:
+            METRICS.write_json(args.metrics_json)
+
+
+def _run_command(args):
     if args.command == 'debug':
         if args.debug_command == 'build':
             build(args)
@@ -608,6 +1094,8 @@ def entry():
             download(args, tempdir_path)
     elif args.command == 'extract':
         extract(args)
+    elif args.command == 'watch':
+        exit(watch(args))
     else:
         print(f'Unknown command {args.command}')
         exit(1)
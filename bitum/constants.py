@@ -1,5 +1,8 @@
 CONFIG_PATH = '~/.config/bitum/config.ini'
+CACHE_PATH = '~/.cache/bitum'
 DATABASE_FILENAME = 'bitumen.sqlite3'
+# Suffix of files that are being downloaded (see `transfers.partial_path()`)
+PARTIAL_SUFFIX = '.bitum-part'
 
 BUCKETS = [
     ('256 bytes', 256, [], [0]),
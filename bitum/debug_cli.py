@@ -1,94 +1,165 @@
+from contextlib import ExitStack, contextmanager, redirect_stdout
 import os
 from pathlib import Path
 import re
-import sqlite3
+import shutil
+import sys
+import tempfile
 
 from constants import BUCKETS, DATABASE_FILENAME
+from diff import (
+    IndexTree,
+    iter_db_entries,
+    print_tree_diff,
+    print_tree_hash_diff,
+    walk_sorted,
+)
+from index import CHECKSUM_BLOCK_SIZE, Index
+from inventory import Inventory, index_buckets
+from path_filter import PathFilter
+from pipeline import BucketBuilder, StageStats
+from range_cache import RangeCache, file_key
+from remote_index import RemoteIndex, commit_index, index_size
+from shards import (
+    MANIFEST_FILENAME,
+    index_prefix_of,
+    iter_shard_entries,
+    load_manifest,
+    sync_indexes,
+)
+from storage import LocalStorage
+from tree import DirTree
 from utils import (
     TimedMessage,
-    build_bucket,
-    dirtree_from_db,
-    dirtree_from_disk,
     download_s3_file,
     get_s3_client,
     pp_file_size,
-    print_tree_diff,
     upload_s3_file,
 )
+from verify import verify_remote_files
+
+
+@contextmanager
+def _changes_output(args):
+    """Where to write the changes of a diff to
+
+    With `--format ndjson|tsv` stdout only has the changes (see
+    `diff.write_changes()`) -- progress messages go to stderr instead.
+    """
+    out = sys.stdout
+    if args.format == 'text':
+        yield out
+        return
+    with redirect_stdout(sys.stderr):
+        yield out
+
+
+def _compares_tree_hashes(args):
+    # type: (argparse.Namespace) -> bool
+    """Whether subtrees can be skipped by their tree hashes
+
+    Tree hashes are of the sizes and hashes of the files but not their
+    permissions, so only when those are exactly what's compared -- otherwise
+    the hashes of the two sides never match and nothing would be skipped.
+    """
+    return args.skip_perms and not args.skip_sizes and not args.skip_hashes
 
 
 def diff_local(args):
-    re_exclude = re.compile(args.exclude) if args.exclude else None
+    with _changes_output(args) as out:
+        re_exclude = re.compile(args.exclude) if args.exclude else None
 
-    ###################
-    # Build file list #
-    ###################
-    with TimedMessage('Building file list from disk...'):
-        set_tree_disk, tree_disk = dirtree_from_disk(
+        tree_disk = walk_sorted(
             args.dir,
             return_sizes=not args.skip_sizes,
             return_perms=not args.skip_perms,
             return_hashes=not args.skip_hashes,
             exclude_pattern=re_exclude,
         )
-
-    with TimedMessage('Building file list from DB...'):
-        set_tree_backup, tree_backup = dirtree_from_db(
+        # The disk is walked and hashed in full either way, so tree hashes
+        # wouldn't skip anything -- the two sides are merge-joined as they're
+        # read
+        tree_backup = iter_db_entries(
             DATABASE_FILENAME,
             return_sizes=not args.skip_sizes,
             return_perms=not args.skip_perms,
             return_hashes=not args.skip_hashes,
         )
 
-    print_tree_diff(args, set_tree_disk, tree_disk, set_tree_backup, tree_backup)
+        print_tree_diff(args, tree_disk, tree_backup, out=out)
+
+
+def _remote_db_filepaths(args):
+    # type: (argparse.Namespace) -> dict[str | None, str]
+    "The cached index of each shard of the backup (see `shards.sync_indexes()`)"
+    s3_client = get_s3_client(args.endpoint_url)
+
+    prefix = args.prefix
+    if prefix and not prefix.endswith('/'):
+        prefix = f'{prefix}/'
+
+    # Doesn't touch the local DB, which might be the other side of the diff
+    manifest = load_manifest(s3_client, args.bucket, prefix)
+    db_filepaths = sync_indexes(s3_client, args.bucket, prefix, manifest)
+    if manifest is None and not db_filepaths:
+        raise ValueError(
+            f'No bitum DB was found at "s3://{args.bucket}/{prefix}{DATABASE_FILENAME}"'
+        )
+    return db_filepaths
 
 
-def _tree_from_arg(arg, args):
+def _tree_from_arg(arg, args, tempdir_path):
+    "Returns a stream of `DirEntry` sorted by `file_path` (see `diff.py`)"
     if arg == 'local-files':
         re_exclude = re.compile(args.exclude) if args.exclude else None
 
-        with TimedMessage('Building file list from disk...'):
-            set_tree, tree = dirtree_from_disk(
-                args.dir,
-                return_sizes=not args.skip_sizes,
-                return_perms=not args.skip_perms,
-                return_hashes=not args.skip_hashes,
-                exclude_pattern=re_exclude,
-            )
+        tree = walk_sorted(
+            args.dir,
+            return_sizes=not args.skip_sizes,
+            return_perms=not args.skip_perms,
+            return_hashes=not args.skip_hashes,
+            exclude_pattern=re_exclude,
+        )
     elif arg == 'local-db':
-        with TimedMessage('Building file list from local DB...'):
-            set_tree, tree = dirtree_from_db(
-                DATABASE_FILENAME,
-                return_sizes=not args.skip_sizes,
-                return_perms=not args.skip_perms,
-                return_hashes=not args.skip_hashes,
-            )
+        tree = iter_db_entries(
+            DATABASE_FILENAME,
+            return_sizes=not args.skip_sizes,
+            return_perms=not args.skip_perms,
+            return_hashes=not args.skip_hashes,
+        )
     elif arg == 'remote-db':
-        s3_client = get_s3_client(args.endpoint_url)
-
-        prefix = args.prefix
-        if prefix and not prefix.endswith('/'):
-            prefix = f'{prefix}/'
-
-        s3_path = f'{prefix}{DATABASE_FILENAME}'
-
-        db_filepath = DATABASE_FILENAME
-        with open(db_filepath, 'wb') as f_db:
-            s3_client.download_fileobj(
-                args.bucket, s3_path, f_db
-            )  # , Callback=pbar.update
-
-        with TimedMessage('Building file list from remote DB...'):
-            set_tree, tree = dirtree_from_db(
-                db_filepath,
-                return_sizes=not args.skip_sizes,
-                return_perms=not args.skip_perms,
-                return_hashes=not args.skip_hashes,
-            )
+        tree = iter_shard_entries(
+            _remote_db_filepaths(args).values(),
+            return_sizes=not args.skip_sizes,
+            return_perms=not args.skip_perms,
+            return_hashes=not args.skip_hashes,
+        )
     elif arg == 'remote-files':
         raise ValueError('Integrity for `remote-files` not currently supported')
 
-    return set_tree, tree
+    return tree
+
+
+def _hash_tree_from_arg(arg, args, stack):
+    """Returns the tree of `arg` for `diff_tree_hashes()` (see `diff.py`)
+
+    Indexes are opened on `stack`. Returns `None` when comparing tree hashes
+    doesn't skip anything for `arg`: for `local-files`, which are walked and
+    hashed in full anyway, and for `remote-files` and sharded backups (each
+    shard only has the tree hashes of its own subtree).
+    """
+    kwargs = {
+        'return_sizes': not args.skip_sizes,
+        'return_hashes': not args.skip_hashes,
+    }
+    if arg == 'local-db':
+        return IndexTree(stack.enter_context(Index(DATABASE_FILENAME)), **kwargs)
+    elif arg == 'remote-db':
+        db_filepaths = _remote_db_filepaths(args)
+        if list(db_filepaths) != [None]:
+            return None
+        return IndexTree(stack.enter_context(Index(db_filepaths[None])), **kwargs)
+    return None
 
 
 def build(args):
@@ -98,7 +169,7 @@ def build(args):
     # Build file list #
     ###################
     with TimedMessage('Building file list...'):
-        set_tree1, tree1 = dirtree_from_disk(
+        tree = DirTree.from_disk(
             args.dir,
             return_sizes=not args.skip_sizes,
             return_perms=not args.skip_perms,
@@ -107,8 +178,8 @@ def build(args):
         )
 
     with TimedMessage('Building buckets...'):
-        # for (file_path, file_type, file_hash, file_size, file_perms) in set_tree1:
-        for file_props in set_tree1:
+        # for (file_path, file_type, file_hash, file_size, file_perms) in tree:
+        for file_props in tree:
             if file_props.file_size is None:
                 continue
             for _, bucket_max_size, bucket_file_list, bucket_size in BUCKETS:
@@ -134,32 +205,99 @@ def build(args):
     #######################
     # Build bitumen files #
     #######################
-    db_entries = []
+    # The buckets are built in parallel (see `pipeline.py`) and collected in
+    # order
+    built = []
     with TimedMessage('Building bitumen files...'):
-        print()
-        for bucket_name, bucket_max_size, bucket_file_list, bucket_size in BUCKETS:
-            db_entries += build_bucket(args.dir, bucket_name, bucket_file_list)
-        print()
+        with BucketBuilder(
+            args.dir,
+            args.build_jobs,
+            args.build_max_inflight * 2**20,
+            CHECKSUM_BLOCK_SIZE,
+            StageStats('build', 'buckets', workers=args.build_jobs),
+            read_order=args.read_order,
+            drop_cache=args.drop_cache,
+        ) as builder:
+            futures = [
+                (
+                    bucket_name,
+                    builder.submit(
+                        bucket_name, bucket_file_list, bucket_size[0], builder.stats
+                    ),
+                )
+                for bucket_name, _, bucket_file_list, bucket_size in BUCKETS
+                if bucket_file_list
+            ]
+            for bucket_name, future in futures:
+                built.append((bucket_name, *future.result()))
 
     with TimedMessage('Building bitumen database...'):
-        con = sqlite3.connect(DATABASE_FILENAME)
-        cur = con.cursor()
-        cur.execute('DROP TABLE IF EXISTS files')
-        cur.execute(
-            'CREATE TABLE files(bucket, file_path PRIMARY KEY, byte_index, file_size, file_hash, file_perms)'
+        if os.path.exists(DATABASE_FILENAME):
+            os.remove(DATABASE_FILENAME)
+        with Index(DATABASE_FILENAME, build=True) as index:
+            for bucket_name, db_entries, checksums in built:
+                index.insert(db_entries)
+                index.set_checksums(bucket_name, *checksums)
+
+
+def verify_remote(args, arg):
+    "Verify the remote files against the index of `arg` (see `verify.py`)"
+    if arg == 'local-db':
+        db_filepaths = [DATABASE_FILENAME]
+    elif arg == 'remote-db':
+        db_filepaths = _remote_db_filepaths(args).values()
+    else:
+        raise ValueError(
+            '`remote-files` can only be checked against `local-db` or `remote-db`'
         )
-        cur.executemany('INSERT INTO files VALUES(?, ?, ?, ?, ?, ?)', db_entries)
-        con.commit()  # Remember to commit the transaction after executing INSERT.
-        con.close()
+
+    prefix = args.prefix
+    if prefix and not prefix.endswith('/'):
+        prefix = f'{prefix}/'
+
+    failures = verify_remote_files(
+        get_s3_client(args.endpoint_url, download_limit=args.download_limit),
+        args.bucket,
+        prefix,
+        db_filepaths,
+        sample=args.sample,
+        jobs=args.jobs,
+        seed=args.seed,
+    )
+    for failure in failures:
+        if failure.name is None:
+            print(f'{failure.bucket}.bitumen: {failure.message}')
+        else:
+            print(f'{failure.bucket}.bitumen ({failure.name}): {failure.message}')
+    if failures:
+        print(f'{len(failures)} problems found')
+    else:
+        print('No problems found')
 
 
 def integrity(args):
     'Check integrity between any of "local-files", "local-db", "remote-db", "remote-files"'
+    if args.arg1 == 'remote-files':
+        return verify_remote(args, args.arg2)
+    elif args.arg2 == 'remote-files':
+        return verify_remote(args, args.arg1)
+
+    with _changes_output(args) as out:
+        if _compares_tree_hashes(args):
+            with ExitStack() as stack:
+                tree1 = _hash_tree_from_arg(args.arg1, args, stack)
+                tree2 = None
+                if tree1 is not None:
+                    tree2 = _hash_tree_from_arg(args.arg2, args, stack)
+                if tree2 is not None:
+                    print_tree_hash_diff(args, tree1, tree2, out=out)
+                    return
 
-    set_tree_arg1, tree_arg1 = _tree_from_arg(args.arg1, args)
-    set_tree_arg2, tree_arg2 = _tree_from_arg(args.arg2, args)
+        with tempfile.TemporaryDirectory() as tempdir_path:
+            tree_arg1 = _tree_from_arg(args.arg1, args, tempdir_path)
+            tree_arg2 = _tree_from_arg(args.arg2, args, tempdir_path)
 
-    print_tree_diff(args, set_tree_arg1, tree_arg1, set_tree_arg2, tree_arg2)
+            print_tree_diff(args, tree_arg1, tree_arg2, out=out)
 
 
 def upload_all(args):
@@ -169,19 +307,26 @@ def upload_all(args):
     if prefix and not prefix.endswith('/'):
         prefix = f'{prefix}/'
 
+    if load_manifest(s3_client, args.bucket, prefix) is not None:
+        print(
+            f'The backup at "s3://{args.bucket}/{prefix}" is sharded ({MANIFEST_FILENAME}) -- uploading a single DB is not supported'
+        )
+        return
+
     files = []
     for bucket_name, _, _, _ in BUCKETS:
         filename = f'{bucket_name}.bitumen'
         files.append(filename)
 
-    # Always download DB
-    files.append(DATABASE_FILENAME)
-
     for filename in files:
         s3_path = f'{prefix}{filename}'
 
         upload_s3_file(s3_client, args.bucket, s3_path, filename)
 
+    # Always upload DB -- as a new index, since it might not be based on
+    # the one in the bucket
+    commit_index(s3_client, args.bucket, prefix, DATABASE_FILENAME, None)
+
 
 def download_all(args):
     s3_client = get_s3_client(args.endpoint_url)
@@ -190,18 +335,50 @@ def download_all(args):
     if prefix and not prefix.endswith('/'):
         prefix = f'{prefix}/'
 
-    files = []
-    for bucket_name, _, _, _ in BUCKETS:
+    path_filter = PathFilter(args.include) if args.include else None
+    manifest = load_manifest(s3_client, args.bucket, prefix)
+    db_filepaths = sync_indexes(s3_client, args.bucket, prefix, manifest, path_filter)
+
+    if path_filter is None:
+        bucket_names = index_buckets(db_filepaths.values())
+    else:
+        # Only the buckets holding matching files
+        rows = []
+        for db_filepath in db_filepaths.values():
+            with Index(db_filepath) as index:
+                rows += path_filter.merge(index.iter_rows)
+        bucket_names = {row.bucket for row in rows}
+
+    # Sizes from a single listing rather than a `HEAD` per file
+    inventory = Inventory(s3_client, args.bucket, prefix)
+    for bucket_name in sorted(bucket_names):
         filename = f'{bucket_name}.bitumen'
-        files.append(filename)
-
-    # Always download DB
-    files.append(DATABASE_FILENAME)
-
-    for filename in files:
-        s3_path = f'{prefix}{filename}'
+        if bucket_name not in inventory:
+            print(f'"{filename}" not found in bucket')
+            continue
+        download_s3_file(
+            s3_client,
+            args.bucket,
+            f'{prefix}{filename}',
+            filename,
+            total_bytes=inventory.size(bucket_name),
+        )
 
-        download_s3_file(s3_client, args.bucket, s3_path, filename)
+    # Always download DB -- the shards of a sharded backup are combined into
+    # a single DB, and with `--include` it only has the matching files
+    if manifest is None and path_filter is None:
+        if db_filepaths:
+            shutil.copyfile(db_filepaths[None], DATABASE_FILENAME)
+    else:
+        if os.path.exists(DATABASE_FILENAME):
+            os.remove(DATABASE_FILENAME)
+        with Index(DATABASE_FILENAME, build=True) as index:
+            if path_filter is not None:
+                index.insert(rows)
+            else:
+                for db_filepath in db_filepaths.values():
+                    with Index(db_filepath) as shard_index:
+                        index.insert(shard_index.iter_rows())
 
 
 def check_sizes(args):
@@ -211,23 +388,33 @@ def check_sizes(args):
     if prefix and not prefix.endswith('/'):
         prefix = f'{prefix}/'
 
-    files = []
-    for bucket_name, _, _, _ in BUCKETS:
-        filename = f'{bucket_name}.bitumen'
-        files.append(filename)
-
-    # Always download
-    files.append(DATABASE_FILENAME)
-
-    for filename in files:
-        s3_path = f'{prefix}{filename}'
+    # A single listing rather than a `HEAD` per file (see `inventory.py`)
+    inventory = Inventory(s3_client, args.bucket, prefix)
+    has_db = os.path.exists(DATABASE_FILENAME)
+    if has_db:
+        bucket_names = index_buckets([DATABASE_FILENAME])
+    else:
+        bucket_names = [bucket_name for bucket_name, _, _, _ in BUCKETS]
+
+    sizes = []
+    for bucket_name in sorted(bucket_names):
+        sizes.append((f'{bucket_name}.bitumen', inventory.size(bucket_name)))
+
+    # Always check the DB -- it's stored compressed, so its size is in the
+    # metadata of the object
+    try:
+        meta_data = s3_client.head_object(
+            Bucket=args.bucket, Key=f'{prefix}{DATABASE_FILENAME}'
+        )
+    except:
+        sizes.append((DATABASE_FILENAME, None))
+    else:
+        sizes.append((DATABASE_FILENAME, index_size(meta_data)))
 
-        try:
-            meta_data = s3_client.head_object(Bucket=args.bucket, Key=s3_path)
-        except:
+    for filename, remote_filesize in sizes:
+        if remote_filesize is None:
             print(f'"{filename}" not found in bucket')
             continue
-        remote_filesize = int(meta_data.get('ContentLength'))
 
         stat = os.stat(os.getcwd() + '/' + filename)
         local_filesize = stat.st_size
@@ -237,30 +424,23 @@ def check_sizes(args):
                 f'{filename} {local_filesize} bytes != {filename} {remote_filesize} bytes'
             )
 
+    if has_db:
+        for obj in inventory.orphans(bucket_names):
+            print(
+                f'"{obj.key}" is not in {DATABASE_FILENAME} (orphaned, {pp_file_size(obj.size)})'
+            )
+
 
 def extract_single_file(args):
     # Ensure `/` at beginning of string
     filepath = '/' + args.filepath.lstrip('/')
 
-    con = sqlite3.connect(DATABASE_FILENAME)
-    cur = con.cursor()
-    cur.execute(
-        """
-        SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms
-        FROM files
-        WHERE file_path = ?
-    """,
-        [filepath],
-    )
-    (
-        bucket_name,
-        file_path,
-        byte_index,
-        file_size,
-        file_hash,
-        file_perms,
-    ) = cur.fetchone()
-    con.close()
+    if args.bucket:
+        return extract_single_remote_file(args, filepath)
+
+    with Index(DATABASE_FILENAME) as index:
+        row = index.lookup(filepath)
+    bucket_name, file_path, byte_index, file_size, file_hash, file_perms = row
 
     print(
         f'Extracting "{args.filepath}" from {bucket_name}.bitumen at byte index {byte_index}'
@@ -280,4 +460,63 @@ def extract_single_file(args):
     assert bytes_written == file_size
 
 
-print()
+def extract_single_remote_file(args, filepath):
+    "Extracts a single file from the bucket without downloading the index"
+    s3_client = get_s3_client(args.endpoint_url)
+
+    prefix = args.prefix
+    if prefix and not prefix.endswith('/'):
+        prefix = f'{prefix}/'
+
+    with TimedMessage(f'Looking up "{filepath}" in remote index...'):
+        index_prefix = index_prefix_of(
+            load_manifest(s3_client, args.bucket, prefix), prefix, filepath
+        )
+        if index_prefix is None:
+            row = None
+        else:
+            with RemoteIndex(s3_client, args.bucket, index_prefix) as index:
+                row = index.lookup(filepath)
+    if row is None:
+        print(f'"{filepath}" is not in the backup')
+        return
+    print(
+        f'Made {index.file.num_requests} requests to the index, fetching '
+        f'{pp_file_size(index.file.num_bytes)} of {pp_file_size(index.file.size)}'
+    )
+
+    print(
+        f'Extracting "{args.filepath}" from {row.bucket}.bitumen at byte index {row.byte_index}'
+    )
+    filename = Path(args.filepath).name
+    use_cache = (
+        args.cache_size
+        and row.file_size > 0
+        and row.file_hash
+        and not isinstance(s3_client, LocalStorage)
+    )
+    if use_cache:
+        range_cache = RangeCache(args.cache_size * 2**20)
+        if range_cache.get_file(file_key(row.file_hash), filename):
+            print(range_cache.summary())
+            range_cache.close()
+            return
+    with open(filename, 'wb') as f_output:
+        if row.file_size > 0:
+            response = s3_client.get_object(
+                Bucket=args.bucket,
+                Key=f'{prefix}{row.bucket}.bitumen',
+                Range=f'bytes={row.byte_index}-{row.byte_index + row.file_size - 1}',
+            )
+            bytes_written = f_output.write(response['Body'].read())
+        else:
+            bytes_written = 0
+
+    assert bytes_written == row.file_size
+    if use_cache:
+        range_cache.record_miss(row.file_size)
+        range_cache.put_file(
+            file_key(row.file_hash), filename, expected_hash=row.file_hash
+        )
+        print(range_cache.summary())
+        range_cache.close()
@@ -0,0 +1,473 @@
+from collections import namedtuple
+import heapq
+import json
+import os
+import shutil
+import sys
+
+from constants import PARTIAL_SUFFIX
+from index import Index, sort_key
+from utils import (
+    DirEntry,
+    TimedMessage,
+    file_hash,
+    pp_file_perms,
+    pp_file_size,
+    print_file_diff,
+)
+
+"""
+Diffing trees
+-------------
+
+Both sides of a diff are streams of `DirEntry` in index order, i.e. sorted by
+`(dirname, name)` (see `index.sort_key()`): the disk is walked in that order
+by `walk_sorted()` and the index is read in that order by `iter_db_entries()`.
+`diff_trees()` merge-joins the two streams and yields a `Change` for each path
+that differs, so memory use is constant in the size of the trees.
+
+When permissions aren't compared, `diff_tree_hashes()` can instead compare
+the tree hashes of directories (see `index.py`) and skip every subtree whose
+hash is the same on both sides. Comparing two indexes then only reads the
+directories on the paths to the changes, rather than every entry. The disk
+has no stored tree hashes -- it's walked and hashed in full either way -- so
+it's always compared with `diff_trees()`.
+
+Output
+------
+
+By default changes are printed as aligned columns, which needs all of them
+in memory to size the columns. With `--format ndjson` or `--format tsv`
+(`write_changes()`) each change is written as soon as it's found, followed
+by a summary with the number of changes and bytes of each kind:
+
+    {"type": "change", "kind": "added", "path": "/a", "old": null, "new": {"size": 3, "hash": "...", "perms": null}}
+    {"type": "summary", "counts": {"added": 1, ...}, "bytes": {"added": 3, ...}}
+
+TSV has a header row with the columns `TSV_COLUMNS`. Missing values are
+empty, and tabs, newlines and backslashes in paths are escaped like in C. The
+summary is a comment line per kind: `# <kind> <count> <bytes>` (separated by
+tabs).
+"""
+
+ADDED = 'added'
+REMOVED = 'removed'
+SIZE_CHANGED = 'size_changed'
+HASH_CHANGED = 'hash_changed'
+PERMS_CHANGED = 'perms_changed'
+
+KINDS = [ADDED, REMOVED, SIZE_CHANGED, HASH_CHANGED, PERMS_CHANGED]
+
+# `old` is `None` for `ADDED` and `new` is `None` for `REMOVED`
+Change = namedtuple('Change', ['kind', 'file_path', 'old', 'new'])
+
+TSV_COLUMNS = [
+    'kind',
+    'path',
+    'old_size',
+    'new_size',
+    'old_hash',
+    'new_hash',
+    'old_perms',
+    'new_perms',
+]
+
+
+class Counted:
+    "Wraps an iterable and counts the number of items that have been iterated"
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.count = 0
+
+    def __iter__(self):
+        for item in self.iterable:
+            self.count += 1
+            yield item
+
+
+def walk_sorted(
+    base_path,
+    return_hashes=False,
+    return_sizes=False,
+    return_perms=False,
+    exclude_pattern=None,
+    path_filter=None,
+    known_hashes=None,
+):
+    # type: (str, bool, bool, bool, re.Pattern | None, PathFilter | None, dict[str, tuple[int, int, str]] | None) -> Iterator[DirEntry]
+    """Yield a `DirEntry` for each file under `base_path` in index order
+
+    Like `dirtree_from_disk()` directories aren't included, excluded paths and
+    broken symlinks are skipped and symlinks to directories aren't followed.
+
+    With `path_filter` only the directories it needs are walked, and only
+    the matching files are yielded.
+
+    `known_hashes` maps paths to `(file_size, mtime_ns, file_hash)` -- a file
+    that still has that size and modification time isn't hashed again.
+    """
+    kwargs = {
+        'return_hashes': return_hashes,
+        'return_sizes': return_sizes,
+        'return_perms': return_perms,
+        'exclude_pattern': exclude_pattern,
+        'known_hashes': known_hashes or {},
+    }
+    if path_filter is None:
+        return _walk_dir_sorted(base_path, '', True, **kwargs)
+    return path_filter.merge(
+        lambda rel_dirpath, recursive: _walk_dir_sorted(
+            base_path, rel_dirpath, recursive, **kwargs
+        )
+    )
+
+
+def _walk_dir_sorted(
+    base_path,
+    rel_dirpath,
+    recursive,
+    return_hashes,
+    return_sizes,
+    return_perms,
+    exclude_pattern,
+    known_hashes,
+):
+    # type: (str, str, bool, bool, bool, bool, re.Pattern | None, dict[str, tuple[int, int, str]]) -> Iterator[DirEntry]
+    """`walk_sorted()` of the directory `rel_dirpath` under `base_path`
+
+    Directories are visited in order of their path by keeping the directories
+    that are yet to be listed in a heap -- `/a-b` is listed before `/a/b`
+    since `-` sorts before `/`.
+    """
+    # Relative paths of directories to list
+    heap = [rel_dirpath]
+    while heap:
+        rel_dirpath = heapq.heappop(heap)
+        dirpath = base_path + rel_dirpath
+
+        filenames = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if not entry.is_dir():
+                        # Partial downloads aren't part of the tree until
+                        # they're complete
+                        if not entry.name.endswith(PARTIAL_SUFFIX):
+                            filenames.append(entry.name)
+                    elif recursive and not entry.is_symlink():
+                        # Like `os.walk()` symlinks to directories aren't followed
+                        heapq.heappush(heap, f'{rel_dirpath}/{entry.name}')
+        except OSError:
+            # Like `os.walk()` ignore directories that can't be listed
+            continue
+        filenames.sort()
+
+        for name in filenames:
+            rel_path = f'{rel_dirpath}/{name}'
+            if exclude_pattern and exclude_pattern.match(rel_path):
+                continue
+
+            abs_path = dirpath + '/' + name
+            try:
+                stat = os.stat(abs_path)
+            except FileNotFoundError:
+                # When symlink points to a directory or file that does not exist
+                continue
+            except OSError as err:
+                if err.errno == 62:
+                    # Too many levels of symlinking
+                    continue
+                else:
+                    raise
+
+            entry_hash = None
+            if return_hashes:
+                known = known_hashes.get(rel_path)
+                if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+                    entry_hash = known[2]
+                else:
+                    entry_hash = file_hash(abs_path)
+            yield DirEntry(
+                file_path=rel_path,
+                file_type='F',
+                file_hash=entry_hash,
+                file_size=stat.st_size if return_sizes else None,
+                file_perms=stat.st_mode if return_perms else None,
+            )
+
+
+def iter_db_entries(
+    db_filepath,
+    return_hashes=False,
+    return_sizes=False,
+    return_perms=False,
+    path_filter=None,
+):
+    # type: (str, bool, bool, bool, PathFilter | None) -> Iterator[DirEntry]
+    """Yield a `DirEntry` for each file in the index in index order
+
+    With `path_filter` only the matching files are yielded, and only the
+    directories it needs are read from the index.
+    """
+    with Index(db_filepath) as index:
+        if path_filter is None:
+            rows = index.iter_rows()
+        else:
+            rows = path_filter.merge(index.iter_rows)
+        for row in rows:
+            yield DirEntry(
+                file_path=row.file_path,
+                file_type='F',
+                file_hash=row.file_hash if return_hashes else None,
+                file_size=row.file_size if return_sizes else None,
+                file_perms=row.file_perms if return_perms else None,
+            )
+
+
+def _with_sort_keys(entries):
+    # type: (Iterable[DirEntry]) -> Iterator[tuple[tuple[str, str], DirEntry]]
+    last_key = None
+    for entry in entries:
+        key = sort_key(entry.file_path)
+        if last_key is not None and key <= last_key:
+            raise ValueError(f'Entries not in index order at "{entry.file_path}"')
+        last_key = key
+        yield key, entry
+
+
+def diff_trees(old, new):
+    # type: (Iterable[DirEntry], Iterable[DirEntry]) -> Iterator[Change]
+    """Merge-join two streams of `DirEntry` in index order
+
+    Yields a `Change` for each path that is only in `new` (`ADDED`), only in
+    `old` (`REMOVED`) or in both but with a different size, hash or
+    permissions (checked in that order).
+    """
+    old = _with_sort_keys(old)
+    new = _with_sort_keys(new)
+    key_old, entry_old = next(old, (None, None))
+    key_new, entry_new = next(new, (None, None))
+    while entry_old is not None or entry_new is not None:
+        if entry_new is None or (entry_old is not None and key_old < key_new):
+            yield Change(REMOVED, entry_old.file_path, entry_old, None)
+            key_old, entry_old = next(old, (None, None))
+        elif entry_old is None or key_new < key_old:
+            yield Change(ADDED, entry_new.file_path, None, entry_new)
+            key_new, entry_new = next(new, (None, None))
+        else:
+            if entry_old.file_size != entry_new.file_size:
+                yield Change(SIZE_CHANGED, entry_new.file_path, entry_old, entry_new)
+            elif entry_old.file_hash != entry_new.file_hash:
+                yield Change(HASH_CHANGED, entry_new.file_path, entry_old, entry_new)
+            elif entry_old.file_perms != entry_new.file_perms:
+                yield Change(PERMS_CHANGED, entry_new.file_path, entry_old, entry_new)
+            key_old, entry_old = next(old, (None, None))
+            key_new, entry_new = next(new, (None, None))
+
+
+class IndexTree:
+    "The directories of an index for `diff_tree_hashes()`"
+
+    def __init__(self, index, return_hashes=False, return_sizes=False):
+        # type: (Index, bool, bool) -> None
+        self.index = index
+        self.return_hashes = return_hashes
+        self.return_sizes = return_sizes
+
+    def tree_hash(self, dir_path):
+        # type: (str) -> bytes | None
+        return self.index.tree_hash(dir_path)
+
+    def child_dirs(self, dir_path):
+        # type: (str) -> list[str]
+        return self.index.child_dirs(dir_path)
+
+    def files(self, dir_path):
+        # type: (str) -> Iterator[DirEntry]
+        for row in self.index.iter_rows(dir_path, recursive=False):
+            yield DirEntry(
+                file_path=row.file_path,
+                file_type='F',
+                file_hash=row.file_hash if self.return_hashes else None,
+                file_size=row.file_size if self.return_sizes else None,
+                file_perms=None,
+            )
+
+
+def diff_tree_hashes(old, new, dir_path=''):
+    # type: (IndexTree, IndexTree, str) -> Iterator[Change]
+    """Like `diff_trees()` but skips the subtrees with the same tree hash
+
+    Permissions aren't part of tree hashes, so changes in permissions aren't
+    found. The changes are yielded a directory at a time, depth first --
+    which isn't index order (`/a/b` comes before `/a-b`).
+    """
+    old_hash = old.tree_hash(dir_path)
+    if old_hash is not None and old_hash == new.tree_hash(dir_path):
+        return
+    yield from diff_trees(old.files(dir_path), new.files(dir_path))
+    for child in sorted(set(old.child_dirs(dir_path)) | set(new.child_dirs(dir_path))):
+        yield from diff_tree_hashes(old, new, child)
+
+
+def _tsv_field(value):
+    # type: (object) -> str
+    if value is None:
+        return ''
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def _entry_props(entry):
+    # type: (DirEntry | None) -> dict | None
+    if entry is None:
+        return None
+    return {
+        'size': entry.file_size,
+        'hash': entry.file_hash,
+        'perms': entry.file_perms,
+    }
+
+
+def write_changes(changes, fmt, out=None):
+    # type: (Iterable[Change], str, TextIO | None) -> None
+    """Write `changes` as they come as `ndjson` or `tsv` (see above)
+
+    Only the counts are kept, so memory use is constant.
+    """
+    out = out or sys.stdout
+    counts = dict.fromkeys(KINDS, 0)
+    num_bytes = dict.fromkeys(KINDS, 0)
+    if fmt == 'tsv':
+        out.write('\t'.join(TSV_COLUMNS) + '\n')
+    for change in changes:
+        counts[change.kind] += 1
+        # The bytes that differ: the file on the side that has it, or the
+        # new version of a changed file
+        entry = change.new if change.new is not None else change.old
+        num_bytes[change.kind] += entry.file_size or 0
+
+        if fmt == 'ndjson':
+            record = {
+                'type': 'change',
+                'kind': change.kind,
+                'path': change.file_path,
+                'old': _entry_props(change.old),
+                'new': _entry_props(change.new),
+            }
+            out.write(json.dumps(record) + '\n')
+        else:
+            old = change.old or DirEntry(None, None, None, None, None)
+            new = change.new or DirEntry(None, None, None, None, None)
+            fields = [
+                change.kind,
+                change.file_path,
+                old.file_size,
+                new.file_size,
+                old.file_hash,
+                new.file_hash,
+                old.file_perms,
+                new.file_perms,
+            ]
+            out.write('\t'.join(_tsv_field(field) for field in fields) + '\n')
+
+    if fmt == 'ndjson':
+        record = {'type': 'summary', 'counts': counts, 'bytes': num_bytes}
+        out.write(json.dumps(record) + '\n')
+    else:
+        for kind in KINDS:
+            out.write(f'# {kind}\t{counts[kind]}\t{num_bytes[kind]}\n')
+    out.flush()
+
+
+def print_tree_diff(args, tree1, tree2, out=None):
+    # type: (None, Iterable[DirEntry], Iterable[DirEntry], TextIO | None) -> None
+    """Print the differences between `tree1` (DISK) and `tree2` (BACKUP)
+
+    With `args.format` `ndjson` or `tsv` the changes are written to `out`
+    as they're found (see `write_changes()`).
+    """
+    if args.format != 'text':
+        write_changes(diff_trees(tree2, tree1), args.format, out)
+        return
+
+    tree1 = Counted(tree1)
+    tree2 = Counted(tree2)
+    with TimedMessage('Comparing trees...'):
+        changes = list(diff_trees(tree2, tree1))
+
+    if tree1.count == 0 and tree2.count == 0:
+        print('Both DISK and BACKUP are empty')
+        return
+    print_changes(args, changes)
+
+
+def print_tree_hash_diff(args, tree1, tree2, out=None):
+    # type: (None, IndexTree, IndexTree, TextIO | None) -> None
+    """`print_tree_diff()` with `diff_tree_hashes()`
+
+    With `ndjson` and `tsv` the changes aren't sorted, i.e. they are in the
+    order `diff_tree_hashes()` finds them in.
+    """
+    if args.format != 'text':
+        write_changes(diff_tree_hashes(tree2, tree1), args.format, out)
+        return
+
+    with TimedMessage('Comparing tree hashes...'):
+        changes = sorted(
+            diff_tree_hashes(tree2, tree1), key=lambda c: sort_key(c.file_path)
+        )
+
+    if tree1.tree_hash('') is None and tree2.tree_hash('') is None:
+        print('Both DISK and BACKUP are empty')
+        return
+    print_changes(args, changes)
+
+
+def print_changes(args, changes):
+    # type: (None, list[Change]) -> None
+    "Print `changes` of `diff_trees(BACKUP, DISK)`"
+    if len(changes) == 0:
+        print('No changes! Backup is up-to-date')
+        return
+
+    dir1 = 'DISK'
+    dir2 = 'BACKUP'
+
+    max_path_length = max(len(c.file_path) for c in changes)
+    if not args.skip_perms:
+        # Include permissions in width
+        max_path_length += len(' (xxxxxxxxx)')
+    if not args.skip_hashes:
+        # Include hash in width
+        max_path_length += len(' (xxxxxx)')
+    width = max(max_path_length, len(dir1))
+    # Don't go beyond half the width of the terminal
+    width = min(width, shutil.get_terminal_size().columns // 2)
+    print_file_diff(dir1, '<->', dir2, width)
+    for change in changes:
+        path = change.file_path
+        entry1 = change.new
+        entry2 = change.old
+        if change.kind == ADDED:
+            print_file_diff(path, ' ->', '', width)
+        elif change.kind == REMOVED:
+            print_file_diff('', '<- ', path, width)
+        elif change.kind == SIZE_CHANGED:
+            file_size1 = pp_file_size(entry1.file_size)
+            file_size2 = pp_file_size(entry2.file_size)
+            print_file_diff(
+                path, '<->', path, width, extras1=file_size1, extras2=file_size2
+            )
+        elif change.kind == HASH_CHANGED:
+            file_hash1 = entry1.file_hash
+            file_hash2 = entry2.file_hash
+            print_file_diff(
+                path, '<->', path, width, extras1=file_hash1[:6], extras2=file_hash2[:6]
+            )
+        elif change.kind == PERMS_CHANGED:
+            file_perms1 = pp_file_perms(entry1.file_perms)
+            file_perms2 = pp_file_perms(entry2.file_perms)
+            print_file_diff(
+                path, '<->', path, width, extras1=file_perms1, extras2=file_perms2
+            )
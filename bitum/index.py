@@ -0,0 +1,679 @@
+from collections import namedtuple
+import hashlib
+import heapq
+import os
+import sqlite3
+import struct
+
+"""
+The index (bitumen.sqlite3)
+---------------------------
+
+The schema version is stored in `PRAGMA user_version` and older indexes are
+migrated when they are opened for writing (see `MIGRATIONS`) -- opened only
+for reading they're left as they are, for older versions of bitum that read
+the same file, and a migrated copy is read in memory instead. Version 1 is the original
+single `files`-table, which stored the bucket name and the full path on every
+row and only had an index on `file_path`.
+
+Version 2 normalizes this into:
+
+- `buckets`: one row per `.bitumen`-file with its size
+- `dirs`: one row per directory -- each path prefix is only stored once
+- `entries`: one row per file keyed by `(dir_id, name)`, with an index on
+  `(bucket_id, byte_index)` for looking up the contents of a bucket
+- `meta`: key/value pairs, e.g. which hash function was used
+
+Hashes are stored as binary digests rather than hex strings.
+A `files` view with the columns of version 1 is kept for ad-hoc queries
+(and older versions of bitum, that only read the index).
+
+Entries are ordered by `(dirname, name)`, i.e. all files in a directory
+are grouped together and directories are sorted by their path. This is the
+order the index can be read in without sorting (see `diff.walk_sorted()`).
+
+Version 3 links each directory to its parent (`dirs.parent_id`) -- all
+ancestors of a directory with files have a row, the root is `''` -- and
+stores a "Merkle" hash of each subtree in `dirs.tree_hash` (see
+`tree_hash()`). The hashes are kept up-to-date by `insert()` and `delete()`,
+so two trees can be compared by only descending into the directories whose
+hashes differ (see `diff.diff_tree_hashes()`).
+
+Version 4 adds checksums of the `.bitumen`-files, so the remote files can
+be verified without downloading them (see `verify.py`): `blocks` has a hash
+of each block of `checksum_block_size` bytes (in `meta`) of each bucket,
+and `buckets.hash` is the hash of the block hashes. Buckets built by older
+versions have no checksums.
+"""
+
+SCHEMA_VERSION = 4
+
+TREE_HASH_SIZE = 32
+CHECKSUM_BLOCK_SIZE = 4 * 2**20  # 4 MiB
+
+_FILE_HEADER = struct.Struct('>cIqB')
+_DIR_HEADER = struct.Struct('>cIB')
+
+IndexRow = namedtuple(
+    'IndexRow',
+    ['bucket', 'file_path', 'byte_index', 'file_size', 'file_hash', 'file_perms'],
+)
+
+
+def sort_key(file_path):
+    # type: (str) -> tuple[str, str]
+    "The order of entries in the index -- `(dirname, name)`"
+    dirname, _, name = file_path.rpartition('/')
+    return dirname, name
+
+
+def parent_dir(dir_path):
+    # type: (str) -> str | None
+    "`/a/b` -> `/a` -> `''` -> `None`"
+    return dir_path.rpartition('/')[0] if dir_path else None
+
+
+def tree_hash(files, dirs):
+    # type: (Iterable[tuple[str, int | None, bytes | None]], Iterable[tuple[str, bytes]]) -> bytes
+    """Hash of a directory from its files and subdirectories
+
+    `files` are `(name, file_size, file_hash)` ordered by name and `dirs` are
+    `(name, tree_hash)` ordered by path. Permissions aren't included, since
+    `upload` doesn't store them.
+    """
+    # Hashed in one go -- `update()` per field is slow for many small files
+    parts = []
+    for name, file_size, file_hash in files:
+        name = name.encode()
+        file_hash = file_hash or b''
+        size = -1 if file_size is None else file_size
+        parts += (
+            _FILE_HEADER.pack(b'F', len(name), size, len(file_hash)),
+            name,
+            file_hash,
+        )
+    for name, dir_hash in dirs:
+        name = name.encode()
+        parts += (_DIR_HEADER.pack(b'D', len(name), len(dir_hash)), name, dir_hash)
+    return hashlib.blake2b(b''.join(parts), digest_size=TREE_HASH_SIZE).digest()
+
+
+def _migrate_1(index):
+    index.con.execute(
+        'CREATE TABLE IF NOT EXISTS files(bucket, file_path PRIMARY KEY, byte_index, file_size, file_hash, file_perms)'
+    )
+
+
+def _migrate_2(index):
+    cur = index.con.cursor()
+    cur.executescript(
+        """
+        BEGIN;
+
+        CREATE TABLE meta(
+            key TEXT PRIMARY KEY,
+            value
+        ) WITHOUT ROWID;
+        INSERT INTO meta VALUES('hash_function', 'blake2b');
+
+        CREATE TABLE buckets(
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE dirs(
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE
+        );
+
+        CREATE TABLE entries(
+            dir_id INTEGER NOT NULL REFERENCES dirs(id),
+            name TEXT NOT NULL,
+            bucket_id INTEGER NOT NULL REFERENCES buckets(id),
+            byte_index INTEGER NOT NULL,
+            file_size INTEGER,
+            file_hash BLOB,
+            file_perms INTEGER,
+            PRIMARY KEY(dir_id, name)
+        ) WITHOUT ROWID;
+        CREATE INDEX entries_bucket ON entries(bucket_id, byte_index);
+
+        ALTER TABLE files RENAME TO files_v1;
+
+        CREATE VIEW files AS
+        SELECT
+            buckets.name AS bucket,
+            dirs.path || '/' || entries.name AS file_path,
+            entries.byte_index,
+            entries.file_size,
+            CASE
+                WHEN entries.file_hash IS NOT NULL THEN lower(hex(entries.file_hash))
+            END AS file_hash,
+            entries.file_perms
+        FROM entries
+        JOIN dirs ON dirs.id = entries.dir_id
+        JOIN buckets ON buckets.id = entries.bucket_id;
+        """
+    )
+    cur.execute(
+        'SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms FROM files_v1'
+    )
+    index.insert(cur)
+    cur.execute('DROP TABLE files_v1')
+
+
+def _migrate_3(index):
+    cur = index.con.cursor()
+    cur.executescript(
+        """
+        BEGIN;
+
+        ALTER TABLE dirs ADD COLUMN parent_id INTEGER REFERENCES dirs(id);
+        ALTER TABLE dirs ADD COLUMN tree_hash BLOB;
+        CREATE INDEX dirs_parent ON dirs(parent_id);
+        """
+    )
+    index.schema_version = 3
+    dir_ids = {}
+    for dir_id, path in cur.execute('SELECT id, path FROM dirs').fetchall():
+        if path:
+            # Creates missing ancestors
+            parent_id = index._dir_id(parent_dir(path))
+            cur.execute(
+                'UPDATE dirs SET parent_id = ? WHERE id = ?', [parent_id, dir_id]
+            )
+        dir_ids[dir_id] = path
+    index._update_tree_hashes(dir_ids)
+
+
+def _migrate_4(index):
+    index.con.executescript(
+        f"""
+        BEGIN;
+
+        ALTER TABLE buckets ADD COLUMN hash BLOB;
+
+        CREATE TABLE blocks(
+            bucket_id INTEGER NOT NULL REFERENCES buckets(id),
+            block_index INTEGER NOT NULL,
+            hash BLOB NOT NULL,
+            PRIMARY KEY(bucket_id, block_index)
+        ) WITHOUT ROWID;
+        INSERT INTO meta VALUES('checksum_block_size', {CHECKSUM_BLOCK_SIZE});
+        """
+    )
+
+
+MIGRATIONS = [
+    (1, _migrate_1),
+    (2, _migrate_2),
+    (3, _migrate_3),
+    (4, _migrate_4),
+]
+
+
+class Index:
+    """An open `bitumen.sqlite3`
+
+    `build=True` tunes SQLite for bulk writes (larger pages, WAL, relaxed
+    syncing). `close()` checkpoints the WAL back into the main file, so
+    the index is always a single self-contained file after closing.
+    Bucket sizes and tree hashes are then only updated once on `close()`
+    rather than on every `insert()` and `delete()` -- a build inserts one
+    bucket at a time, which would otherwise rehash the same directories for
+    every bucket. A new index gets its index on `(bucket_id, byte_index)`
+    after all rows are inserted.
+
+    With `track_changes=True` every insert and delete is also recorded in
+    `changes` as `('put', row)` or `('delete', file_path)` -- and new bucket
+    checksums as `('checksums', (bucket, bucket_hash, block_hashes))` --
+    which is what is uploaded as a delta (see `remote_index.py`).
+
+    An index of an older schema is only migrated in place with `build=True`
+    or `writable=True` -- otherwise a copy of it is migrated in memory, and
+    changes to it aren't saved.
+    """
+
+    def __init__(self, db_filepath, build=False, track_changes=False, writable=False):
+        is_new = not os.path.exists(db_filepath) or os.path.getsize(db_filepath) == 0
+        self.db_filepath = db_filepath
+        self.con = sqlite3.connect(db_filepath)
+        self._dir_ids = {}
+        self._bucket_ids = {}
+        self.schema_version = None
+        self.is_build = build
+        self.is_writable = build or writable or is_new
+        self.changes = None
+        # Updated on `close()` when building (see `_update_derived()`)
+        self._pending_bucket_ids = set()
+        self._pending_dir_ids = {}
+
+        if build:
+            if is_new:
+                # Must be set before the first table is created
+                self.con.execute('PRAGMA page_size = 8192')
+            self.con.execute('PRAGMA journal_mode = WAL')
+            self.con.execute('PRAGMA synchronous = NORMAL')
+            self.con.execute('PRAGMA cache_size = -65536')  # 64 MiB
+            self.con.execute('PRAGMA temp_store = MEMORY')
+
+        self._migrate()
+        if build and is_new:
+            # Recreated on `close()`
+            self.con.execute('DROP INDEX entries_bucket')
+        if track_changes:
+            self.changes = []
+
+    def _migrate(self):
+        cur = self.con.cursor()
+        (version,) = cur.execute('PRAGMA user_version').fetchone()
+        if (
+            version == 0
+            and cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'"
+            ).fetchone()
+        ):
+            # Indexes from before `user_version` was set
+            version = 1
+
+        if version > SCHEMA_VERSION:
+            raise ValueError(
+                f'{self.db_filepath} has schema version {version} -- newer than this version of bitum supports ({SCHEMA_VERSION})'
+            )
+
+        if version < SCHEMA_VERSION and not self.is_writable:
+            con = sqlite3.connect(':memory:')
+            self.con.backup(con)
+            self.con.close()
+            self.con = con
+            cur = self.con.cursor()
+
+        # Migrations insert rows with the schema of their version
+        self.schema_version = version
+        for migration_version, migration in MIGRATIONS:
+            if version < migration_version:
+                migration(self)
+                # `PRAGMA` doesn't support parameters
+                cur.execute(f'PRAGMA user_version = {migration_version}')
+                self.con.commit()
+                self.schema_version = migration_version
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def commit(self):
+        self.con.commit()
+
+    def close(self):
+        if self.is_build:
+            self.con.execute(
+                'CREATE INDEX IF NOT EXISTS entries_bucket ON entries(bucket_id, byte_index)'
+            )
+            self._update_bucket_sizes(self._pending_bucket_ids)
+            self._update_tree_hashes(self._pending_dir_ids)
+        self.con.commit()
+        if self.is_build:
+            self.con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.con.execute('PRAGMA journal_mode = DELETE')
+        self.con.close()
+
+    def get_meta(self, key, default=None):
+        cur = self.con.cursor()
+        row = cur.execute('SELECT value FROM meta WHERE key = ?', [key]).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.con.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', [key, value])
+
+    def _dir_id(self, path):
+        # type: (str) -> int
+        dir_id = self._dir_ids.get(path)
+        if dir_id is None:
+            cur = self.con.cursor()
+            row = cur.execute('SELECT id FROM dirs WHERE path = ?', [path]).fetchone()
+            if row:
+                (dir_id,) = row
+            elif self.schema_version >= 3:
+                parent = parent_dir(path)
+                parent_id = self._dir_id(parent) if parent is not None else None
+                cur.execute(
+                    'INSERT INTO dirs(path, parent_id) VALUES(?, ?)', [path, parent_id]
+                )
+                dir_id = cur.lastrowid
+            else:
+                cur.execute('INSERT INTO dirs(path) VALUES(?)', [path])
+                dir_id = cur.lastrowid
+            self._dir_ids[path] = dir_id
+        return dir_id
+
+    def _bucket_id(self, name):
+        # type: (str) -> int
+        bucket_id = self._bucket_ids.get(name)
+        if bucket_id is None:
+            cur = self.con.cursor()
+            cur.execute('INSERT OR IGNORE INTO buckets(name) VALUES(?)', [name])
+            (bucket_id,) = cur.execute(
+                'SELECT id FROM buckets WHERE name = ?', [name]
+            ).fetchone()
+            self._bucket_ids[name] = bucket_id
+        return bucket_id
+
+    def insert(self, db_entries):
+        # type: (Iterable[tuple[str, str, int, int, str, int]]) -> None
+        "Insert (or replace) rows of `(bucket, file_path, byte_index, file_size, file_hash, file_perms)`"
+        bucket_ids = set()
+        dir_ids = {}
+
+        def _rows():
+            for (
+                bucket,
+                file_path,
+                byte_index,
+                file_size,
+                file_hash,
+                file_perms,
+            ) in db_entries:
+                if self.changes is not None:
+                    self.changes.append(
+                        (
+                            'put',
+                            (
+                                bucket,
+                                file_path,
+                                byte_index,
+                                file_size,
+                                file_hash,
+                                file_perms,
+                            ),
+                        )
+                    )
+                dirname, name = sort_key(file_path)
+                bucket_id = self._bucket_id(bucket)
+                bucket_ids.add(bucket_id)
+                dir_id = self._dir_id(dirname)
+                dir_ids[dir_id] = dirname
+                yield (
+                    dir_id,
+                    name,
+                    bucket_id,
+                    byte_index,
+                    file_size,
+                    bytes.fromhex(file_hash) if file_hash is not None else None,
+                    file_perms,
+                )
+
+        self.con.executemany(
+            'INSERT OR REPLACE INTO entries VALUES(?, ?, ?, ?, ?, ?, ?)', _rows()
+        )
+        self._update_derived(bucket_ids, dir_ids)
+
+    def delete(self, file_paths):
+        # type: (Iterable[str]) -> None
+        bucket_ids = set()
+        dir_ids = {}
+        cur = self.con.cursor()
+        for file_path in file_paths:
+            dirname, name = sort_key(file_path)
+            row = cur.execute(
+                """
+                SELECT dir_id, bucket_id FROM entries
+                WHERE dir_id = (SELECT id FROM dirs WHERE path = ?) AND name = ?
+                """,
+                [dirname, name],
+            ).fetchone()
+            if row:
+                dir_id, bucket_id = row
+                cur.execute(
+                    'DELETE FROM entries WHERE dir_id = ? AND name = ?', [dir_id, name]
+                )
+                bucket_ids.add(bucket_id)
+                dir_ids[dir_id] = dirname
+                if self.changes is not None:
+                    self.changes.append(('delete', file_path))
+        self._update_derived(bucket_ids, dir_ids)
+
+    def _update_derived(self, bucket_ids, dir_ids):
+        # type: (set[int], dict[int, str]) -> None
+        "Update the sizes of `bucket_ids` and the tree hashes of `dir_ids` -- on `close()` when building"
+        if self.is_build:
+            self._pending_bucket_ids.update(bucket_ids)
+            self._pending_dir_ids.update(dir_ids)
+        else:
+            self._update_bucket_sizes(bucket_ids)
+            self._update_tree_hashes(dir_ids)
+
+    def _update_bucket_sizes(self, bucket_ids):
+        # Files are stored back-to-back, so the size of the `.bitumen`-file is
+        # where its last file ends. Files don't overlap, so it's enough to look
+        # at the files with the highest `byte_index` (found with the index on
+        # `(bucket_id, byte_index)`) rather than every file in the bucket.
+        self.con.executemany(
+            """
+            UPDATE buckets SET size = (
+                SELECT COALESCE(MAX(byte_index + file_size), 0)
+                FROM entries
+                WHERE bucket_id = buckets.id AND byte_index = (
+                    SELECT MAX(byte_index) FROM entries WHERE bucket_id = buckets.id
+                )
+            )
+            WHERE id = ?
+            """,
+            [[bucket_id] for bucket_id in bucket_ids],
+        )
+
+    def _update_tree_hashes(self, dir_ids):
+        # type: (dict[int, str]) -> None
+        """Recompute the tree hashes of `dir_ids` (`{dir_id: path}`) and their ancestors
+
+        Directories are updated deepest first, so the hashes of their
+        subdirectories are always up-to-date. Directories left without files
+        and subdirectories are removed.
+        """
+        if self.schema_version < 3:
+            return
+        cur = self.con.cursor()
+        # `(-depth, path, dir_id)`
+        heap = [(-path.count('/'), path, dir_id) for dir_id, path in dir_ids.items()]
+        heapq.heapify(heap)
+        queued = set(dir_ids)
+        while heap:
+            _, path, dir_id = heapq.heappop(heap)
+            files = cur.execute(
+                'SELECT name, file_size, file_hash FROM entries WHERE dir_id = ? ORDER BY name',
+                [dir_id],
+            ).fetchall()
+            dirs = [
+                (child_path.rpartition('/')[2], child_hash)
+                for child_path, child_hash in cur.execute(
+                    'SELECT path, tree_hash FROM dirs WHERE parent_id = ? ORDER BY path',
+                    [dir_id],
+                ).fetchall()
+            ]
+            if files or dirs:
+                cur.execute(
+                    'UPDATE dirs SET tree_hash = ? WHERE id = ?',
+                    [tree_hash(files, dirs), dir_id],
+                )
+            else:
+                cur.execute('DELETE FROM dirs WHERE id = ?', [dir_id])
+                self._dir_ids.pop(path, None)
+
+            parent = parent_dir(path)
+            if parent is not None:
+                parent_id = self._dir_id(parent)
+                if parent_id not in queued:
+                    queued.add(parent_id)
+                    heapq.heappush(heap, (-parent.count('/'), parent, parent_id))
+
+    def set_checksums(self, bucket, bucket_hash, block_hashes):
+        # type: (str, str, list[str]) -> None
+        "Replace the checksums of `bucket` (see `verify.bucket_checksums()`)"
+        if self.changes is not None:
+            self.changes.append(('checksums', (bucket, bucket_hash, block_hashes)))
+        bucket_id = self._bucket_id(bucket)
+        cur = self.con.cursor()
+        cur.execute(
+            'UPDATE buckets SET hash = ? WHERE id = ?',
+            [bytes.fromhex(bucket_hash), bucket_id],
+        )
+        cur.execute('DELETE FROM blocks WHERE bucket_id = ?', [bucket_id])
+        cur.executemany(
+            'INSERT INTO blocks VALUES(?, ?, ?)',
+            [
+                (bucket_id, block_index, bytes.fromhex(block_hash))
+                for block_index, block_hash in enumerate(block_hashes)
+            ],
+        )
+
+    def checksums(self, bucket):
+        # type: (str) -> tuple[str, list[str]] | None
+        "`(bucket_hash, block_hashes)` of `bucket` -- `None` if it has no checksums"
+        cur = self.con.cursor()
+        row = cur.execute(
+            'SELECT id, hash FROM buckets WHERE name = ?', [bucket]
+        ).fetchone()
+        if row is None or row[1] is None:
+            return None
+        bucket_id, bucket_hash = row
+        cur.execute(
+            'SELECT hash FROM blocks WHERE bucket_id = ? ORDER BY block_index',
+            [bucket_id],
+        )
+        return bucket_hash.hex(), [block_hash.hex() for (block_hash,) in cur]
+
+    _SELECT_ROWS = """
+        SELECT
+            buckets.name,
+            dirs.path,
+            entries.name,
+            entries.byte_index,
+            entries.file_size,
+            entries.file_hash,
+            entries.file_perms
+        FROM dirs
+        JOIN entries ON entries.dir_id = dirs.id
+        JOIN buckets ON buckets.id = entries.bucket_id
+    """
+
+    @staticmethod
+    def _row(row):
+        # type: (tuple) -> IndexRow
+        bucket, dirname, name, byte_index, file_size, file_hash, file_perms = row
+        return IndexRow(
+            bucket=bucket,
+            file_path=f'{dirname}/{name}',
+            byte_index=byte_index,
+            file_size=file_size,
+            file_hash=file_hash.hex() if file_hash is not None else None,
+            file_perms=file_perms,
+        )
+
+    def lookup(self, file_path):
+        # type: (str) -> IndexRow | None
+        dirname, name = sort_key(file_path)
+        cur = self.con.cursor()
+        cur.execute(
+            f'{self._SELECT_ROWS} WHERE dirs.path = ? AND entries.name = ?',
+            [dirname, name],
+        )
+        row = cur.fetchone()
+        return self._row(row) if row else None
+
+    def iter_rows(self, subtree='', recursive=True):
+        # type: (str, bool) -> Iterator[IndexRow]
+        """All rows in index order (see `sort_key()`)
+
+        With `subtree` only the rows of files in the directory `subtree` --
+        and, if `recursive`, its subdirectories -- are read. This is a range
+        scan on the index of `dirs.path`, so it only touches the entries of
+        the subtree.
+        """
+        if subtree == '' and recursive:
+            where, params = '', []
+        elif recursive:
+            # Paths in the subtree sort between `subtree` and `subtree0`
+            # (`0` comes after `/`). Siblings like `subtree-b` sort in the
+            # same range and are filtered out.
+            where = """
+                WHERE dirs.path >= ? AND dirs.path < ?
+                AND (dirs.path = ? OR substr(dirs.path, 1, ?) = ?)
+            """
+            params = [subtree, f'{subtree}0', subtree, len(subtree) + 1, f'{subtree}/']
+        else:
+            where, params = 'WHERE dirs.path = ?', [subtree]
+
+        cur = self.con.cursor()
+        # `CROSS JOIN` makes SQLite scan `dirs` in `path`-order and look up
+        # the entries of each directory by primary key, rather than sorting
+        cur.execute(
+            f"""
+            {self._SELECT_ROWS.replace('JOIN entries', 'CROSS JOIN entries')}
+            {where}
+            ORDER BY dirs.path, entries.name
+            """,
+            params,
+        )
+        for row in cur:
+            yield self._row(row)
+
+    def bucket_rows(self, bucket):
+        # type: (str) -> list[IndexRow]
+        "Rows of the files in `bucket` ordered by `byte_index`"
+        cur = self.con.cursor()
+        cur.execute(
+            f"""
+            {self._SELECT_ROWS}
+            WHERE entries.bucket_id = (SELECT id FROM buckets WHERE name = ?)
+            ORDER BY entries.byte_index
+            """,
+            [bucket],
+        )
+        return [self._row(row) for row in cur]
+
+    def tree_hash(self, dir_path):
+        # type: (str) -> bytes | None
+        "Tree hash of the directory `dir_path` -- `None` if there's no such directory"
+        row = self.con.execute(
+            'SELECT tree_hash FROM dirs WHERE path = ?', [dir_path]
+        ).fetchone()
+        return row[0] if row else None
+
+    def child_dirs(self, dir_path):
+        # type: (str) -> list[str]
+        "Paths of the subdirectories of `dir_path` in index order"
+        cur = self.con.execute(
+            """
+            SELECT path FROM dirs
+            WHERE parent_id = (SELECT id FROM dirs WHERE path = ?)
+            ORDER BY path
+            """,
+            [dir_path],
+        )
+        return [path for (path,) in cur]
+
+    def buckets_of(self, file_paths):
+        # type: (Iterable[str]) -> set[str]
+        "Names of the buckets that contain any of `file_paths`"
+        buckets = set()
+        for file_path in file_paths:
+            row = self.lookup(file_path)
+            if row:
+                buckets.add(row.bucket)
+        return buckets
+
+    def buckets(self):
+        # type: () -> list[tuple[str, int]]
+        "`(name, size)` of each bucket that has files in it"
+        cur = self.con.cursor()
+        cur.execute(
+            """
+            SELECT name, size FROM buckets
+            WHERE EXISTS (SELECT 1 FROM entries WHERE bucket_id = buckets.id)
+            ORDER BY name
+            """
+        )
+        return cur.fetchall()
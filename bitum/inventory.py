@@ -0,0 +1,74 @@
+from collections import namedtuple
+
+from index import Index
+
+"""
+Remote inventory
+----------------
+
+Rather than a `HEAD` per `.bitumen`-file, `Inventory` lists all objects
+directly under the prefix with `list_objects_v2` -- up to 1000 per request --
+which gives the size and `ETag` of every bucket in a few calls. The listing
+stops at `/` (`Delimiter`), so the shards and deltas of the index aren't
+listed.
+
+It also finds orphaned `.bitumen`-files: objects that no index refers to,
+e.g. left behind by an upload that was interrupted before the index was
+committed.
+"""
+
+BUCKET_SUFFIX = '.bitumen'
+
+RemoteObject = namedtuple('RemoteObject', ['bucket_name', 'key', 'size', 'etag'])
+
+
+def index_buckets(db_filepaths):
+    # type: (Iterable[str]) -> set[str]
+    "Names of the buckets with files in any of the indexes at `db_filepaths`"
+    bucket_names = set()
+    for db_filepath in db_filepaths:
+        with Index(db_filepath) as index:
+            bucket_names.update(name for name, _ in index.buckets())
+    return bucket_names
+
+
+class Inventory:
+    "The `.bitumen`-files at `prefix` in the bucket, keyed by bucket name"
+
+    def __init__(self, s3_client, bucket, prefix):
+        # type: (S3Client, str, str) -> None
+        self.prefix = prefix
+        self.objects = {}
+        self.num_requests = 0
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            self.num_requests += 1
+            for obj in page.get('Contents', []):
+                filename = obj['Key'][len(prefix) :]
+                if filename.endswith(BUCKET_SUFFIX):
+                    bucket_name = filename[: -len(BUCKET_SUFFIX)]
+                    self.objects[bucket_name] = RemoteObject(
+                        bucket_name=bucket_name,
+                        key=obj['Key'],
+                        size=obj['Size'],
+                        etag=obj['ETag'],
+                    )
+
+    def __contains__(self, bucket_name):
+        return bucket_name in self.objects
+
+    def size(self, bucket_name):
+        # type: (str) -> int | None
+        "Size of `<bucket_name>.bitumen` -- `None` if there's no such object"
+        obj = self.objects.get(bucket_name)
+        return obj.size if obj is not None else None
+
+    def orphans(self, bucket_names):
+        # type: (Iterable[str]) -> list[RemoteObject]
+        "The objects of buckets not in `bucket_names` (the buckets the indexes refer to)"
+        referenced = set(bucket_names)
+        return [
+            self.objects[bucket_name]
+            for bucket_name in sorted(self.objects)
+            if bucket_name not in referenced
+        ]
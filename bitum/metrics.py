@@ -0,0 +1,206 @@
+from collections import Counter
+import contextlib
+import cProfile
+from datetime import datetime, timezone
+import json
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+"""
+Metrics
+-------
+
+Where did a slow sync spend its time? Every command runs in a `span()`, as
+does every `TimedMessage` and the phases of `upload` and `download`. Spans
+nest per thread, and record how long they took and how much each counter
+grew meanwhile, so the throughput of a phase is its counters over its time.
+
+A thread that isn't inside a span of its own (e.g. in a thread pool) records
+its spans under the innermost span of the main thread.
+
+Counters are incremented with `count()` where the work is done: files and
+bytes of each pipeline stage (`pipeline.StageStats`), requests, retries and
+bytes sent and received (`scheduler.Scheduler`), hits and misses of the
+range cache, and the files and bytes restored.
+
+    bitum --metrics-json metrics.json upload ...
+
+writes the spans and counters of the command as JSON once it's done (or has
+failed). `--profile cpu` runs the command under cProfile -- in every thread,
+as the pipeline does its work in thread pools -- and `--profile memory`
+under tracemalloc. The profile is written to `--profile-output` and the top
+entries are printed.
+"""
+
+PROFILES = ['cpu', 'memory']
+PROFILE_TOP = 25
+TRACEMALLOC_FRAMES = 10
+
+
+class Span:
+    "A named phase with its duration and the growth of the counters during it"
+
+    def __init__(self, name, counters):
+        # type: (str, Counter) -> None
+        self.name = name
+        self.children = []
+        self.t_begin = time.perf_counter()
+        self.duration = None
+        self.counters = Counter()
+        self._counters_begin = counters
+
+    def end(self, counters):
+        # type: (Counter) -> None
+        self.duration = time.perf_counter() - self.t_begin
+        self.counters = counters - self._counters_begin
+
+    def to_dict(self):
+        # type: () -> dict
+        duration = self.duration
+        if duration is None:
+            # Still running (e.g. interrupted in a thread)
+            duration = time.perf_counter() - self.t_begin
+        result = {'name': self.name, 'seconds': round(duration, 6)}
+        if self.counters:
+            result['counters'] = dict(sorted(self.counters.items()))
+            if duration:
+                result['per_second'] = {
+                    name: round(value / duration, 3)
+                    for name, value in sorted(self.counters.items())
+                }
+        if self.children:
+            result['spans'] = [child.to_dict() for child in self.children]
+        return result
+
+
+class Metrics:
+    "Counters and nested spans of a run (see above) -- safe to use from threads"
+
+    def __init__(self):
+        self.counters = Counter()
+        self.spans = []
+        self.started = datetime.now(timezone.utc)
+        self._t_begin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._main_stack = []
+
+    def count(self, name, value=1):
+        # type: (str, int) -> None
+        with self._lock:
+            self.counters[name] += value
+
+    @contextlib.contextmanager
+    def span(self, name):
+        # type: (str) -> Iterator[Span]
+        "Record the block as a span under the innermost span of this thread"
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            is_main = threading.current_thread() is threading.main_thread()
+            stack = self._local.stack = self._main_stack if is_main else []
+        parent_stack = stack or self._main_stack
+        with self._lock:
+            span = Span(name, self.counters.copy())
+            (parent_stack[-1].children if parent_stack else self.spans).append(span)
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            with self._lock:
+                span.end(self.counters)
+
+    def to_dict(self):
+        # type: () -> dict
+        with self._lock:
+            return {
+                'argv': sys.argv[1:],
+                'started': self.started.isoformat(timespec='seconds'),
+                'seconds': round(time.perf_counter() - self._t_begin, 6),
+                'peak_rss': _peak_rss(),
+                'counters': dict(sorted(self.counters.items())),
+                'spans': [span.to_dict() for span in self.spans],
+            }
+
+    def write_json(self, filepath):
+        # type: (str) -> None
+        with open(filepath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+
+def _peak_rss():
+    # type: () -> int
+    "Peak RSS of this process in bytes"
+    # `ru_maxrss` is in KiB on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+
+METRICS = Metrics()
+count = METRICS.count
+span = METRICS.span
+
+
+def profile(kind, output_path=None):
+    # type: (str, str | None) -> ContextManager[None]
+    "Context manager that runs the block under cProfile (`kind` 'cpu') or tracemalloc ('memory')"
+    if kind == 'cpu':
+        return _profile_cpu(output_path or 'bitum.pstats')
+    return _profile_memory(output_path or 'bitum.tracemalloc')
+
+
+@contextlib.contextmanager
+def _profile_cpu(output_path):
+    # type: (str) -> Iterator[None]
+    # A profiler only sees the thread that enabled it, so every thread that
+    # starts from now on enables one of its own
+    profilers = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def _start_thread_profiler(*_):
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        with lock:
+            profilers.append(profiler)
+        profiler.enable()
+
+    threading.setprofile(_start_thread_profiler)
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        with lock:
+            stats = pstats.Stats(*profilers)
+        stats.dump_stats(output_path)
+        print(f'CPU profile of {len(profilers)} threads written to {output_path}')
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+
+
+@contextlib.contextmanager
+def _profile_memory(output_path):
+    # type: (str) -> Iterator[None]
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot.dump(output_path)
+        print(
+            f'Memory profile written to {output_path} '
+            f'(peak {peak / 2**20:.1f} MiB) -- largest allocations still held at the end:'
+        )
+        for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+            frame = stat.traceback[0]
+            print(
+                f'{stat.size / 2**10:>10.1f} KiB {stat.count:>8} blocks  '
+                f'{frame.filename}:{frame.lineno}'
+            )
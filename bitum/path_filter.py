@@ -0,0 +1,148 @@
+import heapq
+import re
+
+from index import sort_key
+
+"""
+Path filters
+------------
+
+`download`, `extract` and `debug download-all` take `--include` patterns to
+restore only part of the backup. Patterns are paths relative to the root of
+the backup, with the wildcards:
+
+- `*` matches anything but `/`, `?` matches a single character but `/`
+  and `[...]`/`[!...]` match a character (not) in the set but `/`
+- `**` as a whole path component matches any number of directories
+
+A pattern matches a file if it matches the path of the file or of any of the
+directories it's in, so `projects/foo` restores the directory `projects/foo`.
+Patterns without a `/` that contain wildcards, like `*.py`, match at any
+depth (they're prefixed with `**/`).
+
+Rather than filtering every path, each pattern is turned into the directories
+that need to be read: the longest leading part of the pattern without
+wildcards (`projects/foo/**` -> `/projects/foo`), which is read with a range
+scan on the index (`Index.iter_rows()`) or by walking just that directory on
+disk. Only the paths read that way are matched against the patterns.
+"""
+
+WILDCARD_CHARS = '*?['
+
+
+def _translate(component):
+    # type: (str) -> str
+    "Regex for a single path component of a pattern"
+    regex = ''
+    i = 0
+    while i < len(component):
+        char = component[i]
+        i += 1
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            # `]` right after `[` or `[!` is part of the set
+            end = i + 1 if component[i : i + 1] == '!' else i
+            end = component.find(']', end + 1)
+            if end == -1:
+                regex += re.escape(char)
+                continue
+            chars = component[i:end].replace('\\', '\\\\')
+            # Like `*` and `?` a set never matches `/` -- not when negated and
+            # not through a range like `[+-0]` either
+            if chars.startswith('!'):
+                regex += f'[^/{chars[1:]}]'
+            else:
+                regex += f'(?!/)[{chars}]'
+            i = end + 1
+        else:
+            regex += re.escape(char)
+    return regex
+
+
+def _has_wildcards(component):
+    # type: (str) -> bool
+    return component == '**' or any(char in component for char in WILDCARD_CHARS)
+
+
+def _compile(pattern):
+    # type: (str) -> tuple[str, list[tuple[str, bool]]]
+    "Regex for `pattern` and the directories to read as `(dir_path, recursive)`"
+    components = [c for c in pattern.split('/') if c not in ('', '.')]
+    if '/' not in pattern.strip('/') and _has_wildcards(pattern):
+        components = ['**', *components]
+
+    regex = ''
+    for component in components:
+        if component == '**':
+            regex += '(?:/[^/]+)*'
+        else:
+            regex += f'/{_translate(component)}'
+    # Everything inside a matching directory matches
+    regex += '(?:/.*)?'
+
+    literal = []
+    for component in components:
+        if _has_wildcards(component):
+            break
+        literal.append(component)
+    dir_path = ''.join(f'/{component}' for component in literal)
+
+    if len(literal) == len(components) and literal:
+        # The pattern is a plain path of either a directory or a file
+        parent_path = dir_path.rpartition('/')[0]
+        return regex, [(dir_path, True), (parent_path, False)]
+    return regex, [(dir_path, True)]
+
+
+def _is_below(path, dir_path):
+    # type: (str, str) -> bool
+    "Whether `path` is `dir_path` or inside it"
+    return dir_path == '' or path == dir_path or path.startswith(f'{dir_path}/')
+
+
+class PathFilter:
+    "Matches paths against `--include` patterns (see above)"
+
+    def __init__(self, patterns):
+        # type: (Iterable[str]) -> None
+        self.patterns = list(patterns)
+        regexes = []
+        dirs = set()
+        for pattern in self.patterns:
+            regex, pattern_dirs = _compile(pattern)
+            regexes.append(regex)
+            dirs.update(pattern_dirs)
+        self.regex = re.compile('|'.join(f'(?:{regex})' for regex in regexes))
+
+        # Leave out directories that are read anyway, so the same path is
+        # never read twice
+        recursive_dirs = [dir_path for dir_path, recursive in dirs if recursive]
+        self.dirs = sorted(
+            (dir_path, recursive)
+            for dir_path, recursive in dirs
+            if not any(
+                _is_below(dir_path, other)
+                for other in recursive_dirs
+                if other != dir_path or not recursive
+            )
+        )
+
+    def match(self, file_path):
+        # type: (str) -> bool
+        return self.regex.fullmatch(file_path) is not None
+
+    def merge(self, read_dir):
+        # type: (Callable[[str, bool], Iterable]) -> Iterator
+        """Read the directories to read with `read_dir(dir_path, recursive)`
+
+        `read_dir()` must return entries with a `file_path` in index order.
+        The entries of all directories are merged into a single stream in
+        index order, and only the matching entries are yielded.
+        """
+        streams = [read_dir(dir_path, recursive) for dir_path, recursive in self.dirs]
+        for entry in heapq.merge(*streams, key=lambda entry: sort_key(entry.file_path)):
+            if self.match(entry.file_path):
+                yield entry
@@ -0,0 +1,387 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import botocore.exceptions
+
+from metrics import count
+from read_order import READ_WINDOW, drop_cached, prefetch, sort_for_reading
+from transfers import upload_file
+from utils import build_bucket, file_hash, pp_file_size
+from verify import bucket_checksums
+
+"""
+Upload pipeline
+---------------
+
+`upload` runs its stages concurrently, connected by bounded queues, so the
+disk and the network are busy at the same time:
+
+    walk -> hash (`hash_entries()`) -> diff + pack -> upload (`Uploader`)
+
+- The disk is walked without hashing, and `hash_entries()` hashes up to
+  `jobs` files at a time in a thread pool (hashlib releases the GIL while
+  hashing), yielding them in walk order for the diff.
+- New files are packed into buckets as the diff finds them, and each bucket
+  is handed to the `Uploader` as soon as it's full -- the first bucket is
+  uploading while later files are still being hashed and packed. Buckets
+  with changed files are repacked after the diff, as only then all the
+  changes to them are known.
+- Files are read in windows ordered by their place on disk and hinted to
+  the kernel ahead of time (see `read_order.py`).
+- Buckets are built by a `BucketBuilder` with `build_jobs` threads -- reading
+  and writing files releases the GIL, so building scales with the disks
+  and cores. Buckets are collected in the order they were submitted, so the
+  index rows are inserted in the same order however long each one takes.
+  At most `max_inflight` bytes of buckets are being built at a time (a
+  bucket larger than that is built on its own), as each thread reads a whole
+  file into memory at a time.
+- The `Uploader` uploads up to `jobs` buckets at a time from a queue of at
+  most `jobs` buckets. When uploading can't keep up, packing blocks until
+  there's room in the queue (backpressure), which also bounds the disk space
+  used by buckets waiting to be uploaded.
+
+As before, the index is only committed once every bucket has been uploaded.
+With a `TransferJournal` (see `transfers.py`) the buckets that an
+interrupted upload already built or uploaded are reused.
+
+Each stage records how long it was busy and how long it was blocked on the
+queues around it (`StageStats`). They're printed at the end of the upload
+(`print_stats()`) -- the stage with the highest utilization is the
+bottleneck.
+"""
+
+DEFAULT_UPLOAD_JOBS = 4
+DEFAULT_BUILD_JOBS = 4
+DEFAULT_BUILD_MAX_INFLIGHT = 400 * 2**20  # 400 MiB
+
+
+class StageStats:
+    "Items, bytes and time spent busy or blocked of a stage with `workers` threads"
+
+    def __init__(self, name, unit, workers=1):
+        # type: (str, str, int) -> None
+        self.name = name
+        self.unit = unit
+        self.workers = workers
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items=0, num_bytes=0, busy=0.0, blocked=0.0):
+        # type: (int, int, float, float) -> None
+        with self._lock:
+            self.items += items
+            self.bytes += num_bytes
+            self.busy += busy
+            self.blocked += blocked
+        # Also as counters of `metrics.py`, e.g. `hash_files` and `hash_bytes`
+        if items:
+            count(f'{self.name}_{self.unit}', items)
+        if num_bytes:
+            count(f'{self.name}_bytes', num_bytes)
+
+
+def print_stats(stages, elapsed):
+    # type: (list[StageStats], float) -> None
+    "Print a line per stage with its utilization over `elapsed` seconds"
+    print(f'Pipeline ({elapsed:.2f}s):')
+    for stage in stages:
+        utilization = stage.busy / (elapsed * stage.workers) if elapsed else 0
+        threads = f', {stage.workers} threads' if stage.workers > 1 else ''
+        print(
+            f'  {stage.name:<7} {stage.items:>7} {stage.unit:<8} {pp_file_size(stage.bytes):>11}'
+            f'  busy {stage.busy:7.2f}s ({utilization:4.0%}{threads})'
+            f'  blocked {stage.blocked:7.2f}s'
+        )
+
+
+def _timed(iterable, stats):
+    # type: (Iterable[T], StageStats) -> Iterator[T]
+    "Count the time spent producing each item of `iterable` as busy time of `stats`"
+    it = iter(iterable)
+    while True:
+        t_begin = time.perf_counter()
+        item = next(it, None)
+        stats.add(busy=time.perf_counter() - t_begin)
+        if item is None:
+            return
+        stats.add(items=1)
+        yield item
+
+
+def hash_entries(
+    entries,
+    base_path,
+    jobs,
+    walk_stats,
+    hash_stats,
+    read_order='walk',
+    drop_cache=False,
+):
+    # type: (Iterable[DirEntry], str, int, StageStats, StageStats, str, bool) -> Iterator[DirEntry]
+    """Fill in `file_hash` of `entries` (walked from `base_path`), keeping their order
+
+    The files are hashed in windows of `READ_WINDOW` files in `read_order`
+    (see `read_order.py`) -- or `2 * jobs` files in walk order -- and a
+    window is hashed while the one before it is consumed.
+    """
+    window = 2 * jobs if read_order == 'walk' else READ_WINDOW
+
+    def _hash(entry):
+        t_begin = time.perf_counter()
+        path = base_path + entry.file_path
+        entry = entry._replace(file_hash=file_hash(path))
+        if drop_cache:
+            drop_cached(path)
+        hash_stats.add(
+            items=1, num_bytes=entry.file_size or 0, busy=time.perf_counter() - t_begin
+        )
+        return entry
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Futures in walk order
+        pending = deque()
+
+        def _submit(batch):
+            paths = [base_path + entry.file_path for entry in batch]
+            order = sort_for_reading(paths, read_order)
+            if read_order != 'walk':
+                prefetch([paths[i] for i in order], [batch[i].file_size for i in order])
+            futures = [None] * len(batch)
+            for i in order:
+                futures[i] = executor.submit(_hash, batch[i])
+            pending.extend(futures)
+
+        batch = []
+        for entry in _timed(entries, walk_stats):
+            batch.append(entry)
+            if len(batch) >= window:
+                _submit(batch)
+                batch = []
+            while len(pending) > window:
+                yield pending.popleft().result()
+        if batch:
+            _submit(batch)
+        while pending:
+            yield pending.popleft().result()
+
+
+class BucketBuilder:
+    """Builds buckets with `build_bucket()` in `jobs` threads
+
+    `submit()` blocks while `max_inflight` bytes of buckets are being built
+    and returns a future of the index entries and checksums (see
+    `verify.bucket_checksums()`) of the bucket.
+
+    With `journal` a bucket that is still in the working directory with the
+    checksums recorded by an earlier run isn't built again.
+    """
+
+    def __init__(
+        self,
+        dir,
+        jobs,
+        max_inflight,
+        checksum_block_size,
+        stats,
+        read_order='walk',
+        drop_cache=False,
+        journal=None,
+    ):
+        # type: (str, int, int, int, StageStats, str, bool, TransferJournal | None) -> None
+        self.dir = dir
+        self.journal = journal
+        self.read_order = read_order
+        self.drop_cache = drop_cache
+        self.max_inflight = max_inflight
+        self.checksum_block_size = checksum_block_size
+        self.stats = stats
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self._inflight = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.executor.shutdown()
+
+    def submit(self, bucket_name, bucket_file_list, size, submit_stats):
+        # type: (str, list[DirEntry], int, StageStats) -> Future[tuple[list, tuple[str, list[str]]]]
+        t_begin = time.perf_counter()
+        with self._condition:
+            self._condition.wait_for(
+                lambda: (
+                    self._inflight == 0 or self._inflight + size <= self.max_inflight
+                )
+            )
+            self._inflight += size
+        submit_stats.add(blocked=time.perf_counter() - t_begin)
+        return self.executor.submit(self._build, bucket_name, bucket_file_list, size)
+
+    def _build(self, bucket_name, bucket_file_list, size):
+        t_begin = time.perf_counter()
+        try:
+            built = self._built(bucket_name)
+            if built is not None:
+                db_entries, checksums = built
+            else:
+                db_entries = build_bucket(
+                    self.dir,
+                    bucket_name,
+                    bucket_file_list,
+                    show_progress=False,
+                    read_order=self.read_order,
+                    drop_cache=self.drop_cache,
+                )
+                checksums = bucket_checksums(
+                    f'{bucket_name}.bitumen', self.checksum_block_size
+                )
+                if self.journal is not None:
+                    self.journal.set_built(bucket_name, db_entries, checksums)
+        finally:
+            with self._condition:
+                self._inflight -= size
+                self._condition.notify_all()
+        self.stats.add(items=1, num_bytes=size, busy=time.perf_counter() - t_begin)
+        return db_entries, checksums
+
+    def _built(self, bucket_name):
+        # type: (str) -> tuple[list, tuple[str, list[str]]] | None
+        "The index entries and checksums of the bucket if an earlier run built it"
+        built = None if self.journal is None else self.journal.built(bucket_name)
+        filename = f'{bucket_name}.bitumen'
+        if built is None or not os.path.exists(filename):
+            return None
+        if bucket_checksums(filename, self.checksum_block_size) != built[1]:
+            return None
+        return built
+
+
+# Errors of a single upload -- the other buckets are still uploaded
+UPLOAD_ERRORS = (
+    OSError,
+    sqlite3.Error,
+    botocore.exceptions.BotoCoreError,
+    botocore.exceptions.ClientError,
+)
+
+
+class Uploader:
+    """Uploads `.bitumen`-files to `prefix` in `bucket` with `jobs` threads
+
+    `submit()` blocks while `jobs` buckets are waiting to be uploaded. Leaving
+    the `with`-block waits for all uploads, and raises the first error of any
+    of them.
+
+    With `journal` buckets are uploaded with `transfers.upload_file()`, and
+    a bucket that an earlier run uploaded isn't uploaded again.
+    """
+
+    def __init__(self, s3_client, bucket, prefix, jobs, stats, journal=None):
+        # type: (S3Client, str, str, int, StageStats, TransferJournal | None) -> None
+        self.s3_client = s3_client
+        self.journal = journal
+        self.bucket = bucket
+        self.prefix = prefix
+        self.stats = stats
+        self.queue = queue.Queue(maxsize=jobs)
+        self.errors = []
+        self._aborted = False
+        self.threads = [threading.Thread(target=self._run) for _ in range(jobs)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_details):
+        if exc_type is not None:
+            # Skip the uploads that haven't started
+            self._aborted = True
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if exc_type is None and self.errors:
+            raise self.errors[0]
+
+    def submit(self, bucket_name, submit_stats):
+        # type: (str, StageStats) -> None
+        "Queue `<bucket_name>.bitumen` for upload -- blocked time counts for `submit_stats`"
+        t_begin = time.perf_counter()
+        self.queue.put(bucket_name)
+        submit_stats.add(blocked=time.perf_counter() - t_begin)
+
+    def _run(self):
+        try:
+            self._upload_queued()
+        except BaseException as err:
+            # Not a failed upload but a bug -- recorded for `__exit__`, and the
+            # queue is drained so that `submit()` and `__exit__` don't wait on
+            # this thread
+            self.errors.append(err)
+            self._aborted = True
+            while self.queue.get() is not None:
+                pass
+            raise
+
+    def _upload_queued(self):
+        while True:
+            t_begin = time.perf_counter()
+            bucket_name = self.queue.get()
+            self.stats.add(blocked=time.perf_counter() - t_begin)
+            if bucket_name is None:
+                return
+            if self.errors or self._aborted:
+                continue
+
+            filename = f'{bucket_name}.bitumen'
+            t_begin = time.perf_counter()
+            try:
+                if self.journal is None:
+                    with open(filename, 'rb') as f_bitumen:
+                        self.s3_client.upload_fileobj(
+                            f_bitumen, self.bucket, f'{self.prefix}{filename}'
+                        )
+                elif not self._is_uploaded(bucket_name):
+                    # The checksum of the bucket identifies its contents
+                    _, (bucket_hash, _) = self.journal.built(bucket_name)
+                    etag = upload_file(
+                        self.s3_client,
+                        self.bucket,
+                        f'{self.prefix}{filename}',
+                        filename,
+                        self.journal,
+                        bucket_hash,
+                    )
+                    self.journal.set_uploaded(bucket_name, etag)
+            except UPLOAD_ERRORS as err:
+                self.errors.append(err)
+                continue
+            self.stats.add(
+                items=1,
+                num_bytes=os.path.getsize(filename),
+                busy=time.perf_counter() - t_begin,
+            )
+
+    def _is_uploaded(self, bucket_name):
+        # type: (str) -> bool
+        "Whether an earlier run uploaded the bucket and it hasn't changed since"
+        etag = self.journal.uploaded_etag(bucket_name)
+        if etag is None:
+            return False
+        try:
+            response = self.s3_client.head_object(
+                Bucket=self.bucket, Key=f'{self.prefix}{bucket_name}.bitumen'
+            )
+        except self.s3_client.exceptions.ClientError:
+            return False
+        return response['ETag'] == etag
@@ -0,0 +1,242 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from metrics import count
+from utils import cache_root, pp_file_size
+
+"""
+Cache of downloaded ranges
+--------------------------
+
+Partial restores (`download`, `debug extract-single-file --bucket`,
+`archive.RemoteArchive`) often fetch the same bytes again and again -- e.g. CI
+jobs restoring the same dependencies. `RangeCache` keeps what was fetched in
+`CACHE_PATH/ranges/`, keyed by either:
+
+- `file_key(file_hash)` -- the contents of a file by its hash, so the same
+  file is found no matter which bucket or backup it's restored from. Files
+  are checked against the hash as they're copied into the cache, and
+  against their size when they're used.
+- `range_key(etag, offset, size)` -- a range of an object at a given `ETag`.
+
+The cache is bounded to `max_size` bytes by evicting the least recently used
+entries. Entries larger than a quarter of `max_size` aren't cached, so a
+single large file can't flush everything else. The bookkeeping is a small
+SQLite database next to the entries, so several processes can share the
+cache. Its changes are committed in batches of `COMMIT_BATCH_SIZE` (and on
+`close()`) -- a commit per file would cost more than restoring a small file.
+
+The cache is opt-in (`--cache-size`): it only pays off when the same files
+are restored repeatedly over a slow link, and it's never used for backups in
+a local directory (see `storage.py`).
+"""
+
+DEFAULT_CACHE_SIZE = 2**30  # 1 GiB
+CACHE_DIRNAME = 'ranges'
+COMMIT_BATCH_SIZE = 1000
+COPY_CHUNK_SIZE = 2**20  # 1 MiB
+
+
+def file_key(file_hash):
+    # type: (str) -> str
+    return f'file:{file_hash}'
+
+
+def range_key(etag, offset, size):
+    # type: (str, int, int) -> str
+    return f'range:{etag.strip(chr(34))}:{offset}:{size}'
+
+
+class RangeCache:
+    "Size-bounded LRU-cache of downloaded files and ranges on disk (see above)"
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, cache_dir=None):
+        # type: (int, str | None) -> None
+        self.max_size = max_size
+        self.cache_dir = cache_dir or os.path.join(cache_root(), CACHE_DIRNAME)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.con = sqlite3.connect(
+            os.path.join(self.cache_dir, 'ranges.sqlite3'), timeout=30
+        )
+        self.con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries(
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used);
+            """
+        )
+        # Only recomputed when it seems to exceed `max_size` -- other
+        # processes can add and evict entries meanwhile
+        (self.total_size,) = self.con.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries'
+        ).fetchone()
+        self._num_uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+    def _changed(self):
+        "Commit the changes once there's a batch of them"
+        self._num_uncommitted += 1
+        if self._num_uncommitted >= COMMIT_BATCH_SIZE:
+            self.con.commit()
+            self._num_uncommitted = 0
+
+    def _path(self, key):
+        # type: (str) -> str
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _lookup(self, key):
+        # type: (str) -> str | None
+        """Path of the entry for `key` (and mark it as used) -- `None` if
+        there's none, or its file is missing or has the wrong size"""
+        row = self.con.execute(
+            'SELECT size FROM entries WHERE key = ?', [key]
+        ).fetchone()
+        path = self._path(key)
+        if row is None:
+            return None
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            size = None
+        if size != row[0]:
+            self._remove(key)
+            return None
+        self.con.execute(
+            'UPDATE entries SET last_used = ? WHERE key = ?', [time.time(), key]
+        )
+        self._changed()
+        return path
+
+    def _remove(self, key):
+        # type: (str) -> None
+        self.con.execute('DELETE FROM entries WHERE key = ?', [key])
+        self._changed()
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        # type: (str) -> bytes | None
+        path = self._lookup(key)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.record_hit(len(data))
+        return data
+
+    def get_file(self, key, target_path):
+        # type: (str, str) -> bool
+        "Copy the entry for `key` to `target_path` -- returns whether there was one"
+        path = self._lookup(key)
+        if path is None:
+            return False
+        shutil.copyfile(path, target_path)
+        self.record_hit(os.path.getsize(path))
+        return True
+
+    def record_hit(self, size):
+        self.hits += 1
+        self.hit_bytes += size
+        count('cache_hits')
+        count('cache_hit_bytes', size)
+
+    def record_miss(self, size):
+        "Count bytes that had to be downloaded"
+        self.misses += 1
+        self.miss_bytes += size
+        count('cache_misses')
+        count('cache_miss_bytes', size)
+
+    def _add(self, key, write):
+        # type: (str, Callable[[BinaryIO], int | None]) -> None
+        "Add the entry `write(f)` writes -- unless it returns `None`"
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first, so other processes never see a
+        # partial entry
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+            size = write(f)
+        if size is None:
+            os.remove(f.name)
+            return
+        os.replace(f.name, path)
+        self.con.execute(
+            'INSERT OR REPLACE INTO entries VALUES(?, ?, ?)',
+            [key, size, time.time()],
+        )
+        self._changed()
+        self.total_size += size
+        if self.total_size > self.max_size:
+            self._evict()
+
+    def put(self, key, data):
+        # type: (str, bytes) -> None
+        if len(data) <= self.max_size // 4:
+            self._add(key, lambda f: f.write(data))
+
+    def put_file(self, key, source_path, expected_hash=None):
+        # type: (str, str, str | None) -> None
+        "Add a copy of `source_path` -- with `expected_hash` only if it has that hash"
+        if os.path.getsize(source_path) > self.max_size // 4:
+            return
+
+        def _write(f):
+            h = hashlib.blake2b()
+            with open(source_path, 'rb') as f_source:
+                while True:
+                    chunk = f_source.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    f.write(chunk)
+            if expected_hash is not None and h.hexdigest() != expected_hash:
+                return None
+            return f.tell()
+
+        self._add(key, _write)
+
+    def _evict(self):
+        # Least recently used first
+        (self.total_size,) = self.con.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries'
+        ).fetchone()
+        if self.total_size <= self.max_size:
+            return
+        rows = self.con.execute(
+            'SELECT key, size FROM entries ORDER BY last_used'
+        ).fetchall()
+        for key, size in rows:
+            if self.total_size <= self.max_size:
+                break
+            self._remove(key)
+            self.total_size -= size
+
+    def summary(self):
+        # type: () -> str
+        return (
+            f'Cache: {self.hits} hits ({pp_file_size(self.hit_bytes)}), '
+            f'{self.misses} misses ({pp_file_size(self.miss_bytes)})'
+        )
@@ -0,0 +1,137 @@
+import fcntl
+import os
+import struct
+import sys
+
+"""
+Read order
+----------
+
+Files are read in index order when they're hashed and packed, which is
+effectively random on disk. For many small files on a spinning disk (or a
+cold page cache on ext4) seeks and metadata lookups then dominate. So reads
+are scheduled in windows of `READ_WINDOW` files, and within a window sorted
+by `read_order`:
+
+- `walk` -- index order, i.e. as before
+- `inode` -- by inode number. Filesystems like ext4 allocate the inodes and
+  data blocks of files created together close to each other, so this is
+  close to the order on disk, and it only needs a `stat()`.
+- `physical` -- by the physical offset of the first extent of each file
+  (`FIEMAP`, Linux only). Falls back to the inode number where `FIEMAP`
+  isn't supported (e.g. tmpfs) or the file has no extents.
+
+The order of the files in the index and in buckets doesn't change -- only
+the order in which they're read.
+
+With `prefetch()` the files of a window are also hinted to the kernel with
+`posix_fadvise(POSIX_FADV_WILLNEED)` in that order, so it can start reading
+them before they're needed. With `drop_cache` (`--drop-cache`) each file is
+hinted with `POSIX_FADV_DONTNEED` once it's been read, so that a backup
+doesn't evict the page cache of the other processes on the machine. The
+hints are skipped where `posix_fadvise()` doesn't exist (e.g. macOS).
+"""
+
+READ_ORDERS = ['walk', 'inode', 'physical']
+DEFAULT_READ_ORDER = 'inode'
+READ_WINDOW = 1024
+# Larger files aren't prefetched -- `WILLNEED` reads the whole file
+PREFETCH_MAX_SIZE = 2**20  # 1 MiB
+PREFETCH_MAX_BYTES = 64 * 2**20  # 64 MiB per window
+
+# `_IOWR('f', 11, struct fiemap)` from `linux/fs.h`
+FS_IOC_FIEMAP = 0xC020660B
+# `struct fiemap` without extents and `struct fiemap_extent`
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')
+
+
+def _fiemap_offset(fd):
+    # type: (int) -> int | None
+    "Physical offset of the first extent of the file `fd` -- `None` if unknown"
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    # Without `FIEMAP_FLAG_SYNC`, as that would flush every file -- data
+    # that isn't written yet is in the page cache anyway
+    FIEMAP_HEADER.pack_into(request, 0, 0, 2**64 - 1, 0, 0, 1, 0)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    num_extents = FIEMAP_HEADER.unpack_from(request)[3]
+    if num_extents == 0:
+        return None
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+def read_key(path, read_order):
+    # type: (str, str) -> tuple[int, int]
+    "Sort key for reading `path` in `read_order` (see above)"
+    try:
+        if read_order == 'physical' and sys.platform == 'linux':
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                offset = _fiemap_offset(fd)
+                if offset is not None:
+                    return (0, offset)
+                return (1, os.fstat(fd).st_ino)
+            finally:
+                os.close(fd)
+        return (1, os.stat(path).st_ino)
+    except OSError:
+        # Fails when the file is read instead
+        return (2, 0)
+
+
+def sort_for_reading(paths, read_order):
+    # type: (list[str], str) -> list[int]
+    "Indexes of `paths` in the order they should be read in"
+    if read_order == 'walk':
+        return list(range(len(paths)))
+    keys = [read_key(path, read_order) for path in paths]
+    return sorted(range(len(paths)), key=keys.__getitem__)
+
+
+def prefetch(paths, sizes):
+    # type: (list[str], list[int | None]) -> None
+    "Hint the kernel to start reading `paths` (in that order) -- up to `PREFETCH_MAX_BYTES`"
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    num_bytes = 0
+    for path, size in zip(paths, sizes):
+        if size is None or size == 0 or size > PREFETCH_MAX_SIZE:
+            continue
+        num_bytes += size
+        if num_bytes > PREFETCH_MAX_BYTES:
+            break
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def prefetch_window(paths, sizes, read_order):
+    # type: (list[str], list[int | None], str) -> None
+    "`prefetch()` a window of files in `read_order`"
+    if read_order == 'walk':
+        return
+    order = sort_for_reading(paths, read_order)
+    prefetch([paths[i] for i in order], [sizes[i] for i in order])
+
+
+def drop_cached(path):
+    # type: (str) -> None
+    "Hint the kernel that the pages of `path` won't be needed again"
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
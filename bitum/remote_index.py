@@ -0,0 +1,668 @@
+import bz2
+from collections import OrderedDict
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import secrets
+import shutil
+import struct
+import tempfile
+import zlib
+
+from constants import DATABASE_FILENAME
+from index import SCHEMA_VERSION, Index, IndexRow, sort_key
+from sqlite_reader import SQLiteReader
+from utils import TimedMessage, cache_root, pp_file_size
+
+"""
+Transferring the index
+----------------------
+
+The index compresses well (paths share prefixes and only use a fraction of the
+byte range), so it is uploaded compressed. The compression format is stored in
+the object's metadata (`x-amz-meta-compression`), and indexes without it are
+read as uncompressed -- which is how older versions of bitum uploaded them.
+
+The gzip-stream is made up of independent gzip-members, one per
+`INDEX_BLOCK_SIZE` bytes of the index (like BGZF). It's still a valid
+gzip-file, but each block can also be fetched and decompressed on its own.
+The compressed offsets of the blocks are stored in empty gzip-members at the
+end of the stream (in the `BT` "extra" field of their headers), and the
+offset of the first of these is stored in the object metadata
+(`x-amz-meta-block-table`).
+
+This lets `RemoteIndex` look up single rows with a few HTTP Range requests
+instead of downloading the whole index (see `sqlite_reader.py`).
+
+Delta sync
+----------
+
+Rather than round-tripping the whole index on every `upload`, each upload
+writes a small delta with the rows it changed:
+
+    <prefix>bitumen.sqlite3                                  base index
+    <prefix>bitumen.deltas/<index_id>/<delta_seq>.ndjson.gz  deltas
+
+Clients keep a copy of the index per remote in `CACHE_PATH` and apply the
+deltas they haven't seen yet (`sync_index()`). The `meta`-table of an index
+records `index_id`, `delta_seq` (the last delta applied) and `base_seq` (the
+last delta folded into the base). The base also has `index_id` and
+`delta_seq` in its object metadata, so it can be checked with a `HEAD`.
+
+Every `CHECKPOINT_INTERVAL` deltas the full index is uploaded as a new base.
+Deltas are kept for another interval after they've been folded into the base,
+so clients that are slightly behind don't have to download the new base.
+
+`index_id` is generated whenever a new index is uploaded as a whole (a new
+backup or `debug upload-all`), so deltas are never applied to the wrong index.
+"""
+
+INDEX_COMPRESSION = 'gzip'
+METADATA_COMPRESSION = 'compression'
+METADATA_UNCOMPRESSED_SIZE = 'uncompressed-size'
+METADATA_INDEX_ID = 'index-id'
+METADATA_DELTA_SEQ = 'delta-seq'
+METADATA_BLOCK_TABLE = 'block-table'
+METADATA_BLOCK_SIZE = 'block-size'
+
+INDEX_BLOCK_SIZE = 2**16  # 64 KiB
+# Blocks kept in memory by `RemoteIndex`
+INDEX_BLOCK_CACHE_SIZE = 256
+# Block offsets per gzip-member in the block table (the "extra" field of a
+# gzip-header is at most 64 KiB)
+BLOCK_TABLE_MEMBER_OFFSETS = 8000
+
+DELTAS_DIRNAME = 'bitumen.deltas'
+CHECKPOINT_INTERVAL = 16
+
+CHUNK_SIZE = 2**16  # 64 KiB
+
+
+class _GzipDecompressor:
+    "Decompresses gzip-streams, which may consist of several gzip-members"
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(wbits=31)
+
+    def decompress(self, data):
+        result = b''
+        while data:
+            result += self._decompressor.decompress(data)
+            if not self._decompressor.eof:
+                break
+            # Start of the next member
+            data = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(wbits=31)
+        return result
+
+
+DECOMPRESSORS = {
+    'gzip': _GzipDecompressor,
+    'bz2': bz2.BZ2Decompressor,
+    'lzma': lzma.LZMADecompressor,
+}
+
+
+def _gzip_compress(data):
+    # type: (bytes) -> bytes
+    "`gzip.compress()` with `mtime=0`, which makes the output deterministic"
+    # `gzip.compress()` only takes `mtime` from Python 3.8
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _block_table_member(offsets):
+    # type: (list[int]) -> bytes
+    "An empty gzip-member with `offsets` in the `BT` extra field of its header"
+    extra_data = struct.pack(f'<{len(offsets)}Q', *offsets)
+    extra = b'BT' + struct.pack('<H', len(extra_data)) + extra_data
+    return (
+        # Magic, deflate, FEXTRA, mtime=0, no extra flags, unknown OS
+        b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff'
+        + struct.pack('<H', len(extra))
+        + extra
+        # An empty deflate-stream, CRC32 and size of the (empty) contents
+        + b'\x03\x00'
+        + b'\x00' * 8
+    )
+
+
+def _parse_block_table(data):
+    # type: (bytes) -> list[int]
+    "Block offsets from the gzip-members written by `_block_table_member()`"
+    offsets = []
+    pos = 0
+    while pos < len(data):
+        if data[pos : pos + 4] != b'\x1f\x8b\x08\x04':
+            raise ValueError('Invalid block table in index')
+        (extra_size,) = struct.unpack('<H', data[pos + 10 : pos + 12])
+        extra = data[pos + 12 : pos + 12 + extra_size]
+        if extra[:2] != b'BT':
+            raise ValueError('Invalid block table in index')
+        offsets += struct.unpack(f'<{(len(extra) - 4) // 8}Q', extra[4:])
+        pos += 12 + extra_size + 10
+    return offsets
+
+
+def upload_index(s3_client, bucket, s3_path, db_filepath, metadata=None):
+    # type: (S3Client, str, str, str, dict[str, str] | None) -> None
+    "Upload the index at `db_filepath` compressed to `s3_path`"
+    with tempfile.TemporaryFile() as f_compressed:
+        offsets = []
+        with open(db_filepath, 'rb') as f_db:
+            while True:
+                block = f_db.read(INDEX_BLOCK_SIZE)
+                if not block:
+                    break
+                offsets.append(f_compressed.tell())
+                f_compressed.write(_gzip_compress(block))
+        block_table_offset = f_compressed.tell()
+        offsets.append(block_table_offset)
+        for i in range(0, len(offsets), BLOCK_TABLE_MEMBER_OFFSETS):
+            f_compressed.write(
+                _block_table_member(offsets[i : i + BLOCK_TABLE_MEMBER_OFFSETS])
+            )
+        compressed_size = f_compressed.tell()
+        f_compressed.seek(0)
+
+        with TimedMessage(
+            f'Uploading "{s3_path}" ({pp_file_size(compressed_size)} {INDEX_COMPRESSION})...'
+        ):
+            s3_client.upload_fileobj(
+                f_compressed,
+                bucket,
+                s3_path,
+                ExtraArgs={
+                    'Metadata': {
+                        **(metadata or {}),
+                        METADATA_COMPRESSION: INDEX_COMPRESSION,
+                        METADATA_UNCOMPRESSED_SIZE: str(os.path.getsize(db_filepath)),
+                        METADATA_BLOCK_TABLE: str(block_table_offset),
+                        METADATA_BLOCK_SIZE: str(INDEX_BLOCK_SIZE),
+                    }
+                },
+            )
+
+
+def index_size(head_response):
+    # type: (dict) -> int
+    "Uncompressed size of the index from the response of a `head_object()`"
+    metadata = head_response.get('Metadata', {})
+    if METADATA_UNCOMPRESSED_SIZE in metadata:
+        return int(metadata[METADATA_UNCOMPRESSED_SIZE])
+    return int(head_response['ContentLength'])
+
+
+def download_index(s3_client, bucket, s3_path, db_filepath):
+    # type: (S3Client, str, str, str) -> str
+    """Download the index at `s3_path` to `db_filepath` decompressing it on the fly
+
+    Returns the `ETag` of the downloaded index.
+    """
+    with TimedMessage(f'Downloading "{s3_path}"...'):
+        response = s3_client.get_object(Bucket=bucket, Key=s3_path)
+        compression = response.get('Metadata', {}).get(METADATA_COMPRESSION)
+        if compression is not None and compression not in DECOMPRESSORS:
+            raise ValueError(
+                f'Index "{s3_path}" is compressed with unsupported format "{compression}"'
+            )
+        decompressor = DECOMPRESSORS[compression]() if compression else None
+
+        body = response['Body']
+        with open(db_filepath, 'wb') as f_db:
+            while True:
+                data = body.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if decompressor:
+                    data = decompressor.decompress(data)
+                f_db.write(data)
+
+    return response['ETag']
+
+
+def index_cache_dir(s3_client, bucket, prefix):
+    # type: (S3Client, str, str) -> str
+    "Directory for cached files of the backup at `prefix` in `bucket`"
+    remote = f'{s3_client.meta.endpoint_url}|{bucket}|{prefix}'
+    cache_dir = os.path.join(
+        cache_root(), hashlib.sha256(remote.encode()).hexdigest()[:16]
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _delta_dir(prefix, index_id):
+    return f'{prefix}{DELTAS_DIRNAME}/{index_id}/'
+
+
+def _delta_key(prefix, index_id, delta_seq):
+    return f'{_delta_dir(prefix, index_id)}{delta_seq:010}.ndjson.gz'
+
+
+def _list_deltas(s3_client, bucket, prefix, index_id, after_seq):
+    # type: (S3Client, str, str, str, int) -> list[tuple[int, str]]
+    "`(delta_seq, s3_path)` of the deltas of `index_id` after `after_seq`"
+    delta_dir = _delta_dir(prefix, index_id)
+    deltas = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(
+        Bucket=bucket,
+        Prefix=delta_dir,
+        StartAfter=_delta_key(prefix, index_id, after_seq),
+    ):
+        for obj in page.get('Contents', []):
+            filename = obj['Key'][len(delta_dir) :]
+            deltas.append((int(filename.split('.')[0]), obj['Key']))
+    return deltas
+
+
+def _head(s3_client, bucket, s3_path):
+    # type: (S3Client, str, str) -> dict | None
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=s3_path)
+    except s3_client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == '404':
+            return None
+        raise
+
+
+def _index_version(db_filepath):
+    # type: (str) -> tuple[str | None, int | None]
+    "`(index_id, delta_seq)` of a local index"
+    if not os.path.exists(db_filepath):
+        return None, None
+    with Index(db_filepath) as index:
+        return index.get_meta('index_id'), index.get_meta('delta_seq')
+
+
+def _cached_etag(cache_filepath):
+    # type: (str) -> str | None
+    "`ETag` of the remote index that the cached index was downloaded or uploaded as"
+    try:
+        with open(f'{cache_filepath}.etag') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _set_cached_etag(cache_filepath, etag):
+    # type: (str, str | None) -> None
+    etag_filepath = f'{cache_filepath}.etag'
+    if etag is None:
+        if os.path.exists(etag_filepath):
+            os.remove(etag_filepath)
+        return
+    with open(f'{etag_filepath}.tmp', 'w') as f:
+        f.write(etag)
+    os.replace(f'{etag_filepath}.tmp', etag_filepath)
+
+
+def _download_base(s3_client, bucket, s3_path, cache_filepath):
+    # type: (S3Client, str, str, str) -> None
+    # Forget the `ETag` first, so that a crash can't leave a stale pair behind
+    _set_cached_etag(cache_filepath, None)
+    etag = download_index(s3_client, bucket, s3_path, f'{cache_filepath}.tmp')
+    os.replace(f'{cache_filepath}.tmp', cache_filepath)
+    _set_cached_etag(cache_filepath, etag)
+
+
+def _replace_file(source_filepath, target_filepath):
+    "Copy `source_filepath` over `target_filepath` so that it's never half-written"
+    tmp_filepath = f'{target_filepath}.tmp'
+    shutil.copyfile(source_filepath, tmp_filepath)
+    os.replace(tmp_filepath, target_filepath)
+
+
+def _apply_delta(index, s3_client, bucket, s3_path, delta_seq):
+    # type: (Index, S3Client, str, str, int) -> None
+    response = s3_client.get_object(Bucket=bucket, Key=s3_path)
+    puts = []
+    for line in gzip.decompress(response['Body'].read()).splitlines():
+        change = json.loads(line)
+        if change['op'] == 'put':
+            puts.append(tuple(change['row']))
+        elif change['op'] == 'delete':
+            index.insert(puts)
+            puts = []
+            index.delete([change['file_path']])
+        elif change['op'] == 'checksums':
+            index.set_checksums(change['bucket'], change['hash'], change['blocks'])
+    index.insert(puts)
+    index.set_meta('delta_seq', delta_seq)
+    index.commit()
+
+
+def sync_index(s3_client, bucket, prefix):
+    # type: (S3Client, str, str) -> str | None
+    """Bring the cached copy of the remote index up-to-date
+
+    Returns the path of the cached index, or `None` if there's no index at
+    `prefix`. The cached index must not be modified -- make a copy.
+
+    The base index is only downloaded if its `ETag` differs from the one the
+    cached copy was downloaded (or uploaded) as and the cached copy can't be
+    brought up-to-date with deltas.
+    """
+    s3_path = f'{prefix}{DATABASE_FILENAME}'
+    head = _head(s3_client, bucket, s3_path)
+    if head is None:
+        return None
+
+    cache_filepath = os.path.join(
+        index_cache_dir(s3_client, bucket, prefix), DATABASE_FILENAME
+    )
+    metadata = head.get('Metadata', {})
+    index_id = metadata.get(METADATA_INDEX_ID)
+    base_seq = int(metadata.get(METADATA_DELTA_SEQ, 0))
+    local_index_id, local_seq = _index_version(cache_filepath)
+    is_base_cached = (
+        os.path.exists(cache_filepath) and _cached_etag(cache_filepath) == head['ETag']
+    )
+
+    if index_id is None:
+        # Uploaded by an older version of bitum -- there are no deltas
+        if not is_base_cached:
+            _download_base(s3_client, bucket, s3_path, cache_filepath)
+        return cache_filepath
+
+    if local_index_id == index_id and local_seq is not None:
+        deltas = _list_deltas(
+            s3_client, bucket, prefix, index_id, min(local_seq, base_seq)
+        )
+        seqs = [delta_seq for delta_seq, _ in deltas]
+        # The deltas since our copy must all still be there
+        is_usable = local_seq >= base_seq or (seqs and seqs[0] == local_seq + 1)
+    else:
+        is_usable = False
+
+    if not is_usable:
+        _download_base(s3_client, bucket, s3_path, cache_filepath)
+        local_seq = base_seq
+        deltas = _list_deltas(s3_client, bucket, prefix, index_id, base_seq)
+
+    deltas = [(delta_seq, key) for delta_seq, key in deltas if delta_seq > local_seq]
+    if deltas:
+        with TimedMessage(f'Applying {len(deltas)} index deltas...'):
+            with Index(cache_filepath, writable=True) as index:
+                for delta_seq, key in deltas:
+                    if delta_seq != local_seq + 1:
+                        raise ValueError(
+                            f'Index delta {local_seq + 1} is missing in "{_delta_dir(prefix, index_id)}"'
+                        )
+                    _apply_delta(index, s3_client, bucket, key, delta_seq)
+                    local_seq = delta_seq
+
+    return cache_filepath
+
+
+def _upload_delta(s3_client, bucket, s3_path, changes):
+    # type: (S3Client, str, str, list[tuple[str, object]]) -> None
+    lines = []
+    for op, change in changes:
+        if op == 'put':
+            lines.append(json.dumps({'op': op, 'row': change}))
+        elif op == 'delete':
+            lines.append(json.dumps({'op': op, 'file_path': change}))
+        elif op == 'checksums':
+            bucket_name, bucket_hash, block_hashes = change
+            lines.append(
+                json.dumps(
+                    {
+                        'op': op,
+                        'bucket': bucket_name,
+                        'hash': bucket_hash,
+                        'blocks': block_hashes,
+                    }
+                )
+            )
+    data = _gzip_compress('\n'.join(lines).encode())
+    with TimedMessage(
+        f'Uploading "{s3_path}" ({len(changes)} changes, {pp_file_size(len(data))})...'
+    ):
+        s3_client.put_object(Bucket=bucket, Key=s3_path, Body=data)
+
+
+def _prune_deltas(s3_client, bucket, prefix, index_id, base_seq):
+    "Delete deltas of other indexes and deltas folded into the base long ago"
+    deltas_dir = f'{prefix}{DELTAS_DIRNAME}/'
+    stale_keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=deltas_dir):
+        for obj in page.get('Contents', []):
+            delta_index_id, _, filename = obj['Key'][len(deltas_dir) :].partition('/')
+            delta_seq = int(filename.split('.')[0])
+            if (
+                delta_index_id != index_id
+                or delta_seq <= base_seq - CHECKPOINT_INTERVAL
+            ):
+                stale_keys.append(obj['Key'])
+
+    # `delete_objects()` takes at most 1000 keys
+    for i in range(0, len(stale_keys), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in stale_keys[i : i + 1000]]},
+        )
+
+
+def commit_index(s3_client, bucket, prefix, db_filepath, changes, checkpoint=False):
+    # type: (S3Client, str, str, str, list[tuple[str, object]] | None, bool) -> None
+    """Publish the changes made to a copy of the index at `db_filepath`
+
+    `changes` is `Index.changes` of the copy. They're uploaded as the next
+    delta and, if `checkpoint` is set or it's time to, the whole index is
+    uploaded as a new base. If `changes` is `None` the index is uploaded as
+    a new index (new `index_id`). Finally the cached copy of the index is
+    replaced by `db_filepath`.
+    """
+    with Index(db_filepath, writable=True) as index:
+        index_id = index.get_meta('index_id')
+        if changes is None or index_id is None:
+            index_id = secrets.token_hex(8)
+            delta_seq = 0
+            checkpoint = True
+            index.set_meta('index_id', index_id)
+        else:
+            delta_seq = index.get_meta('delta_seq', 0) + 1
+            base_seq = index.get_meta('base_seq', 0)
+            checkpoint = checkpoint or delta_seq - base_seq >= CHECKPOINT_INTERVAL
+        index.set_meta('delta_seq', delta_seq)
+        if checkpoint:
+            index.set_meta('base_seq', delta_seq)
+
+    if delta_seq > 0:
+        _upload_delta(
+            s3_client, bucket, _delta_key(prefix, index_id, delta_seq), changes
+        )
+    if checkpoint:
+        upload_index(
+            s3_client,
+            bucket,
+            f'{prefix}{DATABASE_FILENAME}',
+            db_filepath,
+            metadata={
+                METADATA_INDEX_ID: index_id,
+                METADATA_DELTA_SEQ: str(delta_seq),
+            },
+        )
+        _prune_deltas(s3_client, bucket, prefix, index_id, delta_seq)
+
+    cache_filepath = os.path.join(
+        index_cache_dir(s3_client, bucket, prefix), DATABASE_FILENAME
+    )
+    if checkpoint:
+        # The base changed -- remember the new `ETag`, so the next sync
+        # doesn't download the index we just uploaded
+        _set_cached_etag(cache_filepath, None)
+        _replace_file(db_filepath, cache_filepath)
+        head = _head(s3_client, bucket, f'{prefix}{DATABASE_FILENAME}')
+        _set_cached_etag(cache_filepath, head['ETag'])
+    else:
+        _replace_file(db_filepath, cache_filepath)
+
+
+class _RangedIndexFile:
+    """Reads parts of the index at `s3_path` with HTTP Range requests
+
+    Works for indexes uploaded uncompressed and for compressed indexes with a
+    block table. Fetched blocks are kept in an LRU-cache, and all requests
+    are pinned to the `ETag` of the object, so a concurrent upload of the
+    index can't mix blocks of two versions. `num_requests` and `num_bytes`
+    count the requests and the (compressed) bytes fetched, and `size` is
+    the size of the whole (uncompressed) index.
+    """
+
+    def __init__(self, s3_client, bucket, s3_path, head):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.s3_path = s3_path
+        self.etag = head['ETag']
+        self.num_requests = 0
+        self.num_bytes = 0
+        self._blocks = OrderedDict()
+
+        metadata = head.get('Metadata', {})
+        compression = metadata.get(METADATA_COMPRESSION)
+        if compression is None:
+            self.block_size = INDEX_BLOCK_SIZE
+            self.offsets = None
+            self.size = int(head['ContentLength'])
+        elif compression == 'gzip' and METADATA_BLOCK_TABLE in metadata:
+            self.block_size = int(metadata[METADATA_BLOCK_SIZE])
+            self.offsets = _parse_block_table(
+                self._get(f'bytes={metadata[METADATA_BLOCK_TABLE]}-')
+            )
+            self.size = int(metadata[METADATA_UNCOMPRESSED_SIZE])
+        else:
+            raise ValueError(
+                f'Index "{s3_path}" can\'t be read in parts -- it has to be downloaded'
+            )
+
+    def _get(self, bytes_range):
+        # type: (str) -> bytes
+        self.num_requests += 1
+        response = self.s3_client.get_object(
+            Bucket=self.bucket, Key=self.s3_path, Range=bytes_range, IfMatch=self.etag
+        )
+        data = response['Body'].read()
+        self.num_bytes += len(data)
+        return data
+
+    def _block(self, i):
+        # type: (int) -> bytes
+        block = self._blocks.get(i)
+        if block is not None:
+            self._blocks.move_to_end(i)
+            return block
+
+        if self.offsets is None:
+            start = i * self.block_size
+            end = min(start + self.block_size, self.size)
+            block = self._get(f'bytes={start}-{end - 1}')
+        else:
+            data = self._get(f'bytes={self.offsets[i]}-{self.offsets[i + 1] - 1}')
+            block = gzip.decompress(data)
+
+        self._blocks[i] = block
+        if len(self._blocks) > INDEX_BLOCK_CACHE_SIZE:
+            self._blocks.popitem(last=False)
+        return block
+
+    def read(self, offset, size):
+        # type: (int, int) -> bytes
+        end = min(offset + size, self.size)
+        data = bytearray()
+        while offset < end:
+            i, block_offset = divmod(offset, self.block_size)
+            block = self._block(i)
+            data += block[block_offset : block_offset + end - offset]
+            offset = (i + 1) * self.block_size
+        return bytes(data)
+
+
+class RemoteIndex:
+    """Read-only access to the remote index without downloading it
+
+    Rows are looked up directly in the b-trees of the remote index with
+    HTTP Range requests (see `sqlite_reader.py`), so looking up a single file
+    only fetches a few blocks of the index. Deltas that haven't been folded
+    into the base index yet are downloaded and take precedence.
+
+    Raises `ValueError` if the index can't be read in parts (e.g. it was
+    uploaded by an older version of bitum) -- use `sync_index()` instead.
+    """
+
+    def __init__(self, s3_client, bucket, prefix):
+        s3_path = f'{prefix}{DATABASE_FILENAME}'
+        head = _head(s3_client, bucket, s3_path)
+        if head is None:
+            raise ValueError(f'No bitum DB was found at "s3://{bucket}/{s3_path}"')
+
+        self.file = _RangedIndexFile(s3_client, bucket, s3_path, head)
+        self.reader = SQLiteReader(self.file.read)
+        # Lookups only use `dirs.path`, `entries` and `buckets`, which are the
+        # same since version 2
+        if not 2 <= self.reader.user_version <= SCHEMA_VERSION:
+            raise ValueError(
+                f'Index "{s3_path}" has schema version {self.reader.user_version} (expected 2-{SCHEMA_VERSION})'
+            )
+
+        # Changes in deltas that aren't in the base yet -- the latest wins
+        self.pending = {}
+        metadata = head.get('Metadata', {})
+        index_id = metadata.get(METADATA_INDEX_ID)
+        if index_id is not None:
+            base_seq = int(metadata.get(METADATA_DELTA_SEQ, 0))
+            for _, key in _list_deltas(s3_client, bucket, prefix, index_id, base_seq):
+                response = s3_client.get_object(Bucket=bucket, Key=key)
+                for line in gzip.decompress(response['Body'].read()).splitlines():
+                    change = json.loads(line)
+                    if change['op'] == 'put':
+                        row = IndexRow(*change['row'])
+                        self.pending[row.file_path] = row
+                    elif change['op'] == 'delete':
+                        self.pending[change['file_path']] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def lookup(self, file_path):
+        # type: (str) -> IndexRow | None
+        if file_path in self.pending:
+            return self.pending[file_path]
+
+        dirname, name = sort_key(file_path)
+        reader = self.reader
+        # `dirs.path` is `UNIQUE`, so SQLite keeps an index of `(path, id)`
+        dir_record = reader.index_lookup(
+            reader.root_page('sqlite_autoindex_dirs_1'), (dirname,)
+        )
+        if dir_record is None:
+            return None
+        # `entries` is `WITHOUT ROWID`, i.e. a b-tree keyed by its primary key
+        entry = reader.index_lookup(reader.root_page('entries'), (dir_record[1], name))
+        if entry is None:
+            return None
+        _, _, bucket_id, byte_index, file_size, file_hash, file_perms = entry
+        # `buckets.id` is the rowid, so the column itself is stored as NULL.
+        # Rows written before a column was added are shorter, so only the
+        # name is picked
+        bucket = reader.table_lookup(reader.root_page('buckets'), bucket_id)[1]
+
+        return IndexRow(
+            bucket=bucket,
+            file_path=file_path,
+            byte_index=byte_index,
+            file_size=file_size,
+            file_hash=file_hash.hex() if file_hash is not None else None,
+            file_perms=file_perms,
+        )
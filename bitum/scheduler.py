@@ -0,0 +1,552 @@
+import heapq
+import io
+import itertools
+import math
+import os
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+from metrics import count
+
+"""
+Request scheduling
+------------------
+
+Object stores throttle clients that send too many requests at a time: S3
+answers with `503 SlowDown`, B2 and R2 with `429 Too Many Requests` or `503`.
+Every request of the S3 client (`utils.get_s3_client()`) goes through a
+`Scheduler` (`schedule()`), which replaces the retries of botocore:
+
+- At most `limit` requests are in flight at a time. The limit is adjusted
+  with AIMD (additive increase, multiplicative decrease) like TCP's
+  congestion window: it grows by one for every `limit` requests that
+  succeed, and halves when a request is throttled or takes more than
+  `LATENCY_FACTOR` times as long as the fastest request of its kind (same
+  operation and order of magnitude of bytes) has recently. The limit is
+  halved at most once per round of requests in flight, as the requests that
+  were sent before it was halved see the same congestion.
+- A request with a response body (`get_object()`) stays in flight until the
+  body has been read or closed, so the limit applies to the downloads
+  themselves. Their latency is measured to the end of the body, without the
+  time spent waiting for the download limit.
+- Throttled requests and transient errors (`500`, `502`, `504`, timeouts
+  and dropped connections) are retried up to `MAX_ATTEMPTS` times, with
+  exponential backoff with full jitter -- a random delay between 0 and
+  `BASE_BACKOFF * 2**attempt` (at most `MAX_BACKOFF`), or the `Retry-After`
+  of the response if that's longer (also at most `MAX_BACKOFF`). The jitter keeps the threads that were
+  throttled together from retrying together.
+- Other errors (e.g. `403 AccessDenied` or `404 NoSuchKey`) aren't retried.
+
+File objects in the request are rewound before a retry. The number of
+requests, retries and throttled requests are kept for `summary()`.
+
+Backups run next to production workloads, so the bytes sent and received
+can be limited (`--upload-limit`/`--download-limit` or `upload_limit`/
+`download_limit` in `config.ini`) with a `RateLimiter` for each direction --
+a token bucket shared by all the requests of the client. Request bodies are
+paced as they're sent (in `before-send`, so that botocore computing their
+checksums doesn't count) and response bodies as they're read. The limiters
+also count the bytes, for the rate achieved against the limit.
+
+When requests wait -- for a slot or for bandwidth -- they go in order of
+`request_priority()`: first the index (everything that isn't a
+`.bitumen`-file), then small reads and writes of `.bitumen`-files (e.g. the
+files of a partial restore), and last the bulk data of whole buckets.
+"""
+
+MAX_INFLIGHT = 64
+INITIAL_INFLIGHT = 8
+MAX_ATTEMPTS = 8
+BASE_BACKOFF = 0.1  # seconds
+MAX_BACKOFF = 20.0  # seconds
+LATENCY_FACTOR = 4
+# Requests faster than this are never a sign of congestion
+MIN_SLOW_LATENCY = 0.5  # seconds
+# The fastest latency of each kind of request creeps up by this fraction with
+# every request, so that it follows a network that has become slower
+LATENCY_DRIFT = 0.01
+
+THROTTLING_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequests',
+    'RequestLimitExceeded',
+    'ServiceUnavailable',
+}
+THROTTLING_STATUSES = {429, 503}
+TRANSIENT_CODES = {'RequestTimeout', 'InternalError'}
+TRANSIENT_STATUSES = {500, 502, 504}
+
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+
+PRIORITY_INDEX = 0
+PRIORITY_SMALL = 1
+PRIORITY_BULK = 2
+SMALL_REQUEST_SIZE = 2**20  # 1 MiB
+# Bandwidth is handed out in chunks of at most this size, so that a large
+# body can't hold up the requests of a higher priority for long
+LIMIT_CHUNK_SIZE = 64 * 2**10  # 64 KiB
+
+
+def classify(err):
+    # type: (Exception) -> str | None
+    "Whether `err` is `THROTTLED`, `TRANSIENT` -- or `None` if it's fatal"
+    if isinstance(err, botocore.exceptions.ClientError):
+        code = err.response.get('Error', {}).get('Code')
+        status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if code in THROTTLING_CODES or status in THROTTLING_STATUSES:
+            return THROTTLED
+        if code in TRANSIENT_CODES or status in TRANSIENT_STATUSES:
+            return TRANSIENT
+        return None
+    if isinstance(
+        err,
+        (
+            botocore.exceptions.ConnectionError,
+            botocore.exceptions.HTTPClientError,
+            botocore.exceptions.IncompleteReadError,
+        ),
+    ):
+        return TRANSIENT
+    return None
+
+
+def _retry_after(err):
+    # type: (Exception) -> float
+    """Seconds to wait as asked for by the `Retry-After` header of the response (if any)
+
+    At most `MAX_BACKOFF`, so a bogus header can't hold up a thread for long.
+    """
+    if not isinstance(err, botocore.exceptions.ClientError):
+        return 0.0
+    headers = err.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    try:
+        retry_after = float(headers.get('retry-after', 0))
+    except ValueError:
+        # An HTTP date -- not sent by object stores in practice
+        return 0.0
+    if math.isnan(retry_after):
+        return 0.0
+    return min(max(retry_after, 0.0), MAX_BACKOFF)
+
+
+def _request_size(api_params):
+    # type: (dict) -> int
+    "The number of bytes sent or asked for (0 if unknown)"
+    num_bytes = 0
+    body = api_params.get('Body')
+    if isinstance(body, (bytes, bytearray)) or hasattr(body, '__len__'):
+        # Including the chunks of files that managed transfers send
+        num_bytes = len(body)
+    elif hasattr(body, 'seek') and hasattr(body, 'tell'):
+        try:
+            position = body.tell()
+            num_bytes = body.seek(0, os.SEEK_END) - position
+            body.seek(position)
+        except (OSError, ValueError, TypeError):
+            pass
+    elif 'ContentLength' in api_params:
+        num_bytes = api_params['ContentLength']
+    elif api_params.get('Range', '').startswith('bytes='):
+        start, _, end = api_params['Range'][len('bytes=') :].partition('-')
+        if start and end:
+            num_bytes = int(end) - int(start) + 1
+    return num_bytes
+
+
+def request_priority(api_params, num_bytes):
+    # type: (dict, int) -> int
+    "`PRIORITY_INDEX`, `PRIORITY_SMALL` or `PRIORITY_BULK` -- lower goes first"
+    if not api_params.get('Key', '').endswith('.bitumen'):
+        return PRIORITY_INDEX
+    if num_bytes <= SMALL_REQUEST_SIZE:
+        return PRIORITY_SMALL
+    return PRIORITY_BULK
+
+
+def _positions(api_params):
+    # type: (dict) -> list[tuple[IO, int]]
+    "The file objects in `api_params` and their positions, to rewind them for a retry"
+    positions = []
+    for value in api_params.values():
+        if hasattr(value, 'seek') and hasattr(value, 'tell'):
+            try:
+                positions.append((value, value.tell()))
+            except (OSError, ValueError):
+                continue
+    return positions
+
+
+class _PriorityQueue:
+    "Lets waiting threads through one at a time, lowest priority first (FIFO within one)"
+
+    def __init__(self, condition):
+        # type: (threading.Condition) -> None
+        self.condition = condition
+        self._waiting = []
+        self._counter = itertools.count()
+
+    def wait(self, priority, predicate, timeout=None):
+        # type: (int, Callable[[], bool], Callable[[], float | None] | None) -> None
+        """Wait (holding `condition`) until it's our turn and `predicate()` holds
+
+        `timeout()` is how long to wait before checking `predicate()` again
+        even without a notification.
+        """
+        ticket = (priority, next(self._counter))
+        heapq.heappush(self._waiting, ticket)
+        while self._waiting[0] != ticket or not predicate():
+            wait_time = None
+            if timeout is not None and self._waiting[0] == ticket:
+                wait_time = timeout()
+            self.condition.wait(wait_time)
+        heapq.heappop(self._waiting)
+        # The next in line may be able to go too
+        self.condition.notify_all()
+
+
+class RateLimiter:
+    """Token bucket of `rate` bytes per second shared by threads
+
+    Without a `rate` the bytes are only counted -- also as the `counter` of
+    `metrics.py`.
+    """
+
+    def __init__(self, rate=None, counter=None):
+        # type: (int | None, str | None) -> None
+        self.rate = rate
+        self.counter = counter
+        self.burst = max(LIMIT_CHUNK_SIZE, (rate or 0) // 10)
+        self.tokens = self.burst
+        self.bytes = 0
+        self.t_first = None
+        self.t_last = None
+        self._t_refill = time.monotonic()
+        self._condition = threading.Condition()
+        self._queue = _PriorityQueue(self._condition)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._t_refill) * self.rate)
+        self._t_refill = now
+
+    def consume(self, num_bytes, priority):
+        # type: (int, int) -> None
+        "Wait until `num_bytes` may be sent or received"
+        with self._condition:
+            if self.rate:
+
+                def _has_tokens():
+                    self._refill()
+                    return self.tokens >= min(num_bytes, self.burst)
+
+                self._queue.wait(
+                    priority,
+                    _has_tokens,
+                    lambda: (min(num_bytes, self.burst) - self.tokens) / self.rate,
+                )
+                # A chunk larger than the burst leaves the bucket in debt
+                self.tokens -= num_bytes
+            self._mark()
+            self.bytes += num_bytes
+        if self.counter is not None:
+            count(self.counter, num_bytes)
+
+    def mark(self):
+        "Extend the time `achieved_rate()` is measured over to now"
+        with self._condition:
+            self._mark()
+
+    def _mark(self):
+        now = time.monotonic()
+        if self.t_first is None:
+            self.t_first = now
+        self.t_last = now
+
+    def achieved_rate(self):
+        # type: () -> float | None
+        """Bytes per second from when the first transfer began to when the last ended
+
+        `None` if no time was measured (e.g. a single chunk).
+        """
+        if self.t_first is None or self.t_last == self.t_first:
+            return None
+        return self.bytes / (self.t_last - self.t_first)
+
+
+class _LimitedStream:
+    "Passes `read()`s of the file object `raw` through `limiter`"
+
+    def __init__(self, raw, limiter, priority):
+        # type: (IO[bytes], RateLimiter, int) -> None
+        self._raw = raw
+        self._limiter = limiter
+        self._priority = priority
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def read(self, amt=None):
+        if amt is None or amt < 0:
+            chunks = []
+            while True:
+                chunk = self.read(LIMIT_CHUNK_SIZE)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        data = self._raw.read(min(amt, LIMIT_CHUNK_SIZE))
+        if data:
+            self._consume(len(data))
+        return data
+
+    def _consume(self, num_bytes):
+        # type: (int) -> None
+        self._limiter.consume(num_bytes, self._priority)
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def iter_chunks(self, chunk_size=LIMIT_CHUNK_SIZE):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class _ResponseBody(_LimitedStream):
+    """A response body that keeps its request in flight until it's been read
+
+    `on_done(waited, failed)` is called once: when `size` bytes (if known) or
+    the end of the body have been read, when a read fails, or when the body
+    is closed or garbage collected. `waited` is the time spent waiting for
+    `limiter`.
+    """
+
+    def __init__(self, raw, limiter, priority, size, on_done):
+        # type: (IO[bytes], RateLimiter, int, int | None, Callable[[float, bool], None]) -> None
+        super().__init__(raw, limiter, priority)
+        self._remaining = size
+        self._on_done = on_done
+        self._waited = 0.0
+        if size == 0:
+            self._done()
+
+    def read(self, amt=None):
+        try:
+            data = super().read(amt)
+        except BaseException:
+            self._done(failed=True)
+            raise
+        if amt is None or amt < 0 or not data:
+            self._done()
+        elif self._remaining is not None:
+            self._remaining -= len(data)
+            if self._remaining <= 0:
+                self._done()
+        return data
+
+    def _consume(self, num_bytes):
+        # type: (int) -> None
+        t_begin = time.perf_counter()
+        super()._consume(num_bytes)
+        self._waited += time.perf_counter() - t_begin
+
+    def _done(self, failed=False):
+        # type: (bool) -> None
+        on_done, self._on_done = self._on_done, None
+        if on_done is not None:
+            on_done(self._waited, failed)
+
+    def close(self):
+        self._done()
+        self._raw.close()
+
+    def __del__(self):
+        # Not read to the end and not closed -- e.g. after an error
+        if getattr(self, '_on_done', None) is not None:
+            self._done()
+
+
+class Scheduler:
+    "Limits, paces and retries the requests to an object store (see above)"
+
+    def __init__(
+        self,
+        max_inflight=MAX_INFLIGHT,
+        initial_inflight=INITIAL_INFLIGHT,
+        max_attempts=MAX_ATTEMPTS,
+        upload_limit=None,
+        download_limit=None,
+    ):
+        # type: (int, int, int, int | None, int | None) -> None
+        self.upload = RateLimiter(upload_limit, 'bytes_sent')
+        self.download = RateLimiter(download_limit, 'bytes_received')
+        self.max_inflight = max_inflight
+        self.max_attempts = max_attempts
+        self.limit = float(min(initial_inflight, max_inflight))
+        self.inflight = 0
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.min_limit = self.limit
+        # Fastest recent latency of each kind of request
+        self._latencies = {}
+        # The number of requests sent so far, and when the limit was last
+        # halved (in that count)
+        self._seq = 0
+        self._decreased_at = 0
+        self._condition = threading.Condition()
+        self._queue = _PriorityQueue(self._condition)
+        # Priority of the request being sent by each thread, for `before-send`
+        self._local = threading.local()
+
+    def call(self, operation_name, make_api_call, api_params):
+        # type: (str, Callable[[str, dict], dict], dict) -> dict
+        "`make_api_call(operation_name, api_params)` -- limited and retried"
+        num_bytes = _request_size(api_params)
+        kind = (operation_name, num_bytes.bit_length())
+        priority = request_priority(api_params, num_bytes)
+        positions = _positions(api_params)
+        # Transfers are timed from when their request is sent (see
+        # `RateLimiter.achieved_rate()`)
+        if 'Body' in api_params:
+            limiter = self.upload
+        elif operation_name == 'GetObject':
+            limiter = self.download
+        else:
+            limiter = None
+        attempt = 0
+        while True:
+            seq = self._acquire(priority)
+            count('requests')
+            t_begin = time.perf_counter()
+            if limiter is not None:
+                limiter.mark()
+            try:
+                self._local.priority = priority
+                response = make_api_call(operation_name, api_params)
+            except Exception as err:
+                error_kind = classify(err)
+                self._release(seq, kind, None, error_kind == THROTTLED)
+                attempt += 1
+                if error_kind is None or attempt >= self.max_attempts:
+                    raise
+                with self._condition:
+                    self.retries += 1
+                count('retries')
+                backoff = random.uniform(
+                    0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (attempt - 1))
+                )
+                time.sleep(max(backoff, _retry_after(err)))
+                for f, position in positions:
+                    f.seek(position)
+                continue
+            if limiter is not None:
+                limiter.mark()
+            if not hasattr(response.get('Body'), 'read'):
+                self._release(seq, kind, time.perf_counter() - t_begin, False)
+                return response
+
+            size = response.get('ContentLength')
+            if size is not None:
+                kind = (operation_name, size.bit_length())
+            response['Body'] = _ResponseBody(
+                response['Body'],
+                self.download,
+                priority,
+                size,
+                self._body_done(seq, kind, t_begin),
+            )
+            return response
+
+    def _body_done(self, seq, kind, t_begin):
+        # type: (int, tuple[str, int], float) -> Callable[[float, bool], None]
+        "Releases the slot of request `seq` once its body has been read (see `_ResponseBody`)"
+
+        def on_done(waited, failed):
+            latency = None if failed else time.perf_counter() - t_begin - waited
+            self._release(seq, kind, latency, False)
+
+        return on_done
+
+    def before_send(self, request, **kwargs):
+        "Pace the body of `request` with the upload limiter"
+        if request.body is None:
+            return
+        body = request.body
+        if isinstance(body, (bytes, bytearray)):
+            body = io.BytesIO(body)
+        elif isinstance(body, str):
+            body = io.BytesIO(body.encode())
+        elif not hasattr(body, 'read'):
+            return
+        request.body = _LimitedStream(
+            body, self.upload, getattr(self._local, 'priority', PRIORITY_BULK)
+        )
+
+    def _acquire(self, priority):
+        # type: (int) -> int
+        with self._condition:
+            self._queue.wait(priority, lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+            self.requests += 1
+            self._seq += 1
+            return self._seq
+
+    def _release(self, seq, kind, latency, throttled):
+        # type: (int, tuple[str, int], float | None, bool) -> None
+        with self._condition:
+            self.inflight -= 1
+            if throttled:
+                self.throttled += 1
+                count('throttled')
+                self._decrease(seq)
+            elif latency is not None:
+                fastest = self._latencies.get(kind, latency)
+                self._latencies[kind] = min(latency, fastest * (1 + LATENCY_DRIFT))
+                if latency > max(MIN_SLOW_LATENCY, LATENCY_FACTOR * fastest):
+                    self._decrease(seq)
+                else:
+                    self.limit = min(self.max_inflight, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def _decrease(self, seq):
+        # type: (int) -> None
+        "Halve the limit -- unless it was halved after request `seq` was sent"
+        if seq > self._decreased_at:
+            self.limit = max(1.0, self.limit / 2)
+            self.min_limit = min(self.min_limit, self.limit)
+            self._decreased_at = self._seq
+
+    def summary(self):
+        # type: () -> str
+        return (
+            f'Requests: {self.requests} ({self.retries} retried, {self.throttled} throttled), '
+            f'concurrency limit {int(self.limit)} (lowest {int(self.min_limit)})'
+        )
+
+
+def schedule(s3_client, scheduler):
+    # type: (S3Client, Scheduler) -> S3Client
+    """Send every request of `s3_client` through `scheduler`
+
+    All the operations of a botocore client -- including those of paginators
+    and managed transfers like `upload_fileobj()` -- go through
+    `_make_api_call()`, so that's where the scheduler is put in. The client
+    should be created without retries of its own.
+    """
+    make_api_call = s3_client._make_api_call
+
+    def _make_api_call(operation_name, api_params):
+        return scheduler.call(operation_name, make_api_call, api_params)
+
+    s3_client._make_api_call = _make_api_call
+    s3_client.meta.events.register('before-send.s3', scheduler.before_send)
+    s3_client.scheduler = scheduler
+    return s3_client
@@ -0,0 +1,161 @@
+import hashlib
+import heapq
+import json
+
+from constants import DATABASE_FILENAME
+from diff import iter_db_entries
+from index import sort_key
+from remote_index import sync_index
+
+"""
+Sharded index
+-------------
+
+By default the whole backup has a single index at `<prefix>bitumen.sqlite3`.
+With `upload --shard-depth N` the index is instead split into one shard per
+subtree N directories deep, and a small manifest lists the shards:
+
+    <prefix>bitumen.manifest.json
+    <prefix>bitumen.shards/<shard_id>/bitumen.sqlite3
+    <prefix>bitumen.shards/<shard_id>/bitumen.deltas/...
+
+Each shard is an index in its own right (with its own `ETag`, cache and
+deltas, see `remote_index.py`) at its own "index prefix", so an upload only
+rewrites the shards whose subtrees changed and a download of a subtree only
+fetches the shards that may hold matching files. Files less than N directories deep go in the
+shard of their directory -- files at the top-level in the shard `''`.
+
+The `.bitumen`-files are shared by all shards and stay at `<prefix>`, but a
+bucket only ever holds files from a single shard.
+"""
+
+MANIFEST_FILENAME = 'bitumen.manifest.json'
+MANIFEST_VERSION = 1
+SHARDS_DIRNAME = 'bitumen.shards'
+
+
+def shard_of(file_path, depth):
+    # type: (str, int) -> str
+    "The subtree whose shard `file_path` belongs to -- e.g. `/a/b/c` -> `/a`"
+    dirnames = file_path.split('/')[1:-1]
+    return ''.join(f'/{dirname}' for dirname in dirnames[:depth])
+
+
+def shard_id(subtree):
+    # type: (str) -> str
+    return hashlib.sha256(subtree.encode()).hexdigest()[:16]
+
+
+def shard_prefix(prefix, id_):
+    # type: (str, str) -> str
+    return f'{prefix}{SHARDS_DIRNAME}/{id_}/'
+
+
+def new_manifest(depth):
+    # type: (int) -> dict
+    return {'version': MANIFEST_VERSION, 'depth': depth, 'shards': {}}
+
+
+def load_manifest(s3_client, bucket, prefix):
+    # type: (S3Client, str, str) -> dict | None
+    "The manifest of a sharded backup -- `None` if the backup isn't sharded"
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket, Key=f'{prefix}{MANIFEST_FILENAME}'
+        )
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    manifest = json.loads(response['Body'].read())
+    if manifest['version'] > MANIFEST_VERSION:
+        raise ValueError(
+            f'Manifest version {manifest["version"]} is newer than this version of bitum supports ({MANIFEST_VERSION})'
+        )
+    return manifest
+
+
+def save_manifest(s3_client, bucket, prefix, manifest):
+    # type: (S3Client, str, str, dict) -> None
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=f'{prefix}{MANIFEST_FILENAME}',
+        Body=json.dumps(manifest, indent=2, sort_keys=True).encode(),
+        ContentType='application/json',
+    )
+
+
+def _holds(shard_subtree, depth, dir_path, recursive):
+    # type: (str, int, str, bool) -> bool
+    "Whether the shard of `shard_subtree` may hold files in `dir_path`"
+    if recursive and _is_below(shard_subtree, dir_path):
+        return True
+    # Shards that aren't `depth` deep only hold files directly in their
+    # directory, so only full-depth shards hold deeper directories
+    return shard_subtree == dir_path or (
+        _is_below(dir_path, shard_subtree) and shard_subtree.count('/') == depth
+    )
+
+
+def index_prefixes(manifest, prefix, path_filter=None):
+    # type: (dict | None, str, PathFilter | None) -> dict[str | None, str]
+    """Index prefix of each shard -- keyed by their subtree
+
+    For an unsharded backup (`manifest` is `None`) there's a single index
+    keyed by `None`. With `path_filter` only the shards that may hold
+    matching files are included.
+    """
+    if manifest is None:
+        return {None: prefix}
+
+    prefixes = {}
+    for shard_subtree, id_ in manifest['shards'].items():
+        if path_filter is None or any(
+            _holds(shard_subtree, manifest['depth'], dir_path, recursive)
+            for dir_path, recursive in path_filter.dirs
+        ):
+            prefixes[shard_subtree] = shard_prefix(prefix, id_)
+    return prefixes
+
+
+def _is_below(path, subtree):
+    # type: (str, str) -> bool
+    "Whether `path` is `subtree` or inside it"
+    return subtree == '' or path == subtree or path.startswith(f'{subtree}/')
+
+
+def index_prefix_of(manifest, prefix, file_path):
+    # type: (dict | None, str, str) -> str | None
+    "Index prefix of the shard holding `file_path` -- `None` if there's no such shard"
+    if manifest is None:
+        return prefix
+    id_ = manifest['shards'].get(shard_of(file_path, manifest['depth']))
+    return shard_prefix(prefix, id_) if id_ is not None else None
+
+
+def sync_indexes(s3_client, bucket, prefix, manifest, path_filter=None):
+    # type: (S3Client, str, str, dict | None, PathFilter | None) -> dict[str | None, str]
+    """`sync_index()` for each shard (see `index_prefixes()`)
+
+    Returns the path of the cached index of each shard. Shards listed in the
+    manifest must exist. For an unsharded backup the result is empty if
+    there's no index.
+    """
+    db_filepaths = {}
+    for key, index_prefix in index_prefixes(manifest, prefix, path_filter).items():
+        db_filepath = sync_index(s3_client, bucket, index_prefix)
+        if db_filepath is None:
+            if manifest is None:
+                continue
+            raise ValueError(
+                f'Shard "{key}" is missing at "s3://{bucket}/{index_prefix}{DATABASE_FILENAME}"'
+            )
+        db_filepaths[key] = db_filepath
+    return db_filepaths
+
+
+def iter_shard_entries(db_filepaths, **kwargs):
+    # type: (Iterable[str], ...) -> Iterator[DirEntry]
+    "`iter_db_entries()` of several shards merged into a single stream in index order"
+    return heapq.merge(
+        *(iter_db_entries(db_filepath, **kwargs) for db_filepath in db_filepaths),
+        key=lambda entry: sort_key(entry.file_path),
+    )
@@ -0,0 +1,273 @@
+"""
+Reading SQLite files without SQLite
+-----------------------------------
+
+`sqlite3` can only open files on disk, but looking up a single row only
+touches a handful of pages: the root page, a few interior pages and a leaf
+for each b-tree. `SQLiteReader` walks the b-trees itself, so the pages can
+come from anywhere -- e.g. HTTP Range requests (see `remote_index.py`).
+
+Only what the index needs is supported: UTF-8 databases, lookups by rowid
+and by key prefix in index b-trees (which is how `WITHOUT ROWID` tables and
+`UNIQUE` constraints are stored), and uncommitted WAL-contents are ignored.
+
+File format reference: https://www.sqlite.org/fileformat2.html
+"""
+
+import struct
+
+HEADER_MAGIC = b'SQLite format 3\x00'
+
+PAGE_INTERIOR_INDEX = 2
+PAGE_INTERIOR_TABLE = 5
+PAGE_LEAF_INDEX = 10
+PAGE_LEAF_TABLE = 13
+
+# Sizes of the integer serial types 1-6
+INT_SIZES = {1: 1, 2: 2, 3: 3, 4: 4, 5: 6, 6: 8}
+
+
+def _varint(data, pos):
+    # type: (bytes, int) -> tuple[int, int]
+    "Decode the varint at `pos` -- returns the value and the position after it"
+    value = 0
+    for i in range(8):
+        byte = data[pos + i]
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos + i + 1
+    return (value << 8) | data[pos + 8], pos + 9
+
+
+def _record(payload):
+    # type: (bytes) -> tuple
+    "Decode a record into a tuple of column values"
+    header_size, pos = _varint(payload, 0)
+    serial_types = []
+    while pos < header_size:
+        serial_type, pos = _varint(payload, pos)
+        serial_types.append(serial_type)
+
+    values = []
+    pos = header_size
+    for serial_type in serial_types:
+        if serial_type == 0:
+            values.append(None)
+        elif serial_type in INT_SIZES:
+            size = INT_SIZES[serial_type]
+            values.append(int.from_bytes(payload[pos : pos + size], 'big', signed=True))
+            pos += size
+        elif serial_type == 7:
+            values.append(struct.unpack('>d', payload[pos : pos + 8])[0])
+            pos += 8
+        elif serial_type in (8, 9):
+            values.append(serial_type - 8)
+        elif serial_type >= 12:
+            size = (serial_type - 12) // 2
+            value = payload[pos : pos + size]
+            values.append(value.decode() if serial_type % 2 else bytes(value))
+            pos += size
+        else:
+            raise ValueError(f'Invalid serial type {serial_type}')
+    return tuple(values)
+
+
+def _type_rank(value):
+    if value is None:
+        return 0
+    elif isinstance(value, (int, float)):
+        return 1
+    elif isinstance(value, str):
+        return 2
+    return 3
+
+
+def _compare(key, record):
+    # type: (tuple, tuple) -> int
+    """Compare `key` with the first `len(key)` columns of `record`
+
+    Follows SQLite's ordering: NULL < numbers < text < blobs. Text is
+    compared with the `BINARY` collation, which for UTF-8 is the same as
+    comparing code points.
+    """
+    for a, b in zip(key, record):
+        a_rank, b_rank = _type_rank(a), _type_rank(b)
+        if a_rank != b_rank:
+            return -1 if a_rank < b_rank else 1
+        if a != b:
+            return -1 if a < b else 1
+    return 0
+
+
+class SQLiteReader:
+    """Read-only access to the b-trees of a SQLite file
+
+    `read(offset, size)` must return `size` bytes of the file starting at
+    `offset`.
+    """
+
+    def __init__(self, read):
+        self.read = read
+        header = read(0, 100)
+        if header[:16] != HEADER_MAGIC:
+            raise ValueError('Not a SQLite database')
+        (page_size,) = struct.unpack('>H', header[16:18])
+        self.page_size = 65536 if page_size == 1 else page_size
+        self.usable_size = self.page_size - header[20]
+        (self.text_encoding,) = struct.unpack('>I', header[56:60])
+        (self.user_version,) = struct.unpack('>I', header[60:64])
+        if self.text_encoding not in (0, 1):
+            raise ValueError('Only UTF-8 databases are supported')
+        self._root_pages = None
+
+    def page(self, page_number):
+        # type: (int) -> bytes
+        return self.read((page_number - 1) * self.page_size, self.page_size)
+
+    def _cells(self, page_number):
+        # type: (int) -> tuple[int, bytes, list[int], int | None]
+        "Page type, page contents, cell offsets and right-most pointer"
+        data = self.page(page_number)
+        header_offset = 100 if page_number == 1 else 0
+        page_type = data[header_offset]
+        (num_cells,) = struct.unpack('>H', data[header_offset + 3 : header_offset + 5])
+        if page_type in (PAGE_INTERIOR_INDEX, PAGE_INTERIOR_TABLE):
+            (right_pointer,) = struct.unpack(
+                '>I', data[header_offset + 8 : header_offset + 12]
+            )
+            pointers_offset = header_offset + 12
+        elif page_type in (PAGE_LEAF_INDEX, PAGE_LEAF_TABLE):
+            right_pointer = None
+            pointers_offset = header_offset + 8
+        else:
+            raise ValueError(f'Page {page_number} is not a b-tree page')
+        offsets = struct.unpack(
+            f'>{num_cells}H', data[pointers_offset : pointers_offset + 2 * num_cells]
+        )
+        return page_type, data, offsets, right_pointer
+
+    def _payload(self, data, pos, payload_size, is_table):
+        # type: (bytes, int, int, bool) -> bytes
+        "Read a payload -- following overflow pages if it doesn't fit the page"
+        usable_size = self.usable_size
+        if is_table:
+            max_local = usable_size - 35
+        else:
+            max_local = (usable_size - 12) * 64 // 255 - 23
+        if payload_size <= max_local:
+            return data[pos : pos + payload_size]
+
+        min_local = (usable_size - 12) * 32 // 255 - 23
+        local_size = min_local + (payload_size - min_local) % (usable_size - 4)
+        if local_size > max_local:
+            local_size = min_local
+
+        payload = bytearray(data[pos : pos + local_size])
+        (overflow_page,) = struct.unpack(
+            '>I', data[pos + local_size : pos + local_size + 4]
+        )
+        while len(payload) < payload_size:
+            overflow_data = self.page(overflow_page)
+            remaining = payload_size - len(payload)
+            payload += overflow_data[4 : 4 + min(remaining, usable_size - 4)]
+            (overflow_page,) = struct.unpack('>I', overflow_data[:4])
+        return bytes(payload)
+
+    def _index_cell(self, data, offset, is_interior):
+        # type: (bytes, int, bool) -> tuple[int | None, tuple]
+        "Left child (for interior pages) and record of an index b-tree cell"
+        if is_interior:
+            (left_child,) = struct.unpack('>I', data[offset : offset + 4])
+            offset += 4
+        else:
+            left_child = None
+        payload_size, pos = _varint(data, offset)
+        return left_child, _record(self._payload(data, pos, payload_size, False))
+
+    def iter_table(self, root_page):
+        # type: (int) -> Iterator[tuple[int, tuple]]
+        "All `(rowid, record)` of the table b-tree at `root_page`"
+        page_type, data, offsets, right_pointer = self._cells(root_page)
+        if page_type == PAGE_INTERIOR_TABLE:
+            for offset in offsets:
+                (left_child,) = struct.unpack('>I', data[offset : offset + 4])
+                yield from self.iter_table(left_child)
+            yield from self.iter_table(right_pointer)
+        elif page_type == PAGE_LEAF_TABLE:
+            for offset in offsets:
+                payload_size, pos = _varint(data, offset)
+                rowid, pos = _varint(data, pos)
+                yield rowid, _record(self._payload(data, pos, payload_size, True))
+        else:
+            raise ValueError(f'Page {root_page} is not a table b-tree page')
+
+    def table_lookup(self, root_page, rowid):
+        # type: (int, int) -> tuple | None
+        "The record with `rowid` in the table b-tree at `root_page`"
+        page_number = root_page
+        while True:
+            page_type, data, offsets, right_pointer = self._cells(page_number)
+            if page_type == PAGE_INTERIOR_TABLE:
+                page_number = right_pointer
+                for offset in offsets:
+                    key, _ = _varint(data, offset + 4)
+                    if rowid <= key:
+                        (page_number,) = struct.unpack('>I', data[offset : offset + 4])
+                        break
+            elif page_type == PAGE_LEAF_TABLE:
+                for offset in offsets:
+                    payload_size, pos = _varint(data, offset)
+                    cell_rowid, pos = _varint(data, pos)
+                    if cell_rowid == rowid:
+                        return _record(self._payload(data, pos, payload_size, True))
+                return None
+            else:
+                raise ValueError(f'Page {page_number} is not a table b-tree page')
+
+    def index_lookup(self, root_page, key):
+        # type: (int, tuple) -> tuple | None
+        """The first record in the index b-tree at `root_page` starting with `key`
+
+        For `WITHOUT ROWID` tables the record is the row with the primary key
+        columns first. For other indexes it's the indexed columns followed by
+        the rowid.
+        """
+        page_number = root_page
+        while True:
+            page_type, data, offsets, right_pointer = self._cells(page_number)
+            is_interior = page_type == PAGE_INTERIOR_INDEX
+            if not is_interior and page_type != PAGE_LEAF_INDEX:
+                raise ValueError(f'Page {page_number} is not an index b-tree page')
+
+            # Binary search for the first cell >= `key`
+            lo, hi = 0, len(offsets)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                _, record = self._index_cell(data, offsets[mid], is_interior)
+                if _compare(key, record) > 0:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            if lo < len(offsets):
+                left_child, record = self._index_cell(data, offsets[lo], is_interior)
+                if _compare(key, record) == 0:
+                    return record
+            else:
+                left_child = right_pointer
+
+            if not is_interior:
+                return None
+            page_number = left_child
+
+    def root_page(self, name):
+        # type: (str) -> int
+        "Root page of the table or index called `name`"
+        if self._root_pages is None:
+            # `sqlite_schema`: type, name, tbl_name, rootpage, sql
+            self._root_pages = {
+                record[1]: record[3] for _, record in self.iter_table(1)
+            }
+        if name not in self._root_pages:
+            raise KeyError(f'No table or index called "{name}"')
+        return self._root_pages[name]
@@ -0,0 +1,735 @@
+from datetime import datetime, timezone
+import errno
+import hashlib
+import io
+import json
+import os
+import secrets
+import shutil
+import stat
+import threading
+from types import SimpleNamespace
+from urllib.parse import unquote, urlsplit
+
+from botocore.exceptions import ClientError
+
+from metrics import count
+from scheduler import LIMIT_CHUNK_SIZE, PRIORITY_BULK, request_priority
+
+"""
+Storage backends
+----------------
+
+A backend stores the objects of a backup -- the `.bitumen`-files, the index
+and its deltas (see `remote_index.py`) and the manifest (see `shards.py`).
+Its interface is the part of the S3 API that bitum uses, with the method
+names and arguments of a boto3 client:
+
+- get a range: `get_object(Bucket, Key, Range=None, IfMatch=None)` -- the
+  `Body` has `read()` and `iter_chunks()`, see also `copy_to_file()`
+- head: `head_object(Bucket, Key)` -- `ContentLength`, `ETag`, `Metadata`
+- put: `put_object(Bucket, Key, Body)` and `upload_fileobj()` (with
+  `ExtraArgs={'Metadata': ...}`), get a whole object: `download_fileobj()`
+- multipart: `create_multipart_upload()`, `upload_part()`,
+  `complete_multipart_upload()`, `abort_multipart_upload()`
+- list: `get_paginator('list_objects_v2')` (with `Prefix`, `Delimiter='/'`
+  and `StartAfter`) and `get_paginator('list_multipart_uploads')`
+- delete: `delete_objects(Bucket, Delete)`
+- errors: `exceptions.ClientError`, `exceptions.NoSuchKey` and
+  `exceptions.NoSuchUpload`, with the S3 error codes -- `LocalStorage`
+  raises `NotImplemented` for a `Delimiter` other than `/`, and
+  `ValueError` for a paginator it doesn't have
+- `meta.endpoint_url` identifies the backend, and `scheduler` has the
+  transfer counters (see `scheduler.py`)
+
+`utils.get_s3_client()` returns one of the backends for an endpoint URL:
+
+- S3 and S3-compatible services: a boto3 client, with its requests going
+  through a `scheduler.Scheduler`
+- `file:///path/to/dir`: `LocalStorage` -- a directory, e.g. on a NAS.
+  Objects are files (`<dir>/<bucket>/<key>`), read with `pread()` and
+  copied with `copy_file_range()`, which copies in the kernel -- and on the
+  server for NFS 4.2, or as a reflink on btrfs and XFS. A new object is
+  written to a temporary file and renamed into place, so readers see either
+  the old or the new object. The `ETag` of an object is made from the inode,
+  modification time and size of its file, which change whenever it's
+  replaced.
+
+`LocalStorage` keeps its own state -- the metadata of objects and the parts
+of multipart uploads -- in `<dir>/<bucket>/.bitum-storage/`.
+"""
+
+STATE_DIRNAME = '.bitum-storage'
+TMP_PREFIX = '.bitum-tmp-'
+MAX_KEYS = 1000
+# Largest single `copy_file_range()` without a rate limit
+COPY_CHUNK_SIZE = 2**30  # 1 GiB
+READ_CHUNK_SIZE = 2**20  # 1 MiB
+
+
+class NoSuchKey(ClientError):
+    pass
+
+
+class NoSuchUpload(ClientError):
+    pass
+
+
+def _error(error_class, code, status, operation_name, message=''):
+    # type: (type[ClientError], str, int, str, str) -> ClientError
+    "An error like the ones botocore raises for the S3 error `code`"
+    return error_class(
+        {
+            'Error': {'Code': code, 'Message': message},
+            'ResponseMetadata': {'HTTPStatusCode': status},
+        },
+        operation_name,
+    )
+
+
+def _fileno(f):
+    # type: (IO[bytes]) -> int | None
+    "File descriptor of the regular file behind `f` -- `None` for e.g. `BytesIO`"
+    try:
+        fd = f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return fd
+
+
+def _copy_range(fd_in, offset, size, fd_out, limiter=None, priority=PRIORITY_BULK):
+    # type: (int, int, int, int, RateLimiter | None, int) -> int
+    """Copy `size` bytes at `offset` of `fd_in` to the position of `fd_out`
+
+    With `copy_file_range()` where the kernel supports it for the two files,
+    otherwise by `pread()` and `write()`. Returns the number of bytes copied
+    (fewer at the end of `fd_in`).
+    """
+    limited = limiter is not None and limiter.rate
+    chunk_size = LIMIT_CHUNK_SIZE if limited else COPY_CHUNK_SIZE
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    copied = 0
+    while copied < size:
+        num_bytes = min(chunk_size, size - copied)
+        if limited:
+            limiter.consume(num_bytes, priority)
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(fd_in, fd_out, num_bytes, offset + copied)
+            except OSError as err:
+                # Not for these files (e.g. across file systems on older
+                # kernels, or to a file opened for appending) -- fall back
+                if err.errno not in (
+                    errno.EBADF,
+                    errno.EXDEV,
+                    errno.EINVAL,
+                    errno.ENOSYS,
+                    errno.EOPNOTSUPP,
+                ):
+                    raise
+                use_copy_file_range = False
+        if not use_copy_file_range:
+            data = os.pread(fd_in, min(num_bytes, READ_CHUNK_SIZE), offset + copied)
+            n = _write_all(fd_out, data)
+        if n == 0:
+            break
+        if limiter is not None and not limited:
+            # Only counted -- once copied, so the rate is of the copy
+            limiter.consume(n, priority)
+        copied += n
+    return copied
+
+
+def _write_all(fd, data):
+    # type: (int, bytes) -> int
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+    return len(data)
+
+
+def _etag(st):
+    # type: (os.stat_result) -> str
+    return f'"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _parse_range(bytes_range, size):
+    # type: (str, int) -> tuple[int, int] | None
+    "`(start, end)` (exclusive) of `bytes=a-b`, `bytes=a-` or `bytes=-n`"
+    start, _, end = bytes_range[len('bytes=') :].partition('-')
+    if not start:
+        start, end = max(0, size - int(end)), size
+    else:
+        start = int(start)
+        end = min(int(end) + 1, size) if end else size
+    if start >= size and size > 0:
+        return None
+    return start, end
+
+
+class _Body:
+    """`Body` of `LocalStorage.get_object()` -- `size` bytes from `offset` of `fd`
+
+    The file is read with `pread()`, so the object can be replaced while it's
+    being read.
+    """
+
+    def __init__(self, fd, offset, size, limiter, priority):
+        # type: (int, int, int, RateLimiter, int) -> None
+        self._fd = fd
+        self._position = offset
+        self._end = offset + size
+        self._limiter = limiter
+        self._priority = priority
+        # The download begins (see `RateLimiter.achieved_rate()`)
+        limiter.mark()
+
+    def read(self, amt=None):
+        # type: (int | None) -> bytes
+        remaining = self._end - self._position
+        if amt is None or amt < 0 or amt > remaining:
+            amt = remaining
+        chunks = []
+        while amt > 0:
+            num_bytes = min(amt, LIMIT_CHUNK_SIZE if self._limiter.rate else amt)
+            self._limiter.consume(num_bytes, self._priority)
+            data = os.pread(self._fd, num_bytes, self._position)
+            if not data:
+                break
+            chunks.append(data)
+            self._position += len(data)
+            amt -= len(data)
+        return b''.join(chunks)
+
+    def iter_chunks(self, chunk_size=READ_CHUNK_SIZE):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def copy_to(self, f_out):
+        # type: (IO[bytes]) -> int
+        "Write the rest of the body to `f_out` -- in the kernel if it's a file"
+        fd_out = _fileno(f_out)
+        if fd_out is None:
+            return _copy_chunks(self, f_out)
+        f_out.flush()
+        copied = _copy_range(
+            self._fd,
+            self._position,
+            self._end - self._position,
+            fd_out,
+            self._limiter,
+            self._priority,
+        )
+        self._position += copied
+        # The position of `f_out` moved underneath it
+        f_out.seek(os.lseek(fd_out, 0, os.SEEK_CUR))
+        return copied
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
+def _copy_chunks(body, f_out, callback=None):
+    # type: (IO[bytes], IO[bytes], Callable[[int], None] | None) -> int
+    copied = 0
+    while True:
+        data = body.read(READ_CHUNK_SIZE)
+        if not data:
+            return copied
+        f_out.write(data)
+        copied += len(data)
+        if callback is not None:
+            callback(len(data))
+
+
+def copy_to_file(body, f_out):
+    # type: (IO[bytes], IO[bytes]) -> int
+    "Write the rest of `body` (of a `get_object()`) to `f_out` -- returns the bytes written"
+    if hasattr(body, 'copy_to'):
+        return body.copy_to(f_out)
+    return _copy_chunks(body, f_out)
+
+
+class _Paginator:
+    def __init__(self, list_page):
+        # type: (Callable[..., tuple[dict, dict | None]]) -> None
+        self._list_page = list_page
+
+    def paginate(self, **kwargs):
+        while True:
+            page, next_kwargs = self._list_page(**kwargs)
+            yield page
+            if next_kwargs is None:
+                return
+            kwargs = {**kwargs, **next_kwargs}
+
+
+class LocalStorage:
+    "The storage backend of a local directory (see above)"
+
+    exceptions = SimpleNamespace(
+        ClientError=ClientError, NoSuchKey=NoSuchKey, NoSuchUpload=NoSuchUpload
+    )
+
+    def __init__(self, root, scheduler):
+        # type: (str, Scheduler) -> None
+        if not os.path.isdir(root):
+            raise FileNotFoundError(f'Storage directory "{root}" does not exist')
+        self.root = os.path.abspath(root)
+        self.meta = SimpleNamespace(endpoint_url=f'file://{self.root}')
+        # Only for its rate limiters and counters -- there's nothing to retry
+        self.scheduler = scheduler
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, endpoint_url, scheduler):
+        # type: (str, Scheduler) -> LocalStorage
+        return cls(unquote(urlsplit(endpoint_url).path), scheduler)
+
+    #########
+    # Paths #
+    #########
+    def _bucket_dir(self, bucket):
+        # type: (str) -> str
+        if not bucket or '/' in bucket or bucket.startswith('.'):
+            raise ValueError(f'Invalid bucket name "{bucket}"')
+        return os.path.join(self.root, bucket)
+
+    def _path(self, bucket, key):
+        # type: (str, str) -> str
+        parts = key.split('/')
+        if (
+            not key
+            or key.startswith('/')
+            or any(part in ('', '.', '..') for part in parts)
+            or parts[0] == STATE_DIRNAME
+            or parts[-1].startswith(TMP_PREFIX)
+        ):
+            raise ValueError(f'Key "{key}" can\'t be stored in a directory')
+        return os.path.join(self._bucket_dir(bucket), *parts)
+
+    def _state_dir(self, bucket, *names):
+        # type: (str, str) -> str
+        return os.path.join(self._bucket_dir(bucket), STATE_DIRNAME, *names)
+
+    def _metadata_dir(self, bucket, key):
+        # type: (str, str) -> str
+        key_hash = hashlib.sha256(key.encode()).hexdigest()
+        return self._state_dir(bucket, 'metadata', key_hash[:2], key_hash)
+
+    def _upload_dir(self, bucket, upload_id):
+        # type: (str, str) -> str
+        if not upload_id.isalnum():
+            raise _error(NoSuchUpload, 'NoSuchUpload', 404, 'UploadPart')
+        return self._state_dir(bucket, 'multipart', upload_id)
+
+    def _request(self):
+        with self._lock:
+            self.scheduler.requests += 1
+        count('requests')
+
+    ###########
+    # Writing #
+    ###########
+    def _write(self, bucket, key, write, metadata=None):
+        # type: (str, str, Callable[[int], None], dict | None) -> str
+        """Write the object `key` by `write(fd)` to a temporary file that then
+        replaces it -- returns the `ETag` of the new object"""
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(
+            os.path.dirname(path), f'{TMP_PREFIX}{secrets.token_hex(8)}'
+        )
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            try:
+                write(fd)
+                os.fsync(fd)
+                etag = _etag(os.fstat(fd))
+            finally:
+                os.close(fd)
+            # The metadata goes by the `ETag` of the object, so it's there
+            # before the object is
+            self._set_metadata(bucket, key, etag, metadata or {})
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._remove_metadata(bucket, key, keep=etag)
+        return etag
+
+    def _write_from(self, fd, body, callback=None):
+        # type: (int, bytes | IO[bytes], Callable[[int], None] | None) -> None
+        "Write `body` (from its position, if it's a file object) to `fd`"
+        limiter = self.scheduler.upload
+        # The upload begins (see `RateLimiter.achieved_rate()`)
+        limiter.mark()
+        if isinstance(body, str):
+            body = body.encode()
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            for i in range(0, len(body), LIMIT_CHUNK_SIZE):
+                chunk = body[i : i + LIMIT_CHUNK_SIZE]
+                limiter.consume(len(chunk), PRIORITY_BULK)
+                _write_all(fd, chunk)
+            if callback is not None:
+                callback(len(body))
+            return
+        fd_in = _fileno(body)
+        if fd_in is None:
+            while True:
+                data = body.read(READ_CHUNK_SIZE)
+                if not data:
+                    return
+                limiter.consume(len(data), PRIORITY_BULK)
+                _write_all(fd, data)
+                if callback is not None:
+                    callback(len(data))
+        offset = body.tell()
+        size = os.fstat(fd_in).st_size - offset
+        copied = _copy_range(fd_in, offset, size, fd, limiter, PRIORITY_BULK)
+        body.seek(offset + copied)
+        if callback is not None:
+            callback(copied)
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, **kwargs):
+        self._request()
+        etag = self._write(Bucket, Key, lambda fd: self._write_from(fd, Body), Metadata)
+        return {'ETag': etag}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Callback=None):
+        self._request()
+        metadata = (ExtraArgs or {}).get('Metadata')
+        self._write(
+            Bucket, Key, lambda fd: self._write_from(fd, Fileobj, Callback), metadata
+        )
+
+    def delete_objects(self, Bucket, Delete):
+        self._request()
+        deleted = []
+        for obj in Delete['Objects']:
+            try:
+                os.remove(self._path(Bucket, obj['Key']))
+            except FileNotFoundError:
+                pass
+            self._remove_metadata(Bucket, obj['Key'])
+            deleted.append({'Key': obj['Key']})
+        return {'Deleted': deleted}
+
+    ############
+    # Metadata #
+    ############
+    def _set_metadata(self, bucket, key, etag, metadata):
+        # type: (str, str, str, dict) -> None
+        if not metadata:
+            return
+        metadata_dir = self._metadata_dir(bucket, key)
+        os.makedirs(metadata_dir, exist_ok=True)
+        filepath = os.path.join(metadata_dir, _etag_filename(etag))
+        with open(f'{filepath}.tmp', 'w') as f:
+            json.dump({'key': key, 'metadata': metadata}, f)
+        os.replace(f'{filepath}.tmp', filepath)
+
+    def _metadata(self, bucket, key, etag):
+        # type: (str, str, str) -> dict
+        filepath = os.path.join(self._metadata_dir(bucket, key), _etag_filename(etag))
+        try:
+            with open(filepath) as f:
+                return json.load(f)['metadata']
+        except FileNotFoundError:
+            return {}
+
+    def _remove_metadata(self, bucket, key, keep=None):
+        # type: (str, str, str | None) -> None
+        "Remove the metadata of earlier versions of `key`"
+        metadata_dir = self._metadata_dir(bucket, key)
+        try:
+            filenames = os.listdir(metadata_dir)
+        except FileNotFoundError:
+            return
+        for filename in filenames:
+            if keep is None or filename != _etag_filename(keep):
+                try:
+                    os.remove(os.path.join(metadata_dir, filename))
+                except FileNotFoundError:
+                    pass
+
+    ###########
+    # Reading #
+    ###########
+    def _open(self, bucket, key, operation_name):
+        # type: (str, str, str) -> tuple[int, os.stat_result]
+        try:
+            fd = os.open(self._path(bucket, key), os.O_RDONLY)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            if operation_name == 'GetObject':
+                raise _error(NoSuchKey, 'NoSuchKey', 404, operation_name) from None
+            # Like S3, errors of HEAD requests have no body
+            raise _error(ClientError, '404', 404, operation_name) from None
+        return fd, os.fstat(fd)
+
+    def _attributes(self, bucket, key, st):
+        # type: (str, str, os.stat_result) -> dict
+        etag = _etag(st)
+        return {
+            'ETag': etag,
+            'ContentLength': st.st_size,
+            'LastModified': datetime.fromtimestamp(st.st_mtime, timezone.utc),
+            'Metadata': self._metadata(bucket, key, etag),
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._request()
+        fd, st = self._open(Bucket, Key, 'HeadObject')
+        os.close(fd)
+        return self._attributes(Bucket, Key, st)
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        self._request()
+        fd, st = self._open(Bucket, Key, 'GetObject')
+        try:
+            response = self._attributes(Bucket, Key, st)
+            if IfMatch is not None and IfMatch != response['ETag']:
+                raise _error(ClientError, 'PreconditionFailed', 412, 'GetObject')
+            start, end = 0, st.st_size
+            if Range is not None:
+                byte_range = _parse_range(Range, st.st_size)
+                if byte_range is None:
+                    raise _error(ClientError, 'InvalidRange', 416, 'GetObject')
+                start, end = byte_range
+                response['ContentRange'] = f'bytes {start}-{end - 1}/{st.st_size}'
+        except BaseException:
+            os.close(fd)
+            raise
+        response['ContentLength'] = end - start
+        priority = request_priority({'Key': Key}, end - start)
+        response['Body'] = _Body(
+            fd, start, end - start, self.scheduler.download, priority
+        )
+        return response
+
+    def download_fileobj(self, Bucket, Key, Fileobj, Callback=None, **kwargs):
+        self._request()
+        fd, st = self._open(Bucket, Key, 'HeadObject')
+        body = _Body(fd, 0, st.st_size, self.scheduler.download, PRIORITY_BULK)
+        try:
+            if Callback is None:
+                body.copy_to(Fileobj)
+            else:
+                _copy_chunks(body, Fileobj, Callback)
+        finally:
+            body.close()
+
+    ###########
+    # Listing #
+    ###########
+    def get_paginator(self, operation_name):
+        if operation_name == 'list_objects_v2':
+            return _Paginator(self._list_objects)
+        if operation_name == 'list_multipart_uploads':
+            return _Paginator(self._list_multipart_uploads)
+        raise ValueError(f"`{operation_name}` isn't supported for file:// backups")
+
+    def _keys(self, bucket, prefix, delimiter):
+        # type: (str, str, str | None) -> Iterator[tuple[str, os.stat_result | None]]
+        """`(key, stat)` of the objects under `prefix` -- with `delimiter` the
+        common prefixes of deeper keys come as `(common_prefix, None)`"""
+        if delimiter not in (None, '', '/'):
+            raise _error(
+                ClientError,
+                'NotImplemented',
+                501,
+                'ListObjectsV2',
+                f'Listing with the delimiter "{delimiter}" isn\'t supported for file:// backups',
+            )
+        bucket_dir = self._bucket_dir(bucket)
+        key_dir = prefix.rpartition('/')[0]
+        walk_dir = (
+            os.path.join(bucket_dir, *key_dir.split('/')) if key_dir else bucket_dir
+        )
+        key_prefix = f'{key_dir}/' if key_dir else ''
+
+        def _walk(dir_path, key_prefix):
+            try:
+                entries = list(os.scandir(dir_path))
+            except (FileNotFoundError, NotADirectoryError):
+                return
+            for entry in entries:
+                if entry.name.startswith(TMP_PREFIX) or (
+                    dir_path == bucket_dir and entry.name == STATE_DIRNAME
+                ):
+                    continue
+                key = f'{key_prefix}{entry.name}'
+                if entry.is_dir(follow_symlinks=False):
+                    dir_key = f'{key}/'
+                    if not (dir_key.startswith(prefix) or prefix.startswith(dir_key)):
+                        continue
+                    if delimiter and dir_key.startswith(prefix):
+                        yield dir_key, None
+                    else:
+                        yield from _walk(entry.path, dir_key)
+                elif key.startswith(prefix) and entry.is_file():
+                    yield key, entry.stat()
+
+        return _walk(walk_dir, key_prefix)
+
+    def _list_objects(
+        self,
+        Bucket,
+        Prefix='',
+        Delimiter=None,
+        StartAfter='',
+        ContinuationToken=None,
+        MaxKeys=MAX_KEYS,
+        **kwargs,
+    ):
+        self._request()
+        start_after = max(StartAfter, ContinuationToken or '')
+        # S3 lists keys in the order of their UTF-8 bytes
+        keys = sorted(
+            (
+                (key, st)
+                for key, st in self._keys(Bucket, Prefix, Delimiter)
+                if key > start_after
+            ),
+            key=lambda item: item[0].encode(),
+        )
+        page_keys = keys[:MaxKeys]
+        page = {
+            'Contents': [
+                {
+                    'Key': key,
+                    'Size': st.st_size,
+                    'ETag': _etag(st),
+                    'LastModified': datetime.fromtimestamp(st.st_mtime, timezone.utc),
+                }
+                for key, st in page_keys
+                if st is not None
+            ],
+            'CommonPrefixes': [{'Prefix': key} for key, st in page_keys if st is None],
+            'KeyCount': len(page_keys),
+            'IsTruncated': len(keys) > MaxKeys,
+        }
+        if len(keys) > MaxKeys:
+            return page, {'ContinuationToken': page_keys[-1][0]}
+        return page, None
+
+    #############
+    # Multipart #
+    #############
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._request()
+        self._path(Bucket, Key)
+        upload_id = secrets.token_hex(16)
+        upload_dir = self._upload_dir(Bucket, upload_id)
+        os.makedirs(upload_dir)
+        with open(os.path.join(upload_dir, 'upload.json'), 'w') as f:
+            json.dump(
+                {'key': Key, 'initiated': datetime.now(timezone.utc).timestamp()}, f
+            )
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def _upload(self, bucket, upload_id, operation_name):
+        # type: (str, str, str) -> tuple[str, dict]
+        upload_dir = self._upload_dir(bucket, upload_id)
+        try:
+            with open(os.path.join(upload_dir, 'upload.json')) as f:
+                return upload_dir, json.load(f)
+        except FileNotFoundError:
+            raise _error(NoSuchUpload, 'NoSuchUpload', 404, operation_name) from None
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._request()
+        upload_dir, _ = self._upload(Bucket, UploadId, 'UploadPart')
+        part_path = os.path.join(upload_dir, f'{PartNumber:05}')
+        tmp_path = f'{part_path}.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            self._write_from(fd, Body)
+            os.fsync(fd)
+            etag = _etag(os.fstat(fd))
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, part_path)
+        return {'ETag': etag}
+
+    def complete_multipart_upload(
+        self, Bucket, Key, UploadId, MultipartUpload, **kwargs
+    ):
+        self._request()
+        upload_dir, _ = self._upload(Bucket, UploadId, 'CompleteMultipartUpload')
+
+        def _concatenate(fd_out):
+            for part in MultipartUpload['Parts']:
+                part_path = os.path.join(upload_dir, f'{part["PartNumber"]:05}')
+                try:
+                    fd_in = os.open(part_path, os.O_RDONLY)
+                except FileNotFoundError:
+                    raise _error(
+                        ClientError, 'InvalidPart', 400, 'CompleteMultipartUpload'
+                    ) from None
+                try:
+                    st = os.fstat(fd_in)
+                    if _etag(st) != part['ETag']:
+                        raise _error(
+                            ClientError, 'InvalidPart', 400, 'CompleteMultipartUpload'
+                        )
+                    # Already counted against the limit by `upload_part()`
+                    _copy_range(fd_in, 0, st.st_size, fd_out)
+                finally:
+                    os.close(fd_in)
+
+        etag = self._write(Bucket, Key, _concatenate)
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._request()
+        upload_dir, _ = self._upload(Bucket, UploadId, 'AbortMultipartUpload')
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return {}
+
+    def _list_multipart_uploads(self, Bucket, Prefix='', **kwargs):
+        self._request()
+        uploads = []
+        multipart_dir = self._state_dir(Bucket, 'multipart')
+        try:
+            upload_ids = os.listdir(multipart_dir)
+        except FileNotFoundError:
+            upload_ids = []
+        for upload_id in upload_ids:
+            try:
+                with open(os.path.join(multipart_dir, upload_id, 'upload.json')) as f:
+                    upload = json.load(f)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if upload['key'].startswith(Prefix):
+                uploads.append(
+                    {
+                        'Key': upload['key'],
+                        'UploadId': upload_id,
+                        'Initiated': datetime.fromtimestamp(
+                            upload['initiated'], timezone.utc
+                        ),
+                    }
+                )
+        uploads.sort(key=lambda upload: (upload['Key'], upload['Initiated']))
+        return {'Uploads': uploads, 'IsTruncated': False}, None
+
+
+def _etag_filename(etag):
+    # type: (str) -> str
+    return f'{etag.strip(chr(34))}.json'
@@ -0,0 +1,428 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from constants import PARTIAL_SUFFIX
+from utils import cache_root
+
+"""
+Resumable transfers
+-------------------
+
+An `upload` or `download` that dies halfway -- e.g. a nightly job over a
+flaky link -- continues where it stopped the next time it's run for the same
+directory and backup. `TransferJournal` records the progress in a SQLite
+database in `CACHE_PATH/transfers/`:
+
+- `buckets` -- the buckets `upload` builds, keyed by their contents
+  (`bucket_key()`: the path, hash and size of each file, and the name of a
+  repacked bucket). A bucket with the same contents gets the same name on
+  the next run. It isn't built again if its `.bitumen`-file is still in the
+  working directory and has the recorded checksums, and it isn't uploaded
+  again if the object in the bucket still has the recorded `ETag`.
+- `multipart` and `parts` -- buckets larger than `MULTIPART_THRESHOLD` are
+  uploaded in parts (`upload_file()`), `PART_JOBS` at a time, and the upload
+  ID and each part are recorded as it completes, so an interrupted upload continues with the missing
+  parts. It's only continued for a file with the same checksum.
+- `files` -- the files `download` has written, with their size and
+  modification time, so they aren't hashed again when the download is
+  resumed (see `walk_sorted(known_hashes=...)`).
+- `partials` -- files larger than `PART_SIZE` are downloaded to
+  `.<name>.bitum-part` next to the file first (`partial_path()`), and continue
+  from the end of it if the file in the backup is still the same.
+
+The journal is cleared once the transfer has gone through. The multipart
+uploads left in it then (of buckets that were no longer needed) are
+aborted, and so are multipart uploads of `.bitumen`-files in the bucket that
+aren't in the journal and were started more than `STALE_UPLOAD_AGE` ago
+(`abort_stale_uploads()`) -- S3 keeps (and bills) the parts of a multipart
+upload until it's completed or aborted.
+"""
+
+TRANSFERS_DIRNAME = 'transfers'
+MULTIPART_THRESHOLD = 16 * 2**20  # 16 MiB
+PART_SIZE = 16 * 2**20  # 16 MiB
+# S3 allows at most 10,000 parts per upload
+MAX_PARTS = 10_000
+# Parts of one multipart upload that are uploaded at the same time
+PART_JOBS = 4
+STALE_UPLOAD_AGE = 24 * 60 * 60  # 1 day
+# Written files are recorded at most this often (in seconds)
+COMMIT_INTERVAL = 1.0
+
+
+def journal_path(kind, endpoint_url, bucket, prefix, base_path):
+    # type: (str, str | None, str, str, str) -> str
+    "Path of the journal of `kind` (`upload`/`download`) between `base_path` and a backup"
+    key = json.dumps([kind, endpoint_url, bucket, prefix, os.path.realpath(base_path)])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_root(), TRANSFERS_DIRNAME, f'{digest}.sqlite3')
+
+
+def bucket_key(bucket_file_list, bucket_name=None):
+    # type: (list[DirEntry], str | None) -> str
+    "Key of the contents of a bucket -- with the `bucket_name` of a repacked bucket"
+    key = hashlib.sha256(f'{bucket_name or ""}\n'.encode())
+    for entry in bucket_file_list:
+        key.update(
+            f'{entry.file_path}\0{entry.file_hash}\0{entry.file_size}\n'.encode()
+        )
+    return key.hexdigest()
+
+
+def partial_path(filepath):
+    # type: (str) -> str
+    dirname, basename = os.path.split(filepath)
+    return os.path.join(dirname, f'.{basename}{PARTIAL_SUFFIX}')
+
+
+def part_size(size):
+    # type: (int) -> int
+    "Size of the parts of a multipart upload of `size` bytes"
+    return max(PART_SIZE, -(-size // MAX_PARTS))
+
+
+class TransferJournal:
+    "The progress of a transfer, kept at `path` (see above)"
+
+    def __init__(self, path):
+        # type: (str) -> None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Used by the threads of `BucketBuilder` and `Uploader`
+        self.con = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS buckets(
+                bucket_name TEXT PRIMARY KEY,
+                key TEXT NOT NULL,
+                db_entries TEXT,
+                checksums TEXT,
+                etag TEXT
+            );
+            CREATE INDEX IF NOT EXISTS buckets_key ON buckets(key);
+            CREATE TABLE IF NOT EXISTS multipart(
+                object_key TEXT PRIMARY KEY,
+                upload_id TEXT NOT NULL,
+                content_id TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS parts(
+                upload_id TEXT NOT NULL,
+                part_number INTEGER NOT NULL,
+                etag TEXT NOT NULL,
+                PRIMARY KEY(upload_id, part_number)
+            );
+            CREATE TABLE IF NOT EXISTS files(
+                path TEXT PRIMARY KEY,
+                file_hash TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS partials(
+                path TEXT PRIMARY KEY,
+                file_hash TEXT NOT NULL
+            );
+            """
+        )
+        self._lock = threading.Lock()
+        self._written = []
+        self._last_commit = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self.con.close()
+
+    def _execute(self, sql, parameters=()):
+        # type: (str, Sequence) -> list[tuple]
+        with self._lock, self.con:
+            return self.con.execute(sql, parameters).fetchall()
+
+    # `upload`
+
+    def name_bucket(self, key, bucket_name):
+        # type: (str, str) -> str
+        "Name of the bucket with the contents `key` -- `bucket_name` unless an earlier run named it"
+        with self._lock, self.con:
+            row = self.con.execute(
+                'SELECT bucket_name FROM buckets WHERE key = ?', [key]
+            ).fetchone()
+            if row is not None:
+                return row[0]
+            # A repacked bucket with other contents than before starts over
+            self.con.execute(
+                'INSERT OR REPLACE INTO buckets(bucket_name, key) VALUES(?, ?)',
+                [bucket_name, key],
+            )
+            return bucket_name
+
+    def built(self, bucket_name):
+        # type: (str) -> tuple[list[tuple], tuple[str, list[str]]] | None
+        "The index entries and checksums of `bucket_name` if it has been built"
+        rows = self._execute(
+            'SELECT db_entries, checksums FROM buckets WHERE bucket_name = ? AND checksums IS NOT NULL',
+            [bucket_name],
+        )
+        if not rows:
+            return None
+        db_entries, checksums = rows[0]
+        db_entries = [tuple(row) for row in json.loads(db_entries)]
+        return db_entries, tuple(json.loads(checksums))
+
+    def set_built(self, bucket_name, db_entries, checksums):
+        # type: (str, list[tuple], tuple[str, list[str]]) -> None
+        self._execute(
+            'UPDATE buckets SET db_entries = ?, checksums = ?, etag = NULL WHERE bucket_name = ?',
+            [json.dumps(db_entries), json.dumps(checksums), bucket_name],
+        )
+
+    def uploaded_etag(self, bucket_name):
+        # type: (str) -> str | None
+        rows = self._execute(
+            'SELECT etag FROM buckets WHERE bucket_name = ?', [bucket_name]
+        )
+        return rows[0][0] if rows else None
+
+    def set_uploaded(self, bucket_name, etag):
+        # type: (str, str) -> None
+        self._execute(
+            'UPDATE buckets SET etag = ? WHERE bucket_name = ?', [etag, bucket_name]
+        )
+
+    def multipart_upload(self, object_key, content_id):
+        # type: (str, str) -> tuple[str, dict[int, str]] | None
+        "The upload ID and the ETag of each completed part of an upload of `content_id`"
+        rows = self._execute(
+            'SELECT upload_id FROM multipart WHERE object_key = ? AND content_id = ?',
+            [object_key, content_id],
+        )
+        if not rows:
+            return None
+        upload_id = rows[0][0]
+        parts = self._execute(
+            'SELECT part_number, etag FROM parts WHERE upload_id = ?', [upload_id]
+        )
+        return upload_id, dict(parts)
+
+    def add_multipart_upload(self, object_key, upload_id, content_id):
+        # type: (str, str, str) -> None
+        self._execute(
+            'INSERT OR REPLACE INTO multipart VALUES(?, ?, ?)',
+            [object_key, upload_id, content_id],
+        )
+
+    def add_part(self, upload_id, part_number, etag):
+        # type: (str, int, str) -> None
+        self._execute(
+            'INSERT OR REPLACE INTO parts VALUES(?, ?, ?)',
+            [upload_id, part_number, etag],
+        )
+
+    def remove_multipart_upload(self, object_key):
+        # type: (str) -> None
+        with self._lock, self.con:
+            self.con.execute(
+                'DELETE FROM parts WHERE upload_id IN (SELECT upload_id FROM multipart WHERE object_key = ?)',
+                [object_key],
+            )
+            self.con.execute('DELETE FROM multipart WHERE object_key = ?', [object_key])
+
+    def multipart_upload_ids(self):
+        # type: () -> set[str]
+        return {row[0] for row in self._execute('SELECT upload_id FROM multipart')}
+
+    def abort_uploads(self, s3_client, bucket):
+        # type: (S3Client, str) -> int
+        "Abort the multipart uploads in the journal -- returns how many"
+        rows = self._execute('SELECT object_key, upload_id FROM multipart')
+        for object_key, upload_id in rows:
+            try:
+                s3_client.abort_multipart_upload(
+                    Bucket=bucket, Key=object_key, UploadId=upload_id
+                )
+            except s3_client.exceptions.NoSuchUpload:
+                pass
+            self.remove_multipart_upload(object_key)
+        return len(rows)
+
+    # `download`
+
+    def known_hashes(self):
+        # type: () -> dict[str, tuple[int, int, str]]
+        "`(file_size, mtime_ns, file_hash)` of each file written by the download"
+        return {
+            path: (file_size, mtime_ns, file_hash)
+            for path, file_hash, file_size, mtime_ns in self._execute(
+                'SELECT path, file_hash, file_size, mtime_ns FROM files'
+            )
+        }
+
+    def add_file(self, path, file_hash, disk_filepath):
+        # type: (str, str, str) -> None
+        "Record that `path` has been written to `disk_filepath` (in batches)"
+        stat = os.stat(disk_filepath)
+        self._written.append((path, file_hash, stat.st_size, stat.st_mtime_ns))
+        if time.time() - self._last_commit > COMMIT_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self._written:
+            with self._lock, self.con:
+                self.con.executemany(
+                    'INSERT OR REPLACE INTO files VALUES(?, ?, ?, ?)', self._written
+                )
+            self._written = []
+        self._last_commit = time.time()
+
+    def partial_offset(self, path, file_hash, part_filepath):
+        # type: (str, str, str) -> int
+        """Bytes of `path` already downloaded to `part_filepath`
+
+        That's 0 unless the partial file is of the same `file_hash`, which is
+        recorded for the next run.
+        """
+        rows = self._execute('SELECT file_hash FROM partials WHERE path = ?', [path])
+        if rows and rows[0][0] == file_hash and os.path.exists(part_filepath):
+            return os.path.getsize(part_filepath)
+        self._execute('INSERT OR REPLACE INTO partials VALUES(?, ?)', [path, file_hash])
+        return 0
+
+    def remove_partial(self, path):
+        # type: (str) -> None
+        self._execute('DELETE FROM partials WHERE path = ?', [path])
+
+    def clear(self):
+        "The transfer has gone through -- forget everything"
+        self._written = []
+        with self._lock, self.con:
+            for table in ['buckets', 'multipart', 'parts', 'files', 'partials']:
+                self.con.execute(f'DELETE FROM {table}')
+
+
+def upload_file(s3_client, bucket, object_key, filepath, journal, content_id):
+    # type: (S3Client, str, str, str, TransferJournal, str) -> str
+    """Upload `filepath` to `object_key` -- returns the `ETag` of the object
+
+    Files larger than `MULTIPART_THRESHOLD` are uploaded in parts, which are
+    recorded in `journal` so that an interrupted upload of the same
+    `content_id` continues with the missing parts.
+    """
+    size = os.path.getsize(filepath)
+    if size <= MULTIPART_THRESHOLD:
+        with open(filepath, 'rb') as f:
+            return s3_client.put_object(Bucket=bucket, Key=object_key, Body=f)['ETag']
+    try:
+        return _upload_parts(
+            s3_client, bucket, object_key, filepath, size, journal, content_id
+        )
+    except s3_client.exceptions.NoSuchUpload:
+        # Aborted in the meantime (e.g. by a lifecycle rule) -- start over
+        journal.remove_multipart_upload(object_key)
+        return _upload_parts(
+            s3_client, bucket, object_key, filepath, size, journal, content_id
+        )
+
+
+def _upload_parts(s3_client, bucket, object_key, filepath, size, journal, content_id):
+    # type: (S3Client, str, str, str, int, TransferJournal, str) -> str
+    upload = journal.multipart_upload(object_key, content_id)
+    if upload is None:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=object_key)[
+            'UploadId'
+        ]
+        journal.add_multipart_upload(object_key, upload_id, content_id)
+        parts = {}
+    else:
+        upload_id, parts = upload
+
+    chunk_size = part_size(size)
+
+    def _upload_part(part_number, offset):
+        with open(filepath, 'rb') as f:
+            f.seek(offset)
+            body = f.read(chunk_size)
+        response = s3_client.upload_part(
+            Bucket=bucket,
+            Key=object_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        return response['ETag']
+
+    with ThreadPoolExecutor(max_workers=PART_JOBS) as executor:
+        futures = {
+            executor.submit(_upload_part, part_number, offset): part_number
+            for part_number, offset in enumerate(range(0, size, chunk_size), start=1)
+            if part_number not in parts
+        }
+        errors = []
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            err = future.exception()
+            if err is not None:
+                # The parts that haven't started are skipped, the ones that
+                # have are still recorded
+                for pending in futures:
+                    pending.cancel()
+                errors.append(err)
+                continue
+            part_number = futures[future]
+            parts[part_number] = future.result()
+            journal.add_part(upload_id, part_number, parts[part_number])
+    if errors:
+        raise errors[0]
+
+    response = s3_client.complete_multipart_upload(
+        Bucket=bucket,
+        Key=object_key,
+        UploadId=upload_id,
+        MultipartUpload={
+            'Parts': [
+                {'PartNumber': part_number, 'ETag': parts[part_number]}
+                for part_number in sorted(parts)
+            ]
+        },
+    )
+    journal.remove_multipart_upload(object_key)
+    return response['ETag']
+
+
+def abort_stale_uploads(s3_client, bucket, prefix, journal):
+    # type: (S3Client, str, str, TransferJournal) -> int
+    """Abort the multipart uploads of `.bitumen`-files under `prefix` that
+    aren't in `journal` and were started more than `STALE_UPLOAD_AGE` ago
+
+    Returns how many were aborted.
+    """
+    ours = journal.multipart_upload_ids()
+    num_aborted = 0
+    paginator = s3_client.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for upload in page.get('Uploads', []):
+            name = upload['Key'][len(prefix) :]
+            if (
+                '/' in name
+                or not name.endswith('.bitumen')
+                or upload['UploadId'] in ours
+                or time.time() - upload['Initiated'].timestamp() < STALE_UPLOAD_AGE
+            ):
+                continue
+            try:
+                s3_client.abort_multipart_upload(
+                    Bucket=bucket, Key=upload['Key'], UploadId=upload['UploadId']
+                )
+            except s3_client.exceptions.NoSuchUpload:
+                continue
+            num_aborted += 1
+    return num_aborted
@@ -0,0 +1,218 @@
+from array import array
+import hashlib
+import sys
+
+from index import Index, sort_key
+from utils import DirEntry, DirEntryProps, file_digest, iter_disk_files
+
+DIGEST_SIZE = hashlib.blake2b().digest_size
+
+
+class DirTree:
+    """Compact, column-oriented representation of a file tree
+
+    `dirtree_from_disk()` and `dirtree_from_db()` keep every file around as a
+    `DirEntry` in a `set` *and* as a `DirEntryProps` in a `dict`, which for
+    large trees means millions of Python objects. `DirTree` instead stores
+    each property as a column:
+
+    - directory paths are interned once in `dirs` (along with the part of
+      the file paths before the name in `prefixes`, e.g. `/a/` for `/a/b`),
+      and each file only stores the index of its directory in `dir_ids`
+      along with its (interned) name
+    - sizes and permissions are stored in `array`s
+    - hashes are stored as binary digests back-to-back in a single `bytearray`
+
+    Columns that weren't requested (e.g. `hashes=False`) are left empty, and
+    the corresponding `DirEntry` field is `None`.
+
+    Once sorted (`.sort()`), entries are in index order (see
+    `index.sort_key()`) and lookups are done by binary search. `DirEntry`
+    tuples are only created on demand.
+    """
+
+    __slots__ = (
+        'dirs',
+        'prefixes',
+        'dir_ids',
+        'names',
+        'sizes',
+        'perms',
+        'hashes',
+        'digest_size',
+        'has_hashes',
+        'has_sizes',
+        'has_perms',
+        '_dir_index',
+        '_is_sorted',
+    )
+
+    def __init__(self, hashes=False, sizes=False, perms=False, digest_size=DIGEST_SIZE):
+        self.dirs = []
+        self.prefixes = []
+        self.dir_ids = array('L')
+        self.names = []
+        self.sizes = array('q')
+        self.perms = array('l')
+        self.hashes = bytearray()
+        self.digest_size = digest_size
+        self.has_hashes = hashes
+        self.has_sizes = sizes
+        self.has_perms = perms
+        self._dir_index = {}
+        self._is_sorted = True
+
+    def append(self, file_path, file_hash=None, file_size=None, file_perms=None):
+        # type: (str, bytes | None, int | None, int | None) -> None
+        dirname, separator, name = file_path.rpartition('/')
+        # `a` and `/a` are both in the directory `''`
+        prefix = dirname + separator
+        dir_id = self._dir_index.get(prefix)
+        if dir_id is None:
+            dir_id = len(self.dirs)
+            self.dirs.append(dirname)
+            self.prefixes.append(prefix)
+            self._dir_index[prefix] = dir_id
+
+        if self._is_sorted and self.names:
+            self._is_sorted = self.key(len(self.names) - 1) < (dirname, name)
+
+        self.dir_ids.append(dir_id)
+        self.names.append(sys.intern(name))
+        if self.has_sizes:
+            self.sizes.append(file_size)
+        if self.has_perms:
+            self.perms.append(file_perms)
+        if self.has_hashes:
+            if len(file_hash) != self.digest_size:
+                raise ValueError(
+                    f'Hash of "{file_path}" is {len(file_hash)} bytes (expected {self.digest_size})'
+                )
+            self.hashes += file_hash
+
+    def path(self, i):
+        # type: (int) -> str
+        return self.prefixes[self.dir_ids[i]] + self.names[i]
+
+    def key(self, i):
+        # type: (int) -> tuple[str, str]
+        return self.dirs[self.dir_ids[i]], self.names[i]
+
+    def props(self, i):
+        # type: (int) -> DirEntryProps
+        if self.has_hashes:
+            offset = i * self.digest_size
+            file_hash = self.hashes[offset : offset + self.digest_size].hex()
+        else:
+            file_hash = None
+
+        return DirEntryProps(
+            file_type='F',
+            file_hash=file_hash,
+            file_size=self.sizes[i] if self.has_sizes else None,
+            file_perms=self.perms[i] if self.has_perms else None,
+        )
+
+    def entry(self, i):
+        # type: (int) -> DirEntry
+        return DirEntry(self.path(i), *self.props(i))
+
+    def sort(self):
+        "Sort entries in index order"
+        if self._is_sorted:
+            return
+
+        order = sorted(range(len(self.names)), key=self.key)
+        self.dir_ids = array('L', (self.dir_ids[i] for i in order))
+        self.names = [self.names[i] for i in order]
+        if self.has_sizes:
+            self.sizes = array('q', (self.sizes[i] for i in order))
+        if self.has_perms:
+            self.perms = array('l', (self.perms[i] for i in order))
+        if self.has_hashes:
+            size = self.digest_size
+            hashes = bytearray()
+            for i in order:
+                hashes += self.hashes[i * size : (i + 1) * size]
+            self.hashes = hashes
+        self._is_sorted = True
+
+    def index(self, file_path):
+        # type: (str) -> int | None
+        "Binary search for `file_path` -- returns `None` if it isn't in the tree"
+        self.sort()
+        key = sort_key(file_path)
+        lo, hi = 0, len(self.names)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.names) and self.key(lo) == key:
+            return lo
+        return None
+
+    def get(self, file_path, default=None):
+        # type: (str, DirEntryProps | None) -> DirEntryProps | None
+        i = self.index(file_path)
+        return default if i is None else self.props(i)
+
+    def __getitem__(self, file_path):
+        # type: (str) -> DirEntryProps
+        i = self.index(file_path)
+        if i is None:
+            raise KeyError(file_path)
+        return self.props(i)
+
+    def __contains__(self, file_path):
+        return self.index(file_path) is not None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        self.sort()
+        for i in range(len(self.names)):
+            yield self.entry(i)
+
+    @classmethod
+    def from_db(
+        cls, db_filepath, return_hashes=False, return_sizes=False, return_perms=False
+    ):
+        # type: (str, bool, bool, bool) -> DirTree
+        "Like `dirtree_from_db()` but iterates the cursor instead of `fetchall()`"
+        tree = cls(hashes=return_hashes, sizes=return_sizes, perms=return_perms)
+        with Index(db_filepath) as index:
+            for row in index.iter_rows():
+                tree.append(
+                    row.file_path,
+                    file_hash=bytes.fromhex(row.file_hash) if return_hashes else None,
+                    file_size=row.file_size,
+                    file_perms=row.file_perms,
+                )
+
+        return tree
+
+    @classmethod
+    def from_disk(
+        cls,
+        base_path,
+        return_hashes=False,
+        return_sizes=False,
+        return_perms=False,
+        exclude_pattern=None,
+    ):
+        # type: (str, bool, bool, bool, re.Pattern | None) -> DirTree
+        "Like `dirtree_from_disk()` but builds a `DirTree`"
+        tree = cls(hashes=return_hashes, sizes=return_sizes, perms=return_perms)
+        for rel_path, abs_path, st in iter_disk_files(base_path, exclude_pattern):
+            tree.append(
+                rel_path,
+                file_hash=file_digest(abs_path) if return_hashes else None,
+                file_size=st.st_size,
+                file_perms=st.st_mode,
+            )
+        tree.sort()
+
+        return tree
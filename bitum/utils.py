@@ -3,14 +3,18 @@ import configparser
 import hashlib
 from itertools import cycle
 import os
-import shutil
 import sqlite3
 import stat
 import time
 
 import boto3
+from botocore.config import Config
 
-from constants import CONFIG_PATH
+from constants import CACHE_PATH, CONFIG_PATH, PARTIAL_SUFFIX
+from metrics import span
+from read_order import READ_WINDOW, drop_cached, prefetch_window
+from scheduler import Scheduler, schedule
+from storage import LocalStorage
 
 DirEntry = namedtuple(
     'DirEntry', ['file_path', 'file_type', 'file_hash', 'file_size', 'file_perms']
@@ -21,19 +25,32 @@ DirEntryProps = namedtuple(
 
 
 class TimedMessage:
+    "Prints `message`, and how long the block took -- also a span of `metrics.py`"
+
     def __init__(self, message):
         self.message = message
+        self._span = span(message.rstrip('.'))
 
     def __enter__(self):
         print(f'{self.message}', end=' ', flush=True)
+        self._span.__enter__()
         self.t_begin = time.time()
 
     def __exit__(self, *exc_details):
         self.t_end = time.time()
         self.duration = self.t_end - self.t_begin
+        self._span.__exit__(*exc_details)
         print(f'Done ({self.duration:.2f}s)')
 
 
+def cache_root():
+    # type: () -> str
+    "The directory bitum caches files in (`$XDG_CACHE_HOME/bitum` or `CACHE_PATH`)"
+    if os.getenv('XDG_CACHE_HOME'):
+        return os.path.join(os.getenv('XDG_CACHE_HOME'), 'bitum')
+    return os.path.expanduser(CACHE_PATH)
+
+
 def chunks(l, size):
     # type: (list[T], int) -> list[T]
     i = 0
@@ -42,24 +59,50 @@ def chunks(l, size):
         i += size
 
 
-def build_bucket(dir, bucket_name, bucket_file_list):
-    # type: (str, str, str, list[str]) -> list[tuple[str, str, int, int, str, str]]
+def build_bucket(
+    dir,
+    bucket_name,
+    bucket_file_list,
+    show_progress=True,
+    read_order='walk',
+    drop_cache=False,
+):
+    # type: (str, str, list[DirEntry], bool, str, bool) -> list[tuple[str, str, int, int, str, str]]
+    """Write the files of `bucket_file_list` back-to-back to `<bucket_name>.bitumen`
+
+    The files are written in the order of the list. Unless `read_order` is
+    `walk` the next window of files is prefetched in that order while a
+    window is written, and with `drop_cache` they're dropped from the page
+    cache once read (see `read_order.py`).
+    """
     db_entries = []
+    # `file_props.file_path` starts with a `/`. When `os.path.join()`
+    # sees this, it ignores all preceding arguments and just starts the
+    # path there, which is not what we want. Therefore the `.lstrip()`.
+    paths = [
+        os.path.join(dir, file_props.file_path.lstrip('/'))
+        for file_props in bucket_file_list
+    ]
 
+    def _prefetch(start):
+        end = start + READ_WINDOW
+        prefetch_window(
+            paths[start:end],
+            [file_props.file_size for file_props in bucket_file_list[start:end]],
+            read_order,
+        )
 
     progress_str = ''
     bytes_written = 0
     with open(f'{bucket_name}.bitumen', 'wb') as f_bitumen:
-        for i, file_props in enumerate(bucket_file_list):
-            if i % 1000 == 0:
+        _prefetch(0)
+        for i, (file_props, path) in enumerate(zip(bucket_file_list, paths)):
+            if show_progress and i % 1000 == 0:
                 progress_str = f'{i}/{len(bucket_file_list)}\r'
                 print(progress_str, end='', flush=True)
-            # `file_props.file_path` starts with a `/`. When `os.path.join()`
-            # sees this, it ignores all preceding arguments and just starts the
-            # path there, which is not what we want. Therefore the `.lstrip()`.
-            with open(
-                os.path.join(dir, file_props.file_path.lstrip('/')), 'rb'
-            ) as f_input:
+            if i % READ_WINDOW == 0:
+                _prefetch(i + READ_WINDOW)
+            with open(path, 'rb') as f_input:
                 db_entries.append(
                     (
                         bucket_name,
@@ -71,12 +114,22 @@ def build_bucket(dir, bucket_name, bucket_file_list):
                     )
                 )
                 bytes_written += f_bitumen.write(f_input.read())
-        print(' ' * len(progress_str) + '\r', end='', flush=True)
+            if drop_cache:
+                drop_cached(path)
+        if show_progress:
+            print(' ' * len(progress_str) + '\r', end='', flush=True)
 
     return db_entries
 
 
-def get_s3_client(endpoint_url=None):
+def get_s3_client(endpoint_url=None, upload_limit=None, download_limit=None):
+    """S3 client whose requests go through a `Scheduler` (see `scheduler.py`)
+
+    An `endpoint_url` like `file:///mnt/nas` gives a `LocalStorage` of that
+    directory instead (see `storage.py`). `upload_limit` and `download_limit`
+    are in bytes per second, and override `upload_limit` and
+    `download_limit` of the config.
+    """
     config = configparser.ConfigParser()
     config.read(os.path.expanduser(CONFIG_PATH))
 
@@ -87,6 +140,13 @@ def get_s3_client(endpoint_url=None):
         exit(1)
 
     config_dict = config['default'] if 'default' in config else {}
+    endpoint_url = endpoint_url or config['default']['endpoint_url']
+    scheduler = Scheduler(
+        upload_limit=upload_limit or parse_size(config_dict.get('upload_limit')),
+        download_limit=download_limit or parse_size(config_dict.get('download_limit')),
+    )
+    if endpoint_url.startswith('file://'):
+        return LocalStorage.from_url(endpoint_url, scheduler)
 
     # Environment variables override config
     aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID') or config_dict.get(
@@ -111,13 +171,16 @@ def get_s3_client(endpoint_url=None):
     )
     s3_client = session.client(
         's3',
-        endpoint_url=endpoint_url or config['default']['endpoint_url'],
+        endpoint_url=endpoint_url,
+        # Requests are retried by the scheduler instead (see `scheduler.py`)
+        config=Config(retries={'mode': 'standard', 'total_max_attempts': 1}),
     )
 
-    return s3_client
+    return schedule(s3_client, scheduler)
 
 
-def download_s3_file(s3_client, bucket, s3_path, target_path):
+def download_s3_file(s3_client, bucket, s3_path, target_path, total_bytes=None):
+    "`total_bytes` is the size of the object, if known (e.g. from an `Inventory`)"
     try:
         from tqdm import tqdm
 
@@ -125,8 +188,9 @@ def download_s3_file(s3_client, bucket, s3_path, target_path):
     except ImportError:
         has_tqdm = False
 
-    meta_data = s3_client.head_object(Bucket=bucket, Key=s3_path)
-    total_bytes = int(meta_data.get('ContentLength', 0))
+    if has_tqdm and total_bytes is None:
+        meta_data = s3_client.head_object(Bucket=bucket, Key=s3_path)
+        total_bytes = int(meta_data.get('ContentLength', 0))
 
     with open(target_path, 'wb') as f:
         if has_tqdm:
@@ -189,7 +253,27 @@ def pp_file_size(size_bytes):
         return f'{value:.2f} {unit}'
 
 
+def parse_size(value):
+    # type: (str | None) -> int | None
+    "Bytes from e.g. `500K`, `10M` or `1G` (powers of 1024) -- `None` for no value"
+    if not value:
+        return None
+    value = value.strip().upper()
+    for suffix in ['IB', 'B']:
+        if value.endswith(suffix):
+            value = value[: -len(suffix)]
+            break
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
 def pp_file_perms(perms):
+    if perms is None:
+        # `upload` doesn't store permissions
+        return '?' * 9
+
     CONST_FILE_PERMS = [
         stat.S_IRUSR,
         stat.S_IWUSR,
@@ -221,84 +305,8 @@ def print_file_diff(path1, op, path2, width, extras1=None, extras2=None):
     print(f'{path1} {op} {path2}')
 
 
-def print_tree_diff(args, set_tree1, tree1, set_tree2, tree2):
-    diff = set_tree1 - set_tree2
-
-    if len(set_tree1) == 0 and len(set_tree2) == 0:
-        print('Both DISK and BACKUP are empty')
-        return
-    elif len(diff) == 0:
-        print('No changes! Backup is up-to-date')
-        return
-
-    dir1 = 'DISK'
-    dir2 = 'BACKUP'
-
-    width = max(max(len(e.file_path) for e in diff), len(dir1))
-    max_path_length = max(len(e.file_path) for e in diff)
-    if not args.skip_perms:
-        # Include permissions in width
-        max_path_length += len(' (xxxxxxxxx)')
-    if not args.skip_hashes:
-        # Include hash in width
-        max_path_length += len(' (xxxxxx)')
-    width = max(max_path_length, len(dir1))
-    # Don't go beyond half the width of the terminal
-    width = min(width, shutil.get_terminal_size().columns // 2)
-    print_file_diff(dir1, '<->', dir2, width)
-    visited = set()
-    for dir_entry in sorted(
-        diff,
-        key=lambda e: e.file_path + '/' if e.file_type == 'D' else e.file_path,
-    ):
-        path = dir_entry.file_path
-        if path in visited:
-            continue
-        else:
-            visited.add(path)
-
-        if path in tree1 and path not in tree2:
-            if dir_entry.file_type == 'D':
-                path += '/'
-            print_file_diff(path, ' ->', '', width)
-        elif path not in tree1 and path in tree2:
-            if dir_entry.file_type == 'D':
-                path += '/'
-            print_file_diff('', '<- ', path, width)
-        elif tree1[path].file_type != tree2[path].file_type:
-            path1 = path
-            path2 = path
-            if tree1[path].file_type == 'D':
-                path1 += '/'
-            if tree2[path].file_type == 'D':
-                path2 += '/'
-            file_type1 = tree1[path].file_type
-            file_type2 = tree2[path].file_type
-            print_file_diff(
-                path1, '<->', path2, width, extras1=file_type1, extras2=file_type2
-            )
-        elif tree1[path].file_size != tree2[path].file_size:
-            file_size1 = pp_file_size(tree1[path].file_size)
-            file_size2 = pp_file_size(tree2[path].file_size)
-            print_file_diff(
-                path, '<->', path, width, extras1=file_size1, extras2=file_size2
-            )
-        elif tree1[path].file_hash != tree2[path].file_hash:
-            file_hash1 = tree1[path].file_hash
-            file_hash2 = tree2[path].file_hash
-            print_file_diff(
-                path, '<->', path, width, extras1=file_hash1[:6], extras2=file_hash2[:6]
-            )
-        elif tree1[path].file_perms != tree2[path].file_perms:
-            file_perms1 = pp_file_perms(tree1[path].file_perms)
-            file_perms2 = pp_file_perms(tree2[path].file_perms)
-            print_file_diff(
-                path, '<->', path, width, extras1=file_perms1, extras2=file_perms2
-            )
-
-
 # hash_func=hashlib.md5, block_size=2 ** 20
-def file_hash(path, hash_func=hashlib.blake2b, block_size=8192):
+def file_digest(path, hash_func=hashlib.blake2b, block_size=8192):
     with open(path, 'rb') as f:
         hash_sum = hash_func()
         while True:
@@ -306,45 +314,36 @@ def file_hash(path, hash_func=hashlib.blake2b, block_size=8192):
             if not chunk:
                 break
             hash_sum.update(chunk)
-    return hash_sum.hexdigest()
-    # return hash_sum.digest()
+    return hash_sum.digest()
 
 
-def dirtree_from_disk(
-    base_path,
-    return_hashes=False,
-    return_sizes=False,
-    return_perms=False,
-    exclude_pattern=None,
-):
-    # type: (str, bool, bool, bool, re.Pattern | None) -> tuple[set[DirEntry], dict[str, DirEntryProps]]
-    """Build a `set` of tuples for each file under the given filepath
-
-    The tuples are of the form
+def file_hash(path, hash_func=hashlib.blake2b, block_size=8192):
+    return file_digest(path, hash_func=hash_func, block_size=block_size).hex()
 
-        (file_path, file_type, file_hash, file_size, file_perms)
 
-    For directories `file_hash` is always `None`.
+def iter_disk_files(base_path, exclude_pattern=None):
+    # type: (str, re.Pattern | None) -> Iterator[tuple[str, str, os.stat_result]]
+    """Yield `(rel_path, abs_path, st)` for each file under `base_path`
 
-    From: github.com/malthejorgensen/difftree.
+    Directories, excluded paths, broken symlinks and partial downloads are
+    skipped.
     """
-    tree = dict()
-    set_dirtree = set()
     for dirpath, dirnames, filenames in os.walk(base_path):
-        dir_entries = [(f, 'F') for f in filenames] + [(d, 'D') for d in dirnames]
-
-        for entry, entry_type in dir_entries:
+        for entry in filenames:
+            if entry.endswith(PARTIAL_SUFFIX):
+                continue
             abs_path = os.path.join(dirpath, entry)
             rel_path = abs_path[len(base_path) :]
+            if not rel_path.startswith('/'):
+                # `base_path` ended in a `/` -- paths always start with one
+                # (like in `diff.walk_sorted()`)
+                rel_path = f'/{rel_path}'
 
             if exclude_pattern and exclude_pattern.match(rel_path):
                 continue
 
-            if entry_type == 'D':
-                continue
-
             try:
-                stat = os.stat(abs_path)
+                st = os.stat(abs_path)
             except FileNotFoundError:
                 # When symlink points to a directory or file that does not exist
                 continue
@@ -355,21 +354,43 @@ def dirtree_from_disk(
                 else:
                     raise
 
-            file_props = {
-                'file_type': entry_type,
-                'file_hash': file_hash(abs_path) if return_hashes else None,
-                # 'file_size': os.path.getsize(filepath),
-                'file_size': stat.st_size
-                if return_sizes and entry_type == 'F'
-                else None,
-                'file_perms': stat.st_mode if return_perms else None,
-            }
-            dir_entry = DirEntry(
-                file_path=rel_path,
-                **file_props,
-            )
-            set_dirtree.add(dir_entry)
-            tree[rel_path] = DirEntryProps(**file_props)
+            yield rel_path, abs_path, st
+
+
+def dirtree_from_disk(
+    base_path,
+    return_hashes=False,
+    return_sizes=False,
+    return_perms=False,
+    exclude_pattern=None,
+):
+    # type: (str, bool, bool, bool, re.Pattern | None) -> tuple[set[DirEntry], dict[str, DirEntryProps]]
+    """Build a `set` of tuples for each file under the given filepath
+
+    The tuples are of the form
+
+        (file_path, file_type, file_hash, file_size, file_perms)
+
+    For directories `file_hash` is always `None`.
+
+    From: github.com/malthejorgensen/difftree.
+    """
+    tree = dict()
+    set_dirtree = set()
+    for rel_path, abs_path, st in iter_disk_files(base_path, exclude_pattern):
+        file_props = {
+            'file_type': 'F',
+            'file_hash': file_hash(abs_path) if return_hashes else None,
+            # 'file_size': os.path.getsize(filepath),
+            'file_size': st.st_size if return_sizes else None,
+            'file_perms': st.st_mode if return_perms else None,
+        }
+        dir_entry = DirEntry(
+            file_path=rel_path,
+            **file_props,
+        )
+        set_dirtree.add(dir_entry)
+        tree[rel_path] = DirEntryProps(**file_props)
 
     return set_dirtree, tree
 
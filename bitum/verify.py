@@ -0,0 +1,184 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import math
+import random
+
+from index import Index
+from inventory import Inventory
+from utils import TimedMessage, pp_file_size
+
+"""
+Verifying the remote files
+--------------------------
+
+`debug integrity remote-db remote-files` (or `local-db`) checks that the
+`.bitumen`-files in the bucket hold what the index says they do, without
+downloading them. Their sizes come from a single listing of the prefix (see
+`inventory.py`), which also finds `.bitumen`-files that aren't in the index.
+
+When a bucket is built, a checksum of each block of `checksum_block_size`
+bytes is stored in the index (see `index.py`). Verifying a bucket reads
+each block with a Range request and compares its hash. Buckets built before
+checksums were stored are verified file by file against the hash of each
+file instead.
+
+The blocks (or files) are read by a pool of `jobs` threads, and each response
+is hashed in chunks as it arrives, so at most `jobs` requests are in flight
+and memory use doesn't depend on the block size. `--download-limit` (or
+`download_limit` of the config) bounds the bandwidth (see `scheduler.py`). With `sample` only that
+percentage of the blocks and files -- picked at random on each run -- is
+read, so regular sampled runs cover the whole backup over time while reading
+only a fraction of it each time.
+"""
+
+CHUNK_SIZE = 2**16  # 64 KiB
+DEFAULT_JOBS = 8
+
+# A range of a `.bitumen`-file to read and the hash it should have.
+# `name` is the block index or the path of the file.
+Unit = namedtuple('Unit', ['bucket', 'name', 'offset', 'size', 'expected_hash'])
+Failure = namedtuple('Failure', ['bucket', 'name', 'message'])
+
+
+def bucket_checksums(filepath, block_size):
+    # type: (str, int) -> tuple[str, list[str]]
+    "The hash of each block of `filepath` and the hash of the block hashes"
+    block_hashes = []
+    bucket_hash = hashlib.blake2b()
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block and block_hashes:
+                break
+            block_hash = hashlib.blake2b(block).digest()
+            bucket_hash.update(block_hash)
+            block_hashes.append(block_hash.hex())
+            if len(block) < block_size:
+                break
+    return bucket_hash.hexdigest(), block_hashes
+
+
+def _units(index, bucket_name, object_size):
+    # type: (Index, str, int) -> tuple[list[Unit], str | None]
+    "The units to verify `bucket_name` by and the expected bucket hash (if any)"
+    checksums = index.checksums(bucket_name)
+    if checksums is not None:
+        bucket_hash, block_hashes = checksums
+        block_size = int(index.get_meta('checksum_block_size'))
+        units = []
+        for block_index, block_hash in enumerate(block_hashes):
+            offset = block_index * block_size
+            size = min(block_size, object_size - offset)
+            units.append(Unit(bucket_name, block_index, offset, size, block_hash))
+        return units, bucket_hash
+
+    # No checksums -- verify each file against its hash
+    return [
+        Unit(bucket_name, row.file_path, row.byte_index, row.file_size, row.file_hash)
+        for row in index.bucket_rows(bucket_name)
+        if row.file_hash is not None and row.file_size
+    ], None
+
+
+def _read_hash(s3_client, bucket, key, unit):
+    # type: (S3Client, str, str, Unit) -> tuple[bytes, int]
+    "Hash of the range of `unit` and the number of bytes read"
+    h = hashlib.blake2b()
+    size = 0
+    if unit.size > 0:
+        response = s3_client.get_object(
+            Bucket=bucket,
+            Key=key,
+            Range=f'bytes={unit.offset}-{unit.offset + unit.size - 1}',
+        )
+        for chunk in response['Body'].iter_chunks(CHUNK_SIZE):
+            h.update(chunk)
+            size += len(chunk)
+    return h.digest(), size
+
+
+def verify_remote_files(
+    s3_client, bucket, prefix, db_filepaths, sample=100, jobs=DEFAULT_JOBS, seed=None
+):
+    # type: (S3Client, str, str, Iterable[str], float, int, int | None) -> list[Failure]
+    """Verify the `.bitumen`-files at `prefix` against the indexes at `db_filepaths`
+
+    Returns the blocks and files that couldn't be verified, as well as
+    orphaned `.bitumen`-files (see `inventory.py`).
+    """
+    failures = []
+    units = []
+    bucket_hashes = {}
+    bucket_names = set()
+    with TimedMessage('Listing blocks to verify...'):
+        inventory = Inventory(s3_client, bucket, prefix)
+        for db_filepath in db_filepaths:
+            with Index(db_filepath) as index:
+                for bucket_name, size in index.buckets():
+                    bucket_names.add(bucket_name)
+                    object_size = inventory.size(bucket_name)
+                    if object_size is None:
+                        failures.append(Failure(bucket_name, None, 'Missing'))
+                        continue
+                    if object_size < size:
+                        failures.append(
+                            Failure(
+                                bucket_name,
+                                None,
+                                f'Is {object_size} bytes but files end at byte {size}',
+                            )
+                        )
+                        continue
+                    bucket_units, bucket_hash = _units(index, bucket_name, object_size)
+                    units += bucket_units
+                    if bucket_hash is not None:
+                        bucket_hashes[bucket_name] = bucket_hash
+
+    num_units = len(units)
+    if sample < 100:
+        rand = random.Random(seed)
+        units = rand.sample(units, math.ceil(num_units * sample / 100))
+        # Read each bucket front to back
+        units.sort(key=lambda unit: (unit.bucket, unit.offset))
+
+    block_hashes = {}
+    num_bytes = 0
+
+    def _verify(unit):
+        return unit, _read_hash(
+            s3_client, bucket, f'{prefix}{unit.bucket}.bitumen', unit
+        )
+
+    with TimedMessage(
+        f'Verifying {len(units)} of {num_units} blocks and files in {len(bucket_names)} buckets...'
+    ):
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for unit, (digest, size) in executor.map(_verify, units):
+                num_bytes += size
+                if digest.hex() != unit.expected_hash:
+                    failures.append(Failure(unit.bucket, unit.name, 'Hash mismatch'))
+                if unit.bucket in bucket_hashes:
+                    block_hashes.setdefault(unit.bucket, []).append(digest)
+    print(f'Read {pp_file_size(num_bytes)}')
+
+    # When every block of a bucket has been read, the bucket hash can be checked
+    # as well -- this catches blocks missing from the index
+    if sample >= 100:
+        for bucket_name, bucket_hash in bucket_hashes.items():
+            h = hashlib.blake2b()
+            for digest in block_hashes.get(bucket_name, []):
+                h.update(digest)
+            if h.hexdigest() != bucket_hash:
+                failures.append(Failure(bucket_name, None, 'Bucket hash mismatch'))
+
+    for obj in inventory.orphans(bucket_names):
+        failures.append(
+            Failure(
+                obj.bucket_name,
+                None,
+                f'Orphaned -- not in the index ({pp_file_size(obj.size)})',
+            )
+        )
+
+    return failures
@@ -0,0 +1,396 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import os
+import secrets
+import select
+import signal
+import sqlite3
+import struct
+import sys
+import time
+
+from path_filter import WILDCARD_CHARS, PathFilter
+from utils import cache_root
+
+"""
+Watch mode
+----------
+
+`bitum watch DIR` watches every directory under `DIR` with inotify (Linux
+only) and records the paths that changed in a journal, so that `upload` only
+has to walk and diff those paths instead of the whole tree.
+
+The journal is a SQLite database in `CACHE_PATH/journals/<hash of DIR>/`:
+`dirty` holds the changed paths (relative to `DIR`, like in the index) in the
+order they were recorded, and `meta` holds:
+
+- `epoch` -- a random ID set when the watcher is watching every directory,
+  and replaced when it misses events (the kernel's event queue overflowed).
+  It's removed when the watcher starts or stops.
+- `baseline` -- the epoch of the last upload, and `index_state` the
+  `index_id` and `delta_seq` of each index it left behind. `upload` only uses
+  the journal if `baseline` is the current epoch -- i.e. the watcher has been
+  running without missing events since the last upload read the disk -- and
+  nothing else has uploaded to the backup since. Otherwise the whole tree is
+  walked (like without a watcher), and the journal is used from then on.
+
+A watcher holds a lock on `watch.lock` in the journal directory while it's
+running, so `upload` knows whether there is one (a watcher that dies
+releases it).
+
+Events reach the watcher a little after the change, so before it reads the
+journal, `upload` creates a fence file in the journal directory (which is
+watched as well) and waits for the watcher to record it in `meta`. The
+kernel delivers the events of a watcher in order, so every change made
+before the fence is in the journal by then. Once the upload has gone
+through, the paths up to the fence are removed from the journal.
+
+A changed path is a file or a directory -- a new or moved directory is
+recorded as a whole, since files can be created in it before it's watched.
+`journal_filter()` turns the paths into a `PathFilter` (see
+`path_filter.py`), so only they and their parent directories are read on disk
+and in the index. With more than `MAX_JOURNAL_PATHS` paths the whole tree is
+walked instead.
+"""
+
+JOURNAL_DIRNAME = 'journals'
+JOURNAL_FILENAME = 'journal.sqlite3'
+MAX_JOURNAL_PATHS = 10_000
+FENCE_TIMEOUT = 5  # seconds
+FENCE_PREFIX = 'fence-'
+
+# From `sys/inotify.h`
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+# `struct inotify_event` without the name
+INOTIFY_EVENT = struct.Struct('=iIII')
+
+
+def journal_dir(base_path):
+    # type: (str) -> str
+    "Directory of the journal of the tree at `base_path`"
+    key = hashlib.sha256(os.path.realpath(base_path).encode()).hexdigest()[:16]
+    return os.path.join(cache_root(), JOURNAL_DIRNAME, key)
+
+
+class Inotify:
+    "Minimal `ctypes`-binding of inotify"
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path, mask):
+        # type: (str, int) -> int
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self, timeout=None):
+        # type: (float | None) -> list[tuple[int, int, str]]
+        "`(wd, mask, name)` of the events -- waits up to `timeout` seconds for any"
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 2**16)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset : offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            events.append((wd, mask, name))
+        return events
+
+
+class Journal:
+    "The journal of the tree at `base_path` (see above)"
+
+    def __init__(self, base_path):
+        # type: (str) -> None
+        self.dir = journal_dir(base_path)
+        os.makedirs(self.dir, exist_ok=True)
+        self.con = sqlite3.connect(os.path.join(self.dir, JOURNAL_FILENAME), timeout=30)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS dirty(
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL
+            );
+            """
+        )
+
+    @classmethod
+    def open_existing(cls, base_path):
+        # type: (str) -> Journal | None
+        "The journal of `base_path` -- `None` if no watcher has ever created one"
+        if not os.path.exists(os.path.join(journal_dir(base_path), JOURNAL_FILENAME)):
+            return None
+        return cls(base_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def get_meta(self, key):
+        # type: (str) -> str | None
+        row = self.con.execute('SELECT value FROM meta WHERE key = ?', [key]).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key, value):
+        # type: (str, str | None) -> None
+        with self.con:
+            self.con.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', [key, value])
+
+    def add(self, paths):
+        # type: (Iterable[str]) -> None
+        with self.con:
+            self.con.executemany(
+                'INSERT INTO dirty(path) VALUES(?)', [(path,) for path in paths]
+            )
+
+    def _lock_file(self):
+        return open(os.path.join(self.dir, 'watch.lock'), 'a')
+
+    def is_watched(self):
+        # type: () -> bool
+        "Whether a watcher is running"
+        with self._lock_file() as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
+
+    def fence(self):
+        # type: () -> tuple[str, int] | None
+        """Wait for the watcher to record everything up to now
+
+        Returns the epoch and the last `seq` -- `None` without a watcher that
+        watches every directory.
+        """
+        if not self.is_watched() or self.get_meta('epoch') is None:
+            return None
+        nonce = secrets.token_hex(8)
+        open(os.path.join(self.dir, f'{FENCE_PREFIX}{nonce}'), 'w').close()
+        deadline = time.time() + FENCE_TIMEOUT
+        while self.get_meta('fence') != nonce:
+            if time.time() > deadline:
+                return None
+            time.sleep(0.01)
+        # The watcher records the paths before the fence
+        (seq,) = self.con.execute('SELECT COALESCE(MAX(seq), 0) FROM dirty').fetchone()
+        return self.get_meta('epoch'), seq
+
+    def paths(self, seq):
+        # type: (int) -> list[str]
+        "The changed paths up to `seq` (without duplicates)"
+        return [
+            path
+            for (path,) in self.con.execute(
+                'SELECT DISTINCT path FROM dirty WHERE seq <= ?', [seq]
+            )
+        ]
+
+    def is_baseline(self, epoch, index_state):
+        # type: (str, str) -> bool
+        """Whether the journal has every change since the last upload
+
+        That is, the last upload was in `epoch` and the index is still as it
+        left it (`index_state`) -- nothing else has uploaded to the backup.
+        """
+        return (
+            self.get_meta('baseline') == epoch
+            and self.get_meta('index_state') == index_state
+        )
+
+    def consume(self, epoch, seq, index_state):
+        # type: (str, int, str) -> None
+        "The disk has been uploaded as of `seq` of `epoch`, leaving the index at `index_state`"
+        with self.con:
+            self.con.execute('DELETE FROM dirty WHERE seq <= ?', [seq])
+            self.con.executemany(
+                'INSERT OR REPLACE INTO meta VALUES(?, ?)',
+                [('baseline', epoch), ('index_state', index_state)],
+            )
+
+
+def journal_filter(paths):
+    # type: (list[str]) -> PathFilter | None
+    """`PathFilter` that reads only `paths` -- `None` if there are too many
+
+    Wildcards in a path are replaced by `?`, which matches them as well (as
+    well as a few more paths, which only means they're diffed too).
+    """
+    if len(paths) > MAX_JOURNAL_PATHS:
+        return None
+    table = str.maketrans({char: '?' for char in WILDCARD_CHARS})
+    return PathFilter(path.translate(table) for path in paths)
+
+
+class Watcher:
+    "Records the changes under `base_path` into its `Journal` (see above)"
+
+    def __init__(self, base_path):
+        # type: (str) -> None
+        self.base_path = base_path.rstrip('/') or '/'
+        self.journal = Journal(base_path)
+        self.inotify = Inotify()
+        # Watch descriptor -> path relative to `base_path` ('' for the root)
+        self.paths = {}
+        self.pending = set()
+        self.fence_wd = None
+
+    def _watch_tree(self, rel_dirpath):
+        # type: (str) -> None
+        "Watch the directory `rel_dirpath` and every directory under it"
+        stack = [rel_dirpath]
+        while stack:
+            rel_dirpath = stack.pop()
+            try:
+                wd = self.inotify.add_watch(self.base_path + rel_dirpath, WATCH_MASK)
+            except OSError as err:
+                if err.errno == errno.ENOSPC:
+                    raise OSError(
+                        err.errno,
+                        'Out of inotify watches -- raise `fs.inotify.max_user_watches`',
+                    ) from err
+                # Removed in the meantime or not a directory (anymore)
+                continue
+            # A directory that is moved keeps its watch, so this also updates
+            # the path of a moved directory
+            self.paths[wd] = rel_dirpath
+            try:
+                with os.scandir(self.base_path + rel_dirpath) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(f'{rel_dirpath}/{entry.name}')
+            except OSError:
+                continue
+
+    def _new_epoch(self):
+        self.journal.set_meta('epoch', secrets.token_hex(8))
+
+    def _handle(self, wd, mask, name):
+        # type: (int, int, str) -> None
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost -- the next upload has to walk the whole tree
+            print('Event queue overflowed -- the next upload scans everything')
+            self._new_epoch()
+            return
+        if wd == self.fence_wd:
+            if name.startswith(FENCE_PREFIX) and mask & IN_CREATE:
+                self._flush()
+                self.journal.set_meta('fence', name[len(FENCE_PREFIX) :])
+                try:
+                    os.remove(os.path.join(self.journal.dir, name))
+                except FileNotFoundError:
+                    pass
+            return
+        rel_dirpath = self.paths.get(wd)
+        if rel_dirpath is None:
+            return
+        if mask & IN_IGNORED:
+            # The directory was removed (which its parent records)
+            del self.paths[wd]
+            return
+        if not name:
+            # An event of the directory itself
+            return
+        rel_path = f'{rel_dirpath}/{name}'
+        self.pending.add(rel_path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._watch_tree(rel_path)
+
+    def _flush(self):
+        if self.pending:
+            self.journal.add(sorted(self.pending))
+            self.pending = set()
+
+    def run(self):
+        "Watch until interrupted"
+        with self.journal._lock_file() as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f'"{self.base_path}" is already being watched')
+                return 1
+
+            self.journal.set_meta('epoch', None)
+            # Stop as cleanly on `kill` as on Ctrl-C
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            self.fence_wd = self.inotify.add_watch(self.journal.dir, IN_CREATE)
+            t_begin = time.time()
+            self._watch_tree('')
+            self._new_epoch()
+            print(
+                f'Watching {len(self.paths)} directories under "{self.base_path}" ({time.time() - t_begin:.2f}s)'
+            )
+            try:
+                while True:
+                    for wd, mask, name in self.inotify.read():
+                        self._handle(wd, mask, name)
+                    self._flush()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self._flush()
+                self.journal.set_meta('epoch', None)
+                self.inotify.close()
+                self.journal.close()
+        return 0
+
+
+def watch(args):
+    if not sys.platform.startswith('linux'):
+        print('`bitum watch` needs inotify, which is only available on Linux')
+        return 1
+    return Watcher(args.dir).run()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""Benchmark in-memory tree representations
+
+Compares peak RSS and build time of `dirtree_from_db()`/`dirtree_from_disk()`
+against `DirTree.from_db()`/`DirTree.from_disk()`. Each measurement runs in a
+fresh interpreter so peak RSS isn't polluted by earlier runs.
+
+    python scripts/bench_dirtree.py --rows 800000
+    python scripts/bench_dirtree.py --dir ~/Programming
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bitum')
+)
+
+NAMES = [
+    '__init__.py',
+    'index.js',
+    'package.json',
+    'README.md',
+    'Makefile',
+    'main.go',
+    'utils.py',
+    'test.py',
+]
+
+
+def _random_name(rand):
+    if rand.random() < 0.3:
+        return rand.choice(NAMES)
+    length = rand.randint(3, 20)
+    return ''.join(rand.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def _random_bytes(rand, size):
+    # type: (random.Random, int) -> bytes
+    "`rand.randbytes(size)`, which is only in Python 3.9+"
+    if size == 0:
+        return b''
+    return rand.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def create_db(db_filepath, num_rows, seed=0):
+    # type: (str, int, int) -> None
+    "Create a `files`-table with `num_rows` synthetic rows"
+    rand = random.Random(seed)
+    dirs = ['']
+    con = sqlite3.connect(db_filepath)
+    cur = con.cursor()
+    cur.execute(
+        'CREATE TABLE files(bucket, file_path PRIMARY KEY, byte_index, file_size, file_hash, file_perms)'
+    )
+    rows = []
+    paths = set()
+    while len(paths) < num_rows:
+        # ~10 files per directory on average
+        if rand.random() < 0.1:
+            dirs.append(f'{rand.choice(dirs)}/{_random_name(rand)}')
+        path = f'{rand.choice(dirs)}/{_random_name(rand)}'
+        if path in paths:
+            continue
+        paths.add(path)
+        rows.append(
+            (
+                'bucket',
+                path,
+                0,
+                rand.randint(0, 2**20),
+                f'{rand.getrandbits(512):0128x}',
+                0o100644,
+            )
+        )
+    cur.executemany('INSERT INTO files VALUES(?, ?, ?, ?, ?, ?)', rows)
+    con.commit()
+    con.close()
+
+
+def peak_rss():
+    # type: () -> int
+    "Peak RSS of this process in bytes"
+    # `VmHWM` is reset on `exec()` whereas `ru_maxrss` is inherited from the
+    # parent, which has the synthetic DB's rows in memory
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    # `ru_maxrss` is in KiB on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+
+def run(impl, source):
+    # type: (str, str) -> dict
+    from tree import DirTree
+    from utils import dirtree_from_db, dirtree_from_disk
+
+    funcs = {
+        'dirtree_from_db': dirtree_from_db,
+        'DirTree.from_db': DirTree.from_db,
+        'dirtree_from_disk': dirtree_from_disk,
+        'DirTree.from_disk': DirTree.from_disk,
+    }
+    rss_before = peak_rss()
+    t_begin = time.time()
+    tree = funcs[impl](source, return_hashes=True, return_sizes=True, return_perms=True)
+    duration = time.time() - t_begin
+    rss_after = peak_rss()
+
+    return {
+        'impl': impl,
+        'files': len(tree[0]) if isinstance(tree, tuple) else len(tree),
+        'seconds': round(duration, 3),
+        'peak_rss_mib': round(rss_after / 2**20, 1),
+        'peak_rss_delta_mib': round((rss_after - rss_before) / 2**20, 1),
+    }
+
+
+def measure(impl, source):
+    # type: (str, str) -> dict
+    output = subprocess.check_output(
+        [sys.executable, __file__, '--run', impl, source], text=True
+    )
+    return json.loads(output)
+
+
+def entry():
+    argparser = argparse.ArgumentParser(
+        description='Benchmark peak RSS and build time of the tree representations'
+    )
+    argparser.add_argument(
+        '--rows', type=int, default=100_000, help='Number of rows in synthetic DB'
+    )
+    argparser.add_argument('--dir', help='Also benchmark building from this directory')
+    argparser.add_argument('--run', nargs=2, help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(*args.run)))
+        return
+
+    with tempfile.TemporaryDirectory() as tempdir_path:
+        db_filepath = os.path.join(tempdir_path, 'bitumen.sqlite3')
+        create_db(db_filepath, args.rows)
+        # Migrate to the current schema up front, so it isn't measured
+        from index import Index
+
+        Index(db_filepath, writable=True).close()
+        results = [
+            measure('dirtree_from_db', db_filepath),
+            measure('DirTree.from_db', db_filepath),
+        ]
+
+    if args.dir:
+        results += [
+            measure('dirtree_from_disk', args.dir),
+            measure('DirTree.from_disk', args.dir),
+        ]
+
+    for result in results:
+        print(
+            f'{result["impl"]:<18} {result["files"]:>9} files '
+            f'{result["seconds"]:>8.2f}s '
+            f'{result["peak_rss_mib"]:>8.1f} MiB peak RSS '
+            f'(+{result["peak_rss_delta_mib"]:.1f} MiB)'
+        )
+
+
+if __name__ == '__main__':
+    entry()
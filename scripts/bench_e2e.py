@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""End-to-end benchmark of bitum against a local S3 stand-in
+
+Generates reproducible synthetic trees and runs each phase of bitum on them
+against the in-memory S3 stand-in of `scripts/s3_standin.py`, served from
+this process -- or, with `--storage local`, against a directory through the
+local storage backend (see `bitum/storage.py`):
+
+- `tiny` -- many files of up to a few KiB
+- `mixed` -- files of a few KiB to a few MiB
+- `huge` -- a few files larger than a multipart upload part
+- `deep` -- small files in directories nested dozens of levels deep
+
+The phases are `scan` (walk the tree), `hash` (walk and hash it like
+`upload`), `build` (`debug build`), `extract`, `diff` (`debug diff-local`),
+`upload` and `download` (into an empty directory). The output of `extract`
+and `download` is checked against the tree.
+
+    python scripts/bench_e2e.py --output before.json
+    python scripts/bench_e2e.py --output after.json --compare before.json
+
+Each phase runs in a fresh interpreter (like `bench_dirtree.py`), so its
+peak RSS is its own. Files/s and MiB/s are of the whole tree, requests are
+counted by the stand-in (by bitum with `--storage local`). The trees were just written, so files are read
+from the page cache -- see `bench_read_order.py` for reading from disk.
+"""
+
+import argparse
+from datetime import datetime, timezone
+import http.client
+import json
+import os
+import platform
+import random
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_dirtree import _random_bytes, _random_name, peak_rss
+from s3_standin import Stats, make_argparser, make_server
+
+BITUM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bitum')
+sys.path.insert(0, BITUM_DIR)
+
+from diff import walk_sorted  # noqa: E402
+from metrics import METRICS  # noqa: E402
+from pipeline import DEFAULT_UPLOAD_JOBS, StageStats, hash_entries  # noqa: E402
+from utils import pp_file_size  # noqa: E402
+
+BUCKET = 'bench'
+TREES = ['tiny', 'mixed', 'huge', 'deep']
+STORAGES = ['memory', 'local']
+PHASES = ['scan', 'hash', 'build', 'extract', 'diff', 'upload', 'download']
+
+
+def _tree_files(tree, scale, rand):
+    # type: (str, float, random.Random) -> Iterator[tuple[str, int]]
+    "Paths and sizes of the files of `tree`"
+    dirs = ['']
+    if tree == 'tiny':
+        for i in range(int(20_000 * scale)):
+            # ~50 files per directory
+            if rand.random() < 0.02:
+                dirs.append(f'{rand.choice(dirs)}/{_random_name(rand)}.d')
+            yield (
+                f'{rand.choice(dirs)}/{i}-{_random_name(rand)}',
+                min(int(rand.expovariate(1 / 512)), 8192),
+            )
+    elif tree == 'mixed':
+        for i in range(int(2_000 * scale)):
+            if rand.random() < 0.05:
+                dirs.append(f'{rand.choice(dirs)}/{_random_name(rand)}.d')
+            if rand.random() < 0.01:
+                # 1-16 MiB, log-uniform
+                size = int(2 ** rand.uniform(20, 24))
+            else:
+                size = int(rand.expovariate(1 / 32768))
+            yield f'{rand.choice(dirs)}/{i}-{_random_name(rand)}', size
+    elif tree == 'huge':
+        for i in range(max(1, int(3 * scale))):
+            yield f'/{i}-{_random_name(rand)}', 48 * 2**20 + rand.randint(0, 2**20)
+    elif tree == 'deep':
+        for i in range(int(3_000 * scale)):
+            # New directories mostly go below the deepest ones
+            if rand.random() < 0.2:
+                parent = dirs[-1] if rand.random() < 0.7 else rand.choice(dirs)
+                if parent.count('/') < 60:
+                    dirs.append(f'{parent}/{_random_name(rand)}.d')
+            yield (
+                f'{rand.choice(dirs[-10:])}/{i}-{_random_name(rand)}',
+                int(rand.expovariate(1 / 2048)),
+            )
+
+
+def create_tree(base_path, tree, scale, seed):
+    # type: (str, str, float, int) -> tuple[int, int]
+    "Create the files of `tree` under `base_path` -- returns their number and size"
+    rand = random.Random(f'{tree}-{seed}')
+    num_files = 0
+    total_size = 0
+    for path, size in _tree_files(tree, scale, rand):
+        os.makedirs(os.path.dirname(base_path + path), exist_ok=True)
+        with open(base_path + path, 'wb') as f:
+            total_size += f.write(_random_bytes(rand, size))
+        num_files += 1
+    return num_files, total_size
+
+
+def _snapshot(tree_path):
+    # type: (str) -> list
+    return list(walk_sorted(tree_path, return_sizes=True, return_hashes=True))
+
+
+def run(phase, result_filepath, phase_args):
+    # type: (str, str, list[str]) -> None
+    "Run `phase` in this (fresh) interpreter and write its peak RSS and counters to `result_filepath`"
+    try:
+        if phase == 'scan':
+            for _ in walk_sorted(phase_args[0], return_sizes=True):
+                pass
+        elif phase == 'hash':
+            stats = [StageStats('walk', 'files'), StageStats('hash', 'files')]
+            entries = walk_sorted(phase_args[0], return_sizes=True)
+            for _ in hash_entries(entries, phase_args[0], DEFAULT_UPLOAD_JOBS, *stats):
+                pass
+        else:
+            sys.argv = ['cli.py', *phase_args]
+            runpy.run_path(os.path.join(BITUM_DIR, 'cli.py'), run_name='__main__')
+    finally:
+        with open(result_filepath, 'w') as f:
+            json.dump({'peak_rss': peak_rss(), 'counters': METRICS.counters}, f)
+
+
+def measure(phase, phase_args, cwd, env, stats):
+    # type: (str, list[str], str, dict, Stats | None) -> dict
+    """Run `phase` in a subprocess -- its time, peak RSS and requests
+
+    The requests are counted by the stand-in of `stats`, or by bitum itself
+    without one.
+    """
+    result_filepath = os.path.join(cwd, f'.{phase}.json')
+    before = stats.snapshot() if stats is not None else None
+    t_begin = time.perf_counter()
+    with open(os.path.join(cwd, f'{phase}.log'), 'w') as f_log:
+        subprocess.run(
+            [sys.executable, __file__, '--run', phase, result_filepath, *phase_args],
+            cwd=cwd,
+            env=env,
+            stdout=f_log,
+            stderr=subprocess.STDOUT,
+            check=True,
+        )
+    seconds = time.perf_counter() - t_begin
+    with open(result_filepath) as f:
+        result = json.load(f)
+    os.remove(result_filepath)
+    measured = {
+        'seconds': round(seconds, 3),
+        'peak_rss_mib': round(result['peak_rss'] / 2**20, 1),
+    }
+    if stats is None:
+        counters = result['counters']
+        return {
+            **measured,
+            'requests': counters.get('requests', 0),
+            'bytes_sent': counters.get('bytes_sent', 0),
+            'bytes_received': counters.get('bytes_received', 0),
+        }
+    after = stats.snapshot()
+    operations = {
+        operation: count - before['operations'].get(operation, 0)
+        for operation, count in sorted(after['operations'].items())
+        if count > before['operations'].get(operation, 0)
+    }
+    return {
+        **measured,
+        'requests': after['requests'] - before['requests'],
+        'operations': operations,
+        'bytes_sent': after['bytes_in'] - before['bytes_in'],
+        'bytes_received': after['bytes_out'] - before['bytes_out'],
+    }
+
+
+def bench_tree(tree, args, work_dir, endpoint_url, stats):
+    # type: (str, argparse.Namespace, str, str, Stats | None) -> dict
+    tree_dir = os.path.join(work_dir, tree)
+    src = os.path.join(tree_dir, 'src')
+    build_dir = os.path.join(tree_dir, 'build')
+    extract_dir = os.path.join(build_dir, 'extracted')
+    download_dir = os.path.join(tree_dir, 'download')
+    for path in [extract_dir, download_dir]:
+        os.makedirs(path)
+    num_files, total_size = create_tree(src, tree, args.scale, args.seed)
+    print(f'{tree}: {num_files} files ({pp_file_size(total_size)})', flush=True)
+
+    env = dict(
+        os.environ,
+        # Keep the config and the caches of the user out of it
+        HOME=tree_dir,
+        XDG_CACHE_HOME=os.path.join(tree_dir, 'cache'),
+        AWS_ACCESS_KEY_ID='bench',
+        AWS_SECRET_ACCESS_KEY='bench',
+        AWS_DEFAULT_REGION='us-east-1',
+    )
+    remote = ['--endpoint-url', endpoint_url, '--bucket', BUCKET, '--prefix', tree]
+    phase_args = {
+        'scan': [src],
+        'hash': [src],
+        'build': ['debug', 'build', src],
+        'extract': ['extract', extract_dir],
+        'diff': ['debug', 'diff-local', src],
+        'upload': ['upload', '--create', *remote, src],
+        'download': ['download', *remote, download_dir],
+    }
+    expected = _snapshot(src)
+    phases = {}
+    # In the order of `PHASES` -- `extract` and `diff` need `build`, and
+    # `download` needs `upload`
+    for phase in [phase for phase in PHASES if phase in args.phases]:
+        result = measure(phase, phase_args[phase], build_dir, env, stats)
+        if phase != 'scan':
+            result['mib_per_s'] = round(total_size / 2**20 / result['seconds'], 2)
+        result['files_per_s'] = round(num_files / result['seconds'], 1)
+        phases[phase] = result
+        print(
+            f'  {phase:<9}{result["seconds"]:>8.2f}s{result["files_per_s"]:>11.0f} files/s'
+            f'{result.get("mib_per_s", 0):>9.1f} MiB/s{result["peak_rss_mib"]:>8.1f} MiB RSS'
+            f'{result["requests"]:>7} requests',
+            flush=True,
+        )
+        if phase == 'extract':
+            _check(expected, extract_dir, phase)
+        elif phase == 'download':
+            _check(expected, download_dir, phase)
+
+    if not args.keep:
+        shutil.rmtree(tree_dir)
+    return {'files': num_files, 'bytes': total_size, 'phases': phases}
+
+
+def _check(expected, output_dir, phase):
+    # type: (list, str, str) -> None
+    if _snapshot(output_dir) != expected:
+        raise SystemExit(f'The output of `{phase}` differs from the tree')
+
+
+def compare(results, baseline):
+    # type: (dict, dict) -> None
+    "Print the change in time and peak RSS of each phase against `baseline`"
+    print(f'Compared to {baseline.get("commit") or "baseline"}:')
+    for tree, tree_result in results['trees'].items():
+        base_tree = baseline['trees'].get(tree)
+        if base_tree is None:
+            continue
+        for phase, result in tree_result['phases'].items():
+            base = base_tree['phases'].get(phase)
+            if base is None:
+                continue
+            print(
+                f'  {tree:<6}{phase:<9}'
+                f'{result["seconds"] / base["seconds"] - 1:>+8.1%} time'
+                f'{result["peak_rss_mib"] / base["peak_rss_mib"] - 1:>+8.1%} RSS'
+                f'{result["requests"] - base["requests"]:>+7} requests'
+            )
+
+
+def _git_commit():
+    # type: () -> str | None
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=BITUM_DIR,
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def entry():
+    argparser = argparse.ArgumentParser(
+        description='End-to-end benchmark of bitum against a local S3 stand-in'
+    )
+    argparser.add_argument(
+        '--trees', nargs='+', choices=TREES, default=TREES, metavar='tree'
+    )
+    argparser.add_argument(
+        '--phases', nargs='+', choices=PHASES, default=PHASES, metavar='phase'
+    )
+    argparser.add_argument(
+        '--scale', type=float, default=1.0, help='Multiply the number of files by this'
+    )
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument(
+        '--storage',
+        choices=STORAGES,
+        default='memory',
+        help='Back up to the in-memory S3 stand-in, or to a local directory (default: memory)',
+    )
+    argparser.add_argument(
+        '--output', default='bench_e2e.json', help='JSON file to write the results to'
+    )
+    argparser.add_argument('--compare', help='Earlier results to compare against')
+    argparser.add_argument(
+        '--dir', help='Directory to create the trees in (default: a temporary one)'
+    )
+    argparser.add_argument(
+        '--keep', action='store_true', help="Don't remove the trees afterwards"
+    )
+    argparser.add_argument('--run', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.run:
+        run(args.run[0], args.run[1], args.run[2:])
+        return
+
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    stats = server = None
+    if args.storage == 'memory':
+        # The stand-in keeps the objects in memory and doesn't throttle
+        stats = Stats()
+        server = make_server(make_argparser().parse_args(['--port', '0']), stats)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+        conn = http.client.HTTPConnection(host, port)
+        conn.request('PUT', f'/{BUCKET}')
+        conn.getresponse().read()
+        endpoint_url = f'http://{host}:{port}'
+    else:
+        storage_dir = os.path.join(work_dir, 'storage')
+        os.makedirs(storage_dir)
+        endpoint_url = f'file://{storage_dir}'
+
+    results = {
+        'commit': _git_commit(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'storage': args.storage,
+        'scale': args.scale,
+        'seed': args.seed,
+        'trees': {},
+    }
+    try:
+        for tree in args.trees:
+            results['trees'][tree] = bench_tree(
+                tree, args, work_dir, endpoint_url, stats
+            )
+    finally:
+        if server is not None:
+            server.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Wrote {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    entry()
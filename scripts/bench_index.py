@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Benchmark the index schema
+
+Builds an index with the original schema (version 1, a single `files`-table)
+and with the current schema from the same synthetic rows and times the
+queries that bitum runs against it. Rows are inserted one bucket at a time
+like `upload` does, and both schemas return `IndexRow`s.
+
+    python scripts/bench_index.py --rows 1000000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from bench_dirtree import _random_name
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bitum')
+)
+
+from index import SCHEMA_VERSION, Index, IndexRow  # noqa: E402
+from utils import pp_file_size  # noqa: E402
+
+BUCKET_SIZE = 100 * 2**20  # 100 MiB
+
+
+def synthetic_rows(num_rows, seed=0):
+    # type: (int, int) -> list[tuple[str, str, int, int, str, int]]
+    "Rows packed into buckets of 100 MiB like `_build_buckets()` does"
+    rand = random.Random(seed)
+    dirs = ['']
+    rows = []
+    paths = set()
+    bucket = 0
+    byte_index = 0
+    while len(paths) < num_rows:
+        # ~10 files per directory on average
+        if rand.random() < 0.1:
+            dirs.append(f'{rand.choice(dirs)}/{_random_name(rand)}')
+        path = f'{rand.choice(dirs)}/{_random_name(rand)}'
+        if path in paths:
+            continue
+        paths.add(path)
+        file_size = int(rand.expovariate(1 / 8192))
+        if byte_index + file_size > BUCKET_SIZE:
+            bucket += 1
+            byte_index = 0
+        rows.append(
+            (
+                f'bucket{bucket:04}',
+                path,
+                byte_index,
+                file_size,
+                f'{rand.getrandbits(512):0128x}',
+                0o100644,
+            )
+        )
+        byte_index += file_size
+    return rows
+
+
+def by_bucket(rows):
+    # type: (list[tuple]) -> list[list[tuple]]
+    buckets = {}
+    for row in rows:
+        buckets.setdefault(row[0], []).append(row)
+    return list(buckets.values())
+
+
+def timed(func, *args):
+    t_begin = time.time()
+    result = func(*args)
+    return time.time() - t_begin, result
+
+
+def build_v1(db_filepath, rows):
+    con = sqlite3.connect(db_filepath)
+    cur = con.cursor()
+    cur.execute(
+        'CREATE TABLE files(bucket, file_path PRIMARY KEY, byte_index, file_size, file_hash, file_perms)'
+    )
+    for bucket_rows in by_bucket(rows):
+        cur.executemany('INSERT INTO files VALUES(?, ?, ?, ?, ?, ?)', bucket_rows)
+    con.commit()
+    con.close()
+
+
+def build_v2(db_filepath, rows):
+    with Index(db_filepath, build=True) as index:
+        for bucket_rows in by_bucket(rows):
+            index.insert(bucket_rows)
+
+
+def queries_v1(db_filepath, paths, buckets):
+    con = sqlite3.connect(db_filepath)
+    # `Index` returns rows as `IndexRow`s too
+    con.row_factory = lambda _cur, row: IndexRow(*row)
+    cur = con.cursor()
+    results = {}
+    results['lookup'], _ = timed(
+        lambda: [
+            cur.execute(
+                'SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms FROM files WHERE file_path = ?',
+                [path],
+            ).fetchone()
+            for path in paths
+        ]
+    )
+    results['bucket'], _ = timed(
+        lambda: [
+            cur.execute(
+                'SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms FROM files WHERE bucket = ? ORDER BY byte_index',
+                [bucket],
+            ).fetchall()
+            for bucket in buckets
+        ]
+    )
+    results['scan'], _ = timed(
+        lambda: sum(
+            1
+            for _ in cur.execute(
+                'SELECT bucket, file_path, byte_index, file_size, file_hash, file_perms FROM files ORDER BY file_path'
+            )
+        )
+    )
+    con.close()
+    return results
+
+
+def queries_v2(db_filepath, paths, buckets):
+    results = {}
+    with Index(db_filepath) as index:
+        results['lookup'], _ = timed(lambda: [index.lookup(path) for path in paths])
+        results['bucket'], _ = timed(
+            lambda: [index.bucket_rows(bucket) for bucket in buckets]
+        )
+        results['scan'], _ = timed(lambda: sum(1 for _ in index.iter_rows()))
+    return results
+
+
+def entry():
+    argparser = argparse.ArgumentParser(description='Benchmark the index schema')
+    argparser.add_argument('--rows', type=int, default=1_000_000)
+    argparser.add_argument(
+        '--lookups', type=int, default=10_000, help='Number of lookups by path'
+    )
+    argparser.add_argument(
+        '--buckets', type=int, default=10, help='Number of buckets to list'
+    )
+    args = argparser.parse_args()
+
+    rows = synthetic_rows(args.rows)
+    rand = random.Random(1)
+    paths = [row[1] for row in rand.sample(rows, args.lookups)]
+    buckets = sorted(set(row[0] for row in rand.sample(rows, args.buckets)))
+
+    with tempfile.TemporaryDirectory() as tempdir_path:
+        results = []
+        for version, build, queries in [
+            ('v1', build_v1, queries_v1),
+            (f'v{SCHEMA_VERSION}', build_v2, queries_v2),
+        ]:
+            db_filepath = os.path.join(tempdir_path, f'{version}.sqlite3')
+            build_time, _ = timed(build, db_filepath, rows)
+            result = queries(db_filepath, paths, buckets)
+            result['build'] = build_time
+            result['size'] = os.path.getsize(db_filepath)
+            results.append((version, result))
+
+    print(f'{args.rows} rows, {len(buckets)} buckets, {len(paths)} lookups')
+    print(
+        f'{"schema":<8}{"size":>12}{"build":>10}{"lookups":>10}{"buckets":>10}{"scan":>10}'
+    )
+    for version, result in results:
+        print(
+            f'{version:<8}{pp_file_size(result["size"]):>12}'
+            f'{result["build"]:>9.2f}s{result["lookup"]:>9.2f}s'
+            f'{result["bucket"]:>9.2f}s{result["scan"]:>9.2f}s'
+        )
+
+
+if __name__ == '__main__':
+    entry()
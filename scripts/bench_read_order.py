@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Benchmark reading small files in walk, inode and physical order
+
+Creates a tree of small files in random order (so the walk order has nothing
+to do with the order on disk), then hashes them like `upload` and packs them
+into a bucket like `build_bucket()` with a cold page cache for each
+`--read-order`.
+
+    python scripts/bench_read_order.py --files 100000 --dir /mnt/hdd/bench
+
+The page cache is dropped through `/proc/sys/vm/drop_caches` when run as root
+and with `POSIX_FADV_DONTNEED` on each file otherwise (which leaves the
+metadata cached). Use `--dir` to benchmark a specific disk -- the default
+temporary directory is often tmpfs, where every order is the same.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from bench_dirtree import _random_bytes, _random_name
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bitum')
+)
+
+from diff import walk_sorted  # noqa: E402
+from pipeline import StageStats, hash_entries  # noqa: E402
+from read_order import READ_ORDERS, drop_cached  # noqa: E402
+from utils import build_bucket, pp_file_size  # noqa: E402
+
+
+def create_tree(base_path, num_files, seed=0):
+    # type: (str, int, int) -> int
+    "Create `num_files` files of a few KiB in random order -- returns their total size"
+    rand = random.Random(seed)
+    dirs = ['']
+    paths = set()
+    while len(paths) < num_files:
+        # ~100 files per directory on average. Directories have a suffix so
+        # their names never clash with files.
+        if rand.random() < 0.01:
+            dirs.append(f'{rand.choice(dirs)}/{_random_name(rand)}.d')
+        paths.add(f'{rand.choice(dirs)}/{_random_name(rand)}')
+    paths = sorted(paths)
+    for dir_path in dirs:
+        os.makedirs(base_path + dir_path, exist_ok=True)
+
+    rand.shuffle(paths)
+    total_size = 0
+    for path in paths:
+        size = int(rand.expovariate(1 / 4096))
+        with open(base_path + path, 'wb') as f:
+            total_size += f.write(_random_bytes(rand, size))
+    return total_size
+
+
+def drop_caches(base_path):
+    # type: (str) -> str
+    "Drop the files under `base_path` from the page cache -- returns how"
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return 'drop_caches'
+    except OSError:
+        for entry in walk_sorted(base_path):
+            drop_cached(base_path + entry.file_path)
+        return 'fadvise'
+
+
+def bench_hash(base_path, read_order, jobs):
+    # type: (str, str, int) -> float
+    t_begin = time.time()
+    entries = walk_sorted(base_path, return_sizes=True)
+    stats = [StageStats('walk', 'files'), StageStats('hash', 'files', jobs)]
+    for _ in hash_entries(entries, base_path, jobs, *stats, read_order=read_order):
+        pass
+    return time.time() - t_begin
+
+
+def bench_build(base_path, read_order, bucket_dir):
+    # type: (str, str, str) -> float
+    entries = list(walk_sorted(base_path, return_sizes=True))
+    cwd = os.getcwd()
+    os.chdir(bucket_dir)
+    try:
+        t_begin = time.time()
+        build_bucket(
+            base_path, 'bench', entries, show_progress=False, read_order=read_order
+        )
+        return time.time() - t_begin
+    finally:
+        os.remove('bench.bitumen')
+        os.chdir(cwd)
+
+
+def entry():
+    argparser = argparse.ArgumentParser(
+        description='Benchmark reading small files in walk, inode and physical order'
+    )
+    argparser.add_argument('--files', type=int, default=20_000)
+    argparser.add_argument('--jobs', type=int, default=4)
+    argparser.add_argument(
+        '--dir', help='Directory to create the files in (default: a temporary one)'
+    )
+    args = argparser.parse_args()
+
+    base_dir = tempfile.mkdtemp(dir=args.dir)
+    bucket_dir = tempfile.mkdtemp()
+    try:
+        base_path = os.path.join(base_dir, 'tree')
+        total_size = create_tree(base_path, args.files)
+        print(f'{args.files} files ({pp_file_size(total_size)}) in {base_dir}')
+
+        print(f'{"order":<10}{"hash":>10}{"build":>10}')
+        for read_order in READ_ORDERS:
+            how = drop_caches(base_path)
+            hash_time = bench_hash(base_path, read_order, args.jobs)
+            drop_caches(base_path)
+            build_time = bench_build(base_path, read_order, bucket_dir)
+            print(f'{read_order:<10}{hash_time:>9.2f}s{build_time:>9.2f}s')
+        print(f'Cold cache by {how}')
+    finally:
+        shutil.rmtree(base_dir)
+        shutil.rmtree(bucket_dir)
+
+
+if __name__ == '__main__':
+    entry()
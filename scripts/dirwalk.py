@@ -2,7 +2,6 @@
 import argparse
 import os
 import itertools
-import time
 
 
 def dirtree_from_disk(base_path):
@@ -37,20 +36,6 @@ def dirtree_from_disk(base_path):
     return list_dirtree, total_size
 
 
-class TimedMessage:
-    def __init__(self, message):
-        self.message = message
-
-    def __enter__(self):
-        print(f'{self.message}', end=' ', flush=True)
-        self.t_begin = time.time()
-
-    def __exit__(self, *exc_details):
-        self.t_end = time.time()
-        self.duration = self.t_end - self.t_begin
-        print(f'Done ({self.duration:.2f}s)')
-
-
 def entry():
     argparser = argparse.ArgumentParser(
         description='How fast can Python list recursively all files in?'
@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+"""Local S3 stand-in that throttles like an object store under load
+
+A reverse proxy in front of an S3-compatible server -- e.g. the MinIO of
+`test/test_full_cli_local.sh` -- that answers some of the requests with
+`503 SlowDown` (or `429 Too Many Requests` with `--status 429`), like S3, B2
+and R2 do:
+
+    python scripts/s3_standin.py --upstream http://127.0.0.1:9000 --port 9001 \\
+        --max-inflight 4 --error-rate 0.05
+    python bitum/cli.py upload --endpoint-url http://127.0.0.1:9001/ ...
+
+- `--max-inflight N` -- requests beyond `N` at a time are throttled
+- `--rate R` -- requests beyond `R` per second are throttled
+- `--error-rate P` -- a random fraction `P` of the requests is throttled
+- `--transient-rate P` -- a random fraction `P` fails with `500 InternalError`
+- `--latency S` -- each request is delayed by `S` seconds for every request
+  in flight, so the latency grows with the concurrency
+- `--retry-after S` -- throttled responses have a `Retry-After` header
+
+Requests are forwarded with their headers as they are (including `Host`),
+so their signatures stay valid. The counts are printed every `--report`
+seconds and on exit.
+
+Without `--upstream` the objects are kept in memory (`MemoryStore`) instead,
+which is enough for everything bitum does -- plain, ranged and conditional
+reads, multipart uploads and listings. `scripts/bench_e2e.py` runs it in
+its own process this way. Signatures aren't checked.
+"""
+
+import argparse
+from collections import Counter
+from datetime import datetime, timezone
+import hashlib
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import secrets
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+# Not forwarded (hop-by-hop)
+HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-length'}
+
+
+XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+MAX_KEYS = 1000
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.max_inflight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        # Requests by operation (see `operation_name()`), and bytes of the
+        # request and response bodies
+        self.operations = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def snapshot(self):
+        # type: () -> dict
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'failed': self.failed,
+                'max_inflight': self.max_inflight,
+                'operations': dict(self.operations),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+
+    def line(self):
+        return (
+            f'{self.requests} requests, {self.throttled} throttled, {self.failed} failed, '
+            f'at most {self.max_inflight} at a time'
+        )
+
+
+class TokenBucket:
+    "Allows `rate` requests per second (with bursts of up to `rate`)"
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.t_last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.t_last) * self.rate)
+            self.t_last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def operation_name(command, path):
+    # type: (str, str) -> str
+    "The S3 operation of a path-style request, e.g. `GetObject`"
+    url = urlsplit(path)
+    query = parse_qs(url.query, keep_blank_values=True)
+    has_key = '/' in url.path.strip('/')
+    if not has_key:
+        if command == 'GET':
+            return 'ListMultipartUploads' if 'uploads' in query else 'ListObjectsV2'
+        if command == 'POST' and 'delete' in query:
+            return 'DeleteObjects'
+        return {'PUT': 'CreateBucket', 'HEAD': 'HeadBucket'}.get(command, command)
+    if command == 'PUT':
+        return 'UploadPart' if 'uploadId' in query else 'PutObject'
+    if command == 'POST':
+        if 'uploads' in query:
+            return 'CreateMultipartUpload'
+        return 'CompleteMultipartUpload'
+    if command == 'DELETE':
+        return 'AbortMultipartUpload' if 'uploadId' in query else 'DeleteObject'
+    return {'GET': 'GetObject', 'HEAD': 'HeadObject'}[command]
+
+
+def _decode_aws_chunked(body):
+    # type: (bytes) -> bytes
+    "The payload of a body in `aws-chunked` encoding (without the trailers)"
+    chunks = []
+    pos = 0
+    while True:
+        end = body.index(b'\r\n', pos)
+        size = int(body[pos:end].split(b';')[0], 16)
+        if size == 0:
+            return b''.join(chunks)
+        chunks.append(body[end + 2 : end + 2 + size])
+        pos = end + 2 + size + 2
+
+
+def _timestamp(t):
+    # type: (float) -> str
+    return datetime.fromtimestamp(t, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def _xml(root, children):
+    # type: (str, str) -> bytes
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>\n<{root} xmlns="{XMLNS}">'
+        f'{children}</{root}>'
+    ).encode()
+
+
+class MemoryStore:
+    """Buckets of objects in memory
+
+    Objects are `(data, etag, mtime)`, multipart uploads `(key, initiated,
+    parts)` with `parts` of `part number -> (data, etag)`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.uploads = {}
+
+    def handle(self, command, path, headers, body):
+        # type: (str, str, Message, bytes) -> tuple[int, dict, bytes]
+        "Status, headers and body of the response to a path-style request"
+        url = urlsplit(path)
+        query = {
+            key: values[0]
+            for key, values in parse_qs(url.query, keep_blank_values=True).items()
+        }
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        key = unquote(key)
+        if 'aws-chunked' in headers.get('Content-Encoding', '') or headers.get(
+            'x-amz-decoded-content-length'
+        ):
+            body = _decode_aws_chunked(body)
+        with self.lock:
+            if not key:
+                return self._bucket_request(command, bucket, query, body)
+            if bucket not in self.buckets:
+                return self._error(404, 'NoSuchBucket', bucket)
+            return self._object_request(command, bucket, key, query, headers, body)
+
+    def _error(self, status, code, resource):
+        # Like S3, errors have no namespace
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<Error><Code>{code}</Code><Message>{code}</Message>'
+            f'<Resource>{escape(resource)}</Resource></Error>'
+        ).encode()
+        return status, {'Content-Type': 'application/xml'}, body
+
+    def _bucket_request(self, command, bucket, query, body):
+        if command == 'PUT':
+            self.buckets.setdefault(bucket, {})
+            return 200, {}, b''
+        if bucket not in self.buckets:
+            return self._error(404, 'NoSuchBucket', bucket)
+        objects = self.buckets[bucket]
+        if command == 'HEAD':
+            return 200, {}, b''
+        if command == 'POST' and 'delete' in query:
+            deleted = []
+            for key_element in ElementTree.fromstring(body).iter(f'{{{XMLNS}}}Key'):
+                objects.pop(key_element.text, None)
+                deleted.append(
+                    f'<Deleted><Key>{escape(key_element.text)}</Key></Deleted>'
+                )
+            return 200, {}, _xml('DeleteResult', ''.join(deleted))
+        if command == 'GET' and 'uploads' in query:
+            prefix = query.get('prefix', '')
+            uploads = ''.join(
+                f'<Upload><Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId>'
+                f'<Initiated>{_timestamp(initiated)}</Initiated></Upload>'
+                for upload_id, (upload_bucket, key, initiated, _) in sorted(
+                    self.uploads.items(), key=lambda item: item[1][1]
+                )
+                if upload_bucket == bucket and key.startswith(prefix)
+            )
+            return (
+                200,
+                {},
+                _xml(
+                    'ListMultipartUploadsResult',
+                    f'<Bucket>{bucket}</Bucket><IsTruncated>false</IsTruncated>{uploads}',
+                ),
+            )
+        if command == 'GET':
+            return 200, {}, self._list(bucket, objects, query)
+        return self._error(405, 'MethodNotAllowed', bucket)
+
+    def _list(self, bucket, objects, query):
+        # type: (str, dict, dict) -> bytes
+        "ListObjectsV2 of `objects`"
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter', '')
+        start_after = query.get('continuation-token') or query.get('start-after', '')
+        max_keys = int(query.get('max-keys', MAX_KEYS))
+        contents = []
+        common_prefixes = []
+        last_key = None
+        is_truncated = False
+        for key in sorted(objects):
+            if not key.startswith(prefix) or key <= start_after:
+                continue
+            if len(contents) + len(common_prefixes) >= max_keys:
+                is_truncated = True
+                break
+            if delimiter and delimiter in key[len(prefix) :]:
+                common_prefix = key[
+                    : key.index(delimiter, len(prefix)) + len(delimiter)
+                ]
+                if common_prefix in common_prefixes:
+                    continue
+                common_prefixes.append(common_prefix)
+                # Skip the rest of the keys under the common prefix
+                last_key = common_prefix + '\U0010ffff'
+                start_after = last_key
+                continue
+            data, etag, mtime = objects[key]
+            contents.append(
+                f'<Contents><Key>{escape(key)}</Key><LastModified>{_timestamp(mtime)}</LastModified>'
+                f'<ETag>{escape(etag)}</ETag><Size>{len(data)}</Size>'
+                '<StorageClass>STANDARD</StorageClass></Contents>'
+            )
+            last_key = key
+        children = (
+            f'<Name>{bucket}</Name><Prefix>{escape(prefix)}</Prefix>'
+            f'<KeyCount>{len(contents) + len(common_prefixes)}</KeyCount>'
+            f'<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(is_truncated).lower()}</IsTruncated>'
+            + ''.join(contents)
+            + ''.join(
+                f'<CommonPrefixes><Prefix>{escape(common_prefix)}</Prefix></CommonPrefixes>'
+                for common_prefix in common_prefixes
+            )
+        )
+        if delimiter:
+            children += f'<Delimiter>{escape(delimiter)}</Delimiter>'
+        if is_truncated:
+            children += (
+                f'<NextContinuationToken>{escape(last_key)}</NextContinuationToken>'
+            )
+        return _xml('ListBucketResult', children)
+
+    def _object_request(self, command, bucket, key, query, headers, body):
+        objects = self.buckets[bucket]
+        upload_id = query.get('uploadId')
+        if command == 'PUT' and upload_id is not None:
+            if upload_id not in self.uploads:
+                return self._error(404, 'NoSuchUpload', key)
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            self.uploads[upload_id][3][int(query['partNumber'])] = (body, etag)
+            return 200, {'ETag': etag}, b''
+        if command == 'PUT':
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            objects[key] = (body, etag, time.time())
+            return 200, {'ETag': etag}, b''
+        if command == 'POST' and 'uploads' in query:
+            upload_id = secrets.token_hex(16)
+            self.uploads[upload_id] = (bucket, key, time.time(), {})
+            return (
+                200,
+                {},
+                _xml(
+                    'InitiateMultipartUploadResult',
+                    f'<Bucket>{bucket}</Bucket><Key>{escape(key)}</Key>'
+                    f'<UploadId>{upload_id}</UploadId>',
+                ),
+            )
+        if command == 'POST':
+            if upload_id not in self.uploads:
+                return self._error(404, 'NoSuchUpload', key)
+            parts = self.uploads.pop(upload_id)[3]
+            numbers = [
+                int(element.text)
+                for element in ElementTree.fromstring(body).iter(
+                    f'{{{XMLNS}}}PartNumber'
+                )
+            ]
+            data = b''.join(parts[number][0] for number in numbers)
+            digests = b''.join(
+                bytes.fromhex(parts[number][1].strip('"')) for number in numbers
+            )
+            etag = f'"{hashlib.md5(digests).hexdigest()}-{len(numbers)}"'
+            objects[key] = (data, etag, time.time())
+            return (
+                200,
+                {},
+                _xml(
+                    'CompleteMultipartUploadResult',
+                    f'<Bucket>{bucket}</Bucket><Key>{escape(key)}</Key>'
+                    f'<ETag>{escape(etag)}</ETag>',
+                ),
+            )
+        if command == 'DELETE' and upload_id is not None:
+            if self.uploads.pop(upload_id, None) is None:
+                return self._error(404, 'NoSuchUpload', key)
+            return 204, {}, b''
+        if command == 'DELETE':
+            objects.pop(key, None)
+            return 204, {}, b''
+
+        # GET and HEAD
+        if key not in objects:
+            return self._error(404, 'NoSuchKey', key)
+        data, etag, mtime = objects[key]
+        if headers.get('If-Match') not in (None, etag):
+            return self._error(412, 'PreconditionFailed', key)
+        response_headers = {
+            'ETag': etag,
+            'Last-Modified': datetime.fromtimestamp(mtime, timezone.utc).strftime(
+                '%a, %d %b %Y %H:%M:%S GMT'
+            ),
+            'Accept-Ranges': 'bytes',
+        }
+        status = 200
+        if headers.get('Range', '').startswith('bytes='):
+            start, _, end = headers['Range'][len('bytes=') :].partition('-')
+            if not start:
+                start, end = max(0, len(data) - int(end)), len(data) - 1
+            start = int(start)
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+            response_headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+            data = data[start : end + 1]
+            status = 206
+        return status, response_headers, data
+
+
+def make_handler(args, stats, bucket, store=None):
+    upstream = urlsplit(args.upstream) if args.upstream else None
+    local = threading.local()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # The headers and the body are written separately -- with Nagle's
+        # algorithm the body waits for the client's delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                super().log_message(format, *log_args)
+
+        def _read_body(self):
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    chunk = self.rfile.read(size)
+                    self.rfile.readline()
+                    if size == 0:
+                        break
+                    chunks.append(chunk)
+                return b''.join(chunks)
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def _error(self, status, code, message):
+            body = (
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Error><Code>{code}</Code><Message>{message}</Message>'
+                f'<RequestId>{secrets.token_hex(8)}</RequestId></Error>'
+            ).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/xml')
+            self.send_header('Content-Length', str(len(body)))
+            if args.retry_after and status != 500:
+                self.send_header('Retry-After', str(args.retry_after))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def _throttle_reason(self, inflight):
+            if args.max_inflight and inflight > args.max_inflight:
+                return 'too many requests in flight'
+            if bucket is not None and not bucket.take():
+                return 'request rate'
+            if random.random() < args.error_rate:
+                return 'random'
+            return None
+
+        def _respond(self, status, headers, body):
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+                with stats.lock:
+                    stats.bytes_out += len(body)
+
+        def _forward(self, body):
+            if store is not None:
+                self._respond(
+                    *store.handle(self.command, self.path, self.headers, body)
+                )
+                return
+            conn = getattr(local, 'conn', None)
+            if conn is None:
+                conn = local.conn = HTTPConnection(upstream.hostname, upstream.port)
+            headers = {
+                key: value
+                for key, value in self.headers.items()
+                if key.lower() not in HOP_HEADERS
+            }
+            headers['Content-Length'] = str(len(body))
+            try:
+                conn.request(self.command, self.path, body=body, headers=headers)
+                response = conn.getresponse()
+                response_body = response.read()
+            except (ConnectionError, OSError):
+                # Upstream closed the connection -- retry once on a new one
+                conn.close()
+                conn = local.conn = HTTPConnection(upstream.hostname, upstream.port)
+                conn.request(self.command, self.path, body=body, headers=headers)
+                response = conn.getresponse()
+                response_body = response.read()
+
+            self.send_response(response.status)
+            for key, value in response.getheaders():
+                if key.lower() not in HOP_HEADERS:
+                    self.send_header(key, value)
+            if self.command == 'HEAD':
+                self.send_header(
+                    'Content-Length', response.getheader('Content-Length', '0')
+                )
+            else:
+                self.send_header('Content-Length', str(len(response_body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(response_body)
+                with stats.lock:
+                    stats.bytes_out += len(response_body)
+
+        def _handle(self):
+            body = self._read_body()
+            with stats.lock:
+                stats.operations[operation_name(self.command, self.path)] += 1
+                stats.bytes_in += len(body)
+                stats.requests += 1
+                stats.inflight += 1
+                inflight = stats.inflight
+                stats.max_inflight = max(stats.max_inflight, inflight)
+            try:
+                if args.latency:
+                    time.sleep(args.latency * inflight)
+                reason = self._throttle_reason(inflight)
+                if reason is not None:
+                    with stats.lock:
+                        stats.throttled += 1
+                    if args.status == 429:
+                        self._error(429, 'TooManyRequests', f'Throttled ({reason})')
+                    else:
+                        self._error(
+                            503,
+                            'SlowDown',
+                            f'Please reduce your request rate ({reason})',
+                        )
+                elif random.random() < args.transient_rate:
+                    with stats.lock:
+                        stats.failed += 1
+                    self._error(
+                        500, 'InternalError', 'We encountered an internal error'
+                    )
+                else:
+                    self._forward(body)
+            finally:
+                with stats.lock:
+                    stats.inflight -= 1
+
+        do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+    return Handler
+
+
+def make_argparser():
+    argparser = argparse.ArgumentParser(
+        description='Local S3 stand-in that throttles like an object store under load'
+    )
+    argparser.add_argument(
+        '--upstream',
+        help='S3-compatible server to forward to, e.g. http://127.0.0.1:9000 (default: keep objects in memory)',
+    )
+    argparser.add_argument('--port', type=int, default=9001)
+    argparser.add_argument('--max-inflight', type=int, default=0)
+    argparser.add_argument('--rate', type=float, default=0)
+    argparser.add_argument('--error-rate', type=float, default=0.0)
+    argparser.add_argument('--transient-rate', type=float, default=0.0)
+    argparser.add_argument('--latency', type=float, default=0.0)
+    argparser.add_argument('--retry-after', type=int, default=0)
+    argparser.add_argument('--status', type=int, choices=[429, 503], default=503)
+    argparser.add_argument('--report', type=float, default=10.0)
+    argparser.add_argument('--verbose', action='store_true')
+    return argparser
+
+
+def make_server(args, stats):
+    # type: (argparse.Namespace, Stats) -> ThreadingHTTPServer
+    "Server for `args` (of `make_argparser()`) -- `--port 0` picks a free port"
+    bucket = TokenBucket(args.rate) if args.rate else None
+    store = None if args.upstream else MemoryStore()
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', args.port), make_handler(args, stats, bucket, store)
+    )
+    server.daemon_threads = True
+    return server
+
+
+def entry():
+    args = make_argparser().parse_args()
+
+    stats = Stats()
+    server = make_server(args, stats)
+
+    def _report():
+        while True:
+            time.sleep(args.report)
+            print(stats.line(), flush=True)
+
+    threading.Thread(target=_report, daemon=True).start()
+    if args.upstream:
+        print(f'Forwarding http://127.0.0.1:{args.port} to {args.upstream}', flush=True)
+    else:
+        print(f'Serving http://127.0.0.1:{args.port} from memory', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(stats.line())
+
+
+if __name__ == '__main__':
+    entry()
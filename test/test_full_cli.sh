@@ -26,6 +26,13 @@ aws --endpoint-url http://127.0.0.1:9000/ s3 mb s3://bitum-bucket || true
 
 set -x
 
+# Build and extract locally -- all files are at the root of `files-random/`,
+# which is given with a trailing `/`
+mkdir -p build-dir/extracted
+(cd build-dir && python ../bitum/cli.py debug build ../files-random/ && python ../bitum/cli.py extract extracted)
+diff -r ./build-dir/extracted ./files-random-original
+/bin/rm -rf build-dir/
+
 # Upload files
 python bitum/cli.py upload --create --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket files-random # python cli.py sync
 
@@ -39,4 +46,96 @@ python bitum/cli.py download --endpoint-url http://127.0.0.1:9000/ --bucket bitu
 # Check that the downloaded files are correct
 diff -r ./files-random ./files-random-original
 
+# Upload to and download from a local directory
+/bin/rm -rf files-random/ nas/
+mkdir -p files-random/ nas/
+cp -Rf ./files-random-original/* ./files-random
+python bitum/cli.py upload --create --endpoint-url "file://$PWD/nas" --bucket bitum-bucket files-random
+/bin/rm -rf files-random/
+mkdir -p files-random/
+python bitum/cli.py download --endpoint-url "file://$PWD/nas" --bucket bitum-bucket files-random
+diff -r ./files-random ./files-random-original
+/bin/rm -rf nas/
+
 /bin/rm -rf files-random/ files-random-original/
+
+# Upload and download a tree that is split into one shard per top-level
+# directory, and download only some of it with `--include`
+mkdir -p files-tree/a/b files-tree/c
+for i in $(seq 20); do
+  for dir in files-tree files-tree/a files-tree/a/b files-tree/c; do
+    dd bs=1 count=$((1 + $RANDOM % 1000)) if=/dev/random > "$dir/$i" 2>/dev/null
+  done
+done
+cp -Rf ./files-tree ./files-tree-original
+python bitum/cli.py upload --create --shard-depth 1 --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix tree files-tree
+/bin/rm -rf files-tree/
+mkdir -p files-tree/
+python bitum/cli.py download --include 'a/**' --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix tree files-tree
+diff -r ./files-tree/a ./files-tree-original/a
+test ! -e files-tree/c
+python bitum/cli.py download --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix tree files-tree
+diff -r ./files-tree ./files-tree-original
+/bin/rm -rf files-tree/ files-tree-original/
+
+# Upload with `bitum watch` running, so the second upload only reads the
+# paths that changed since the first one
+mkdir -p files-watch/a
+for i in $(seq 20); do
+  dd bs=1 count=$((1 + $RANDOM % 1000)) if=/dev/random > "files-watch/$i" 2>/dev/null
+  dd bs=1 count=$((1 + $RANDOM % 1000)) if=/dev/random > "files-watch/a/$i" 2>/dev/null
+done
+python bitum/cli.py watch files-watch > watch.log &
+watch_pid=$!
+until grep -q '^Watching' watch.log; do sleep 0.1; done
+python bitum/cli.py upload --create --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix watch files-watch
+echo changed > files-watch/1
+/bin/rm files-watch/a/2
+mkdir -p files-watch/b
+echo new > files-watch/b/new
+python bitum/cli.py upload --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix watch files-watch | tee upload.log
+grep -q 'paths changed since the last upload' upload.log
+kill $watch_pid
+wait $watch_pid
+cp -Rf ./files-watch ./files-watch-original
+/bin/rm -rf files-watch/
+mkdir -p files-watch/
+python bitum/cli.py download --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix watch files-watch
+diff -r ./files-watch ./files-watch-original
+/bin/rm -rf files-watch/ files-watch-original/ watch.log upload.log
+
+# Interrupt an upload and a download of a file larger than a part of a
+# multipart upload (16 MiB) and resume them. The transfers are throttled, so
+# they are interrupted part-way (`timeout` exits with 124 when it has to
+# stop the command).
+mkdir -p files-large
+dd bs=1048576 count=40 if=/dev/urandom of=files-large/large 2>/dev/null
+cp -Rf ./files-large ./files-large-original
+status=0
+timeout -s INT 7 python bitum/cli.py upload --create --upload-limit 4M --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix large files-large || status=$?
+test $status -eq 124
+# The index is only uploaded at the end, so the backup still has to be created
+python bitum/cli.py upload --create --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix large files-large | tee upload.log
+# Only the parts that weren't uploaded before are sent
+if grep -q '^Sent 40.00 MiB' upload.log; then exit 1; fi
+/bin/rm -f upload.log
+/bin/rm -rf files-large/
+mkdir -p files-large/
+status=0
+timeout -s INT 5 python bitum/cli.py download --download-limit 4M --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix large files-large || status=$?
+test $status -eq 124
+# The download continues from what was written to the partial file
+test -s files-large/.large.bitum-part
+# The partial file isn't backed up (to another prefix, since the directory has
+# no complete files)
+python bitum/cli.py upload --create --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix large-partial files-large
+mkdir -p files-large-partial
+python bitum/cli.py download --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix large-partial files-large-partial
+test -z "$(ls -A files-large-partial)"
+/bin/rm -rf files-large-partial/
+python bitum/cli.py download --endpoint-url http://127.0.0.1:9000/ --bucket bitum-bucket --prefix large files-large
+diff -r ./files-large ./files-large-original
+/bin/rm -rf files-large/ files-large-original/
+
+# Not covered here: retrying failed requests with backoff, which needs an
+# endpoint that fails on purpose